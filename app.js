@@ -18,6 +18,7 @@ var currentDeviceId = null;
 var devicesId = []
 var requestId = null;
 var resultChecker = null;
+var statusWaiter = null;
 
 var controller = new Controller();
 var text_lines_editor = new TextLinesEditor(document.getElementById('map-container'));
@@ -55,6 +56,11 @@ document.getElementById("cancel").addEventListener("click", function () {
         clearInterval(resultChecker);
     }
 
+    if (statusWaiter != null) {
+        statusWaiter.abort();
+        statusWaiter = null;
+    }
+
     requestId = null;
 
     clear();
@@ -92,20 +98,45 @@ async function send() {
 
     upload_url = window.location.origin + '/upload_image'
 
-    data = image
-    if (typeof image != 'string') {
-        data = image.src;
-    }
+    // the image is uploaded as raw JPEG bytes, without the base64 encoding overhead
+    let blob = await new Promise(resolve => original_image_canvas.toBlob(resolve, 'image/jpeg', 0.85));
 
     let response = await fetch(upload_url, {
         method: 'POST',
         headers: {
             'Accept': 'application/json',
-            'Content-Type': 'application/json'
+            'Content-Type': 'image/jpeg'
         },
-        body: JSON.stringify({ image: data })
+        body: blob
     })
 
+    // the server rejects uploads when it is overloaded (503) or the client has too many unfinished uploads (429)
+    if (response.status == 429 || response.status == 503) {
+        $('#uploadingMessage').collapse('hide');
+        let retry_after = response.headers.get('Retry-After');
+        alert("Server je momentálně přetížený. Zkuste to prosím znovu" + (retry_after != null ? " za " + retry_after + " s." : " později."));
+        return;
+    }
+
+    if (response.status == 413) {
+        $('#uploadingMessage').collapse('hide');
+        alert("Obrázek je příliš velký.");
+        return;
+    }
+
+    // errors of the application come with a JSON body with the message, those of the web server may not
+    if (!response.ok) {
+        $('#uploadingMessage').collapse('hide');
+        let error = null;
+        try {
+            error = (await response.json())['error'];
+        }
+        catch (e) {
+        }
+        alert("Nahrání obrázku se nezdařilo" + (error != null ? ": " + error : ". Zkuste to prosím znovu."));
+        return;
+    }
+
     data = await response.json();
     requestId = data['request_id'];
     window.history.pushState(null, "PERO App", '?id=' + requestId);
@@ -135,8 +166,8 @@ function snap() {
     original_image_canvas.height = resolution.height;
     original_image_canvas.getContext('2d').drawImage(video, 0, 0);
 
-    // base64 encoded image
-    image = original_image_canvas.toDataURL('image/jpeg', 0.85);
+    // the image is encoded from the canvas when it is sent
+    image = original_image_canvas;
 }
 
 function selectImage() {
@@ -167,7 +198,7 @@ function selectImage() {
                     preview_canvas.getContext('2d').drawImage(temp_image, 0, 0, preview_canvas.width, preview_canvas.height);
                     original_image_canvas.getContext('2d').drawImage(temp_image, 0, 0, original_image_canvas.width, original_image_canvas.height);
 
-                    image = original_image_canvas.toDataURL('image/jpeg', 0.85);
+                    image = original_image_canvas;
                 }
 
                 temp_image.src = reader_onload_event.target.result;
@@ -336,36 +367,81 @@ function waitForResult() {
     var url = new URL(window.location);
     requestId = url.searchParams.get("id");
 
-    resultChecker = setInterval(function () {
-        checkStatus(requestId).then(requestStatus => {
-            if (requestStatus == 200) {
-                clearInterval(resultChecker);
-                text_lines_editor.change_image(requestId);
-                
-                controller.goForward();
-            }
-            else if (requestStatus == 202) {
-                // continue checking
-            }
-            else if (requestStatus == 404) {
-                clearInterval(resultChecker);
-                alert("Naznámý požadavek. ID: " + requestId);
-                controller.goStart();
-            }
-            else if (requestStatus == 500) {
-                clearInterval(resultChecker);
-                alert("Při zpracování Vašeho požadavku došlo k chybě. Zkuste to prosím znovu. ID: " + requestId);
-                controller.goStart();
+    waitForStatus(requestId);
+}
+
+async function waitForStatus(waitedRequestId) {
+    // long polling, the server answers as soon as the request is finished or after a timeout (202)
+    statusWaiter = new AbortController();
+
+    while (requestId == waitedRequestId) {
+        let requestStatus = null;
+        let retryAfter = null;
+
+        try {
+            let response = await fetch("/wait_status/" + waitedRequestId, { signal: statusWaiter.signal });
+            requestStatus = response.status;
+            retryAfter = response.headers.get('Retry-After');
+        }
+        catch (error) {
+            if (error.name == "AbortError") {
+                return;
             }
-            else {
+        }
+
+        if (requestId != waitedRequestId) {
+            return;
+        }
+
+        if (requestStatus == 200 || requestStatus == 500) {
+            statusWaiter = null;
+            handleRequestStatus(requestStatus);
+            return;
+        }
+        else if (requestStatus != 202) {
+            // long polling not available, fall back to periodic status checks
+            statusWaiter = null;
+            pollForResult(waitedRequestId);
+            return;
+        }
+        else if (retryAfter != null) {
+            // the server did not let the request wait, too many clients are waiting
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        }
+    }
+}
+
+function pollForResult(waitedRequestId) {
+    resultChecker = setInterval(function () {
+        checkStatus(waitedRequestId).then(requestStatus => {
+            if (requestStatus != 202) {
                 clearInterval(resultChecker);
-                alert("Neočekávaný stav (" + requestStatus + ") požadavku. ID: " + requestId);
-                controller.goStart();
+                handleRequestStatus(requestStatus);
             }
         });
     }, 2000);
 }
 
+function handleRequestStatus(requestStatus) {
+    if (requestStatus == 200) {
+        text_lines_editor.change_image(requestId);
+
+        controller.goForward();
+    }
+    else if (requestStatus == 404) {
+        alert("Naznámý požadavek. ID: " + requestId);
+        controller.goStart();
+    }
+    else if (requestStatus == 500) {
+        alert("Při zpracování Vašeho požadavku došlo k chybě. Zkuste to prosím znovu. ID: " + requestId);
+        controller.goStart();
+    }
+    else {
+        alert("Neočekávaný stav (" + requestStatus + ") požadavku. ID: " + requestId);
+        controller.goStart();
+    }
+}
+
 function checkRequest() {
     checkStatus(requestId).then(requestStatus => {
         if (requestStatus == 200) {
@@ -385,10 +461,38 @@ async function checkStatus(requestId) {
 }
 
 async function updateMusicButton() {
-    let url = "/get_music/" + requestId;
+    let musicRequestId = requestId;
+    let url = "/get_music/" + musicRequestId;
 
     setDisabled('play');
 
+    // the music manifest tells whether the page has MIDI, only results processed without it are probed
+    let statusResponse = await fetch("/get_music_status/" + musicRequestId);
+    if (statusResponse.status == 200) {
+        let music = await statusResponse.json();
+
+        if (musicRequestId != requestId) {
+            return;
+        }
+
+        if (music['status'] == "pending") {
+            setTimeout(() => {
+                if (musicRequestId == requestId) {
+                    updateMusicButton();
+                }
+            }, 3000);
+        }
+        else if (music['page']) {
+            setEnabled('play');
+            document.getElementById("midi-player").src = url;
+        }
+        else {
+            document.getElementById("midi-player").src = "";
+        }
+
+        return;
+    }
+
     fetch(url).then(response => {
         if (response.status == 200)
         {
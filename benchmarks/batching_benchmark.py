@@ -0,0 +1,115 @@
+"""Measures OCR throughput (pages/s) of ocr_pipeline.DynamicBatching with different batch settings.
+
+Example:
+    python benchmarks/batching_benchmark.py -p pipeline/config.ini -i images/ --batch-sizes 1 2 4 8 --batch-delays 0.02 0.1
+"""
+
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import configparser
+
+import cv2
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pero_ocr.core.layout import PageLayout
+from pero_ocr.document_ocr.page_parser import PageParser
+
+from ocr_pipeline import DynamicBatching
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pipeline-config', help='Path to OCR pipeline config file.', required=True)
+    parser.add_argument('-i', '--images', help='Directory with benchmark images.', required=True)
+    parser.add_argument('--device', help='Torch device used for OCR.', default='cuda')
+    parser.add_argument('--batch-sizes', help='Batch sizes to measure.', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--batch-delays', help='Maximal batch delays (in seconds) to measure.', type=float, nargs='+', default=[0.05])
+    parser.add_argument('--repeat', help='Number of passes over the images for each setting.', type=int, default=1)
+    args = parser.parse_args()
+    return args
+
+
+def load_images(path):
+    images = []
+
+    for file_name in sorted(os.listdir(path)):
+        image = cv2.imread(os.path.join(path, file_name), 1)
+        if image is not None:
+            images.append((os.path.splitext(file_name)[0], image))
+
+    return images
+
+
+def run(page_parser, images, batch_size, batch_delay):
+    # the page parser is serialized as in the OCR pipeline, only the OCR engines are called by several threads
+    parser_lock = threading.Lock()
+    batching = DynamicBatching(page_parser, max_delay=batch_delay, parser_lock=parser_lock) if batch_size > 1 else None
+    pages = queue.Queue()
+    for page in images:
+        pages.put(page)
+
+    def worker():
+        while True:
+            try:
+                page_id, image = pages.get_nowait()
+            except queue.Empty:
+                return
+
+            page_layout = PageLayout(id=page_id, page_size=(image.shape[0], image.shape[1]))
+
+            if batching is not None:
+                batching.page_started()
+            try:
+                with parser_lock:
+                    page_parser.process_page(image, page_layout)
+            finally:
+                if batching is not None:
+                    batching.page_finished()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(batch_size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    stats = {}
+    if batching is not None:
+        stats = batching.stats()
+        batching.uninstall()
+
+    return elapsed, stats
+
+
+def main():
+    args = parse_arguments()
+
+    pipeline_config = configparser.ConfigParser()
+    pipeline_config.read(args.pipeline_config)
+    page_parser = PageParser(pipeline_config, torch.device(args.device), config_path=os.path.dirname(args.pipeline_config))
+
+    images = load_images(args.images) * args.repeat
+    print(f"{len(images)} pages per setting")
+
+    # warm up, the first pages are slow because of lazy initialization
+    run(page_parser, images[:2], batch_size=1, batch_delay=0)
+
+    print(f"{'batch size':>10} {'delay [s]':>10} {'pages/s':>10} {'pages/batch':>12} {'lines/batch':>12}")
+    for batch_size in args.batch_sizes:
+        for batch_delay in (args.batch_delays if batch_size > 1 else [0.0]):
+            elapsed, stats = run(page_parser, images, batch_size, batch_delay)
+            print(f"{batch_size:>10} {batch_delay:>10.3f} {len(images) / elapsed:>10.2f} "
+                  f"{stats.get('pages_per_batch', 1.0):>12.2f} {stats.get('lines_per_batch', 0.0):>12.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""Compares throughput and latency of the server modes (Flask development server and gunicorn workers) under load.
+
+The server is started for each mode with the given config, so the test should run against a copy of the data
+directories. Uploaded images are processed only if the OCR pipeline runs on the same directories.
+
+Example:
+    python benchmarks/load_test.py -c test_config.ini -i image.jpg --lines-request-id 0123abcd --modes 0 4 --concurrency 16
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+import urllib3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_helper
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config-file', help='Path to server config file.', required=True)
+    parser.add_argument('-i', '--image', help='JPEG or PNG image uploaded by the upload_image test.', required=True)
+    parser.add_argument('--lines-request-id', help='ID of a finished request used by the get_lines test.')
+    parser.add_argument('--modes', help='Numbers of gunicorn workers to measure, 0 for the Flask development server.', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--threads', help='Number of threads of each gunicorn worker.', type=int, default=16)
+    parser.add_argument('--concurrency', help='Number of concurrent clients.', type=int, default=16)
+    parser.add_argument('--requests', help='Number of requests of each test.', type=int, default=500)
+    parser.add_argument('--wait-timeout', help='Timeout of the wait_status requests in seconds.', type=float, default=1.0)
+    args = parser.parse_args()
+    return args
+
+
+def start_server(config_file, workers, threads, base_url):
+    command = [sys.executable, SERVER_SCRIPT, "-c", config_file, "--workers", str(workers), "--threads", str(threads)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            requests.get(base_url + "/get_cache_stats", timeout=1, verify=False)
+            return process
+        except (requests.ConnectionError, requests.Timeout):
+            # a starting gunicorn worker may accept the connection before the application is loaded
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError(f"Server with {workers} workers did not start.")
+
+
+def stop_server(process):
+    process.terminate()
+    process.wait(timeout=30)
+
+
+def run_test(name, send_request, count, concurrency):
+    local = threading.local()
+
+    def timed_request(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.verify = False
+            local.session = session
+
+        start = time.monotonic()
+        response = send_request(session, i)
+        return time.monotonic() - start, response.status_code < 500
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_request, range(count)))
+    elapsed = time.monotonic() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    errors = sum(1 for _, ok in results if not ok)
+
+    print(f"{name:>14} {count / elapsed:>10.1f} {np.percentile(latencies, 50):>9.1f} "
+          f"{np.percentile(latencies, 95):>9.1f} {np.percentile(latencies, 99):>9.1f} {errors:>7}")
+
+
+def main():
+    args = parse_arguments()
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    configuration = config_helper.parse_configuration(args.config_file)
+    scheme = "https" if "ssl" in configuration else "http"
+    host = configuration["common"]["host"]
+    if host == "0.0.0.0":
+        host = "127.0.0.1"
+    base_url = f"{scheme}://{host}:{configuration['common']['port']}"
+
+    with open(args.image, "rb") as file:
+        image = file.read()
+    content_type = "image/png" if image.startswith(b"\x89PNG") else "image/jpeg"
+
+    for workers in args.modes:
+        mode = "Flask development server" if workers == 0 else f"gunicorn, {workers} workers x {args.threads} threads"
+        print(mode)
+        print(f"{'endpoint':>14} {'req/s':>10} {'p50 [ms]':>9} {'p95 [ms]':>9} {'p99 [ms]':>9} {'errors':>7}")
+
+        process = start_server(args.config_file, workers, args.threads, base_url)
+        request_ids = []
+
+        try:
+            def upload_image(session, i):
+                response = session.post(base_url + "/upload_image", data=image, headers={"Content-Type": content_type})
+                if response.status_code == 200:
+                    request_ids.append(response.json()["request_id"])
+                return response
+
+            def get_status(session, i):
+                return session.get(base_url + "/get_status/" + request_ids[i % len(request_ids)])
+
+            def wait_status(session, i):
+                # queued requests wait for the timeout (or get 202 right away when too many clients are waiting)
+                return session.get(base_url + "/wait_status/" + request_ids[i % len(request_ids)],
+                                   params={"timeout": args.wait_timeout})
+
+            def get_lines(session, i):
+                return session.get(base_url + "/get_lines/" + args.lines_request_id, headers={"Accept-Encoding": "gzip"})
+
+            run_test("upload_image", upload_image, args.requests, args.concurrency)
+            if request_ids:
+                run_test("get_status", get_status, args.requests, args.concurrency)
+                run_test("wait_status", wait_status, args.requests, args.concurrency)
+            if args.lines_request_id is not None:
+                run_test("get_lines", get_lines, args.requests, args.concurrency)
+
+        finally:
+            stop_server(process)
+
+        print()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
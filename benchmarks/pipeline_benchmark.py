@@ -0,0 +1,438 @@
+"""Offline end-to-end benchmark of the OCR pipeline with a stub PageParser and a stub captioning service.
+
+Images are uploaded to a temporary upload directory the same way as by the server and go through the real
+NewFileHandler flow (watchdog events, work queue, loading, saving of tiles, confidences, logits and XML, captioning and
+music export), only the OCR is replaced by StubPageParser, which returns synthetic lines and regions after a given
+delay, and captions are generated by a local HTTP server answering like the OpenAI API after a given delay. No GPU,
+models or network access are needed (pero_ocr and torch are still imported by ocr_pipeline). Reports pages/s, the
+distribution of upload-to-XML latency and the time spent in each stage, results can be saved as JSON.
+
+Example:
+    python benchmarks/pipeline_benchmark.py -i images/ --pages 200 --recognition-latency 0.5 --caption-latency 1.0
+    python benchmarks/pipeline_benchmark.py --pages 200 --pipelined --save-workers 4 --deferred-captions -o results.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+
+import numpy as np
+import scipy.sparse
+from watchdog.observers import Observer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_registry
+import request_storage
+from captioning import CaptionCache, CaptionClient
+from ocr_pipeline import NewFileHandler, StagedPipeline, WorkQueue
+from server_benchmark import WORDS, get_commit, get_line_positions, make_image
+
+from pero_ocr.core.layout import RegionLayout, TextLine
+
+CHARACTERS = sorted(set("".join(WORDS) + " "))
+CAPTION_CATEGORY = "Obrázek"
+MUSIC_CATEGORY = "Notový zápis"
+
+STORAGE_DIRECTORIES = ("images", "xmls", "logits", "errors", "music", "tiles", "claims")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--images', help='Directory with JPEG or PNG images, a synthetic page is used by default.')
+    parser.add_argument('-o', '--output', help='Path of the JSON file with the results.')
+    parser.add_argument('--pages', help='Number of uploaded pages (the images are repeated).', type=int, default=100)
+    parser.add_argument('--warmup', help='Number of pages processed before the measurement.', type=int, default=2)
+    parser.add_argument('--upload-interval', help='Seconds between two uploads, 0 uploads all pages at once.', type=float, default=0.0)
+    parser.add_argument('--recognition-latency', help='Seconds the stub parser spends on each page.', type=float, default=0.2)
+    parser.add_argument('--line-latency', help='Seconds the stub parser spends on each text line.', type=float, default=0.0)
+    parser.add_argument('--lines', help='Number of text lines of each page.', type=int, default=40)
+    parser.add_argument('--image-regions', help='Number of captioned image regions of each page.', type=int, default=2)
+    parser.add_argument('--music-regions', help='Number of music regions of each page.', type=int, default=0)
+    parser.add_argument('--caption-latency', help='Seconds the stub captioning service spends on each request.', type=float, default=0.5)
+    parser.add_argument('--caption-concurrency', help='Maximal number of concurrent captioning requests.', type=int, default=4)
+    parser.add_argument('--caption-cache', help='Use the persistent caption cache.', action='store_true')
+    parser.add_argument('--deferred-captions', help='Publish results before image captions are generated.', action='store_true')
+    parser.add_argument('--no-logits', help='Do not store full logits.', action='store_true')
+    parser.add_argument('--no-tiles', help='Do not generate tile pyramids.', action='store_true')
+    parser.add_argument('--max-pixels', help='Scale larger images down to this number of pixels.', type=int, default=0)
+    parser.add_argument('--pipelined', help='Load, recognize and save different pages concurrently.', action='store_true')
+    parser.add_argument('--load-workers', help='Number of threads loading images in pipelined mode.', type=int, default=1)
+    parser.add_argument('--recognition-workers', help='Number of threads running OCR in pipelined mode.', type=int, default=1)
+    parser.add_argument('--save-workers', help='Number of threads saving results in pipelined mode.', type=int, default=2)
+    parser.add_argument('--stage-queue-size', help='Maximal number of pages waiting between stages in pipelined mode.', type=int, default=2)
+    parser.add_argument('--timeout', help='Maximal time in seconds to wait for the results.', type=float, default=3600)
+    parser.add_argument('--data-dir', help='Directory for the uploads and results, kept after the benchmark (a temporary directory by default).')
+    parser.add_argument('--verbose', help='Print the log of the pipeline.', action='store_true')
+    args = parser.parse_args()
+    return args
+
+
+class StubPageParser:
+    """Replacement of PageParser which returns synthetic text lines (with logits), image and music regions after
+    a fixed delay. Layouts are generated from the page ID, so repeated runs produce the same results."""
+
+    def __init__(self, page_latency, line_latency, lines, image_regions, music_regions, frames_per_character=3):
+        self.page_latency = page_latency
+        self.line_latency = line_latency
+        self.lines = lines
+        self.image_regions = image_regions
+        self.music_regions = music_regions
+        self.frames_per_character = frames_per_character
+
+        self._labels = dict((character, i) for i, character in enumerate(CHARACTERS))
+
+    def process_page(self, image, page_layout):
+        time.sleep(self.page_latency + self.line_latency * self.lines)
+
+        rng = random.Random(page_layout.id)
+        height, width = page_layout.page_size
+        left, right = width // 16, width - width // 16
+
+        text_region = self.create_region("r000", [[left, 0], [right, 0], [right, height * 0.75], [left, height * 0.75]], "text")
+        for i, (top, bottom) in enumerate(get_line_positions(height, self.lines)):
+            text_region.lines.append(self.create_line(f"r000-l{i:03d}", i, left, right, top, bottom, rng))
+        page_layout.regions = [text_region]
+
+        # the lower quarter of the page is split into columns of image regions and rows of music regions
+        for i in range(self.image_regions):
+            x1 = left + (right - left) * i // self.image_regions
+            x2 = left + (right - left) * (i + 1) // self.image_regions
+            polygon = [[x1, height * 0.78], [x2, height * 0.78], [x2, height * 0.88], [x1, height * 0.88]]
+            page_layout.regions.append(self.create_region(f"r{len(page_layout.regions):03d}", polygon, CAPTION_CATEGORY))
+
+        for i in range(self.music_regions):
+            y1 = height * (0.9 + 0.09 * i / self.music_regions)
+            y2 = height * (0.9 + 0.09 * (i + 1) / self.music_regions)
+            polygon = [[left, y1], [right, y1], [right, y2], [left, y2]]
+            page_layout.regions.append(self.create_region(f"r{len(page_layout.regions):03d}", polygon, MUSIC_CATEGORY))
+
+        return page_layout
+
+    def create_region(self, region_id, polygon, category):
+        region = RegionLayout(region_id, np.asarray(polygon, dtype=np.float64))
+        region.category = category
+        return region
+
+    def create_line(self, line_id, index, left, right, top, bottom, rng):
+        transcription = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        baseline = bottom - (bottom - top) // 5
+
+        line = TextLine(id=line_id, index=index,
+                        baseline=np.asarray([[left, baseline], [right, baseline]], dtype=np.float64),
+                        polygon=np.asarray([[left, top], [right, top], [right, bottom], [left, bottom]], dtype=np.float64),
+                        heights=[float(baseline - top), float(bottom - baseline)],
+                        transcription=transcription,
+                        logits=self.create_logits(transcription),
+                        characters=CHARACTERS,
+                        logit_coords=[0, right - left])
+        line.category = "text"
+        return line
+
+    def create_logits(self, transcription):
+        """CTC logits with a confident frame of each character surrounded by blank frames."""
+        blank = len(CHARACTERS)
+        logits = np.zeros((len(transcription) * self.frames_per_character, blank + 1), dtype=np.float32)
+        logits[:, blank] = 10.0
+
+        for i, character in enumerate(transcription):
+            frame = i * self.frames_per_character + self.frames_per_character // 2
+            logits[frame, blank] = 0.0
+            logits[frame, self._labels[character]] = 10.0
+
+        return scipy.sparse.csc_matrix(logits)
+
+
+class CaptionServer(ThreadingHTTPServer):
+    """Local stub of the OpenAI chat completions endpoint answering each request after a fixed delay."""
+
+    daemon_threads = True
+
+    def __init__(self, latency):
+        super().__init__(("127.0.0.1", 0), CaptionRequestHandler)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+class CaptionRequestHandler(BaseHTTPRequestHandler):
+    # keeps the connections of the client's pool alive
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.count_request()
+        time.sleep(self.server.latency)
+
+        body = json.dumps({"choices": [{"message": {"role": "assistant", "content": "A stub caption of the image."}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_images(path, image_size=(1600, 2200), lines=40):
+    """Encoded images of the directory with their extensions, a synthetic JPEG page without the directory."""
+    if path is None:
+        return [(make_image(image_size[0], image_size[1], lines), ".jpg")]
+
+    images = []
+    for file_name in sorted(os.listdir(path)):
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension in {".jpg", ".jpeg", ".png"}:
+            with open(os.path.join(path, file_name), "rb") as file:
+                images.append((file.read(), ".png" if extension == ".png" else ".jpg"))
+
+    return images
+
+
+def upload(upload_path, jobs, data, extension):
+    """Stores the image the same way as the server, returns its request ID."""
+    request_id = uuid.uuid4().hex
+    jobs.add(request_id)
+
+    path = request_storage.make_shard_dirs(request_storage.get_file_path(upload_path, request_id, extension))
+    with open(path + ".part", "wb") as file:
+        file.write(data)
+    os.replace(path + ".part", path)
+
+    return request_id
+
+
+def wait_for_results(jobs, request_ids, deadline):
+    """Waits until the jobs are done or failed, returns them by their request IDs."""
+    finished = {}
+    waiting = list(request_ids)
+
+    while len(waiting) > 0 and time.monotonic() < deadline:
+        still_waiting = []
+        for request_id in waiting:
+            job = jobs.get(request_id)
+            if job["state"] in {job_registry.DONE, job_registry.FAILED}:
+                finished[request_id] = job
+            else:
+                still_waiting.append(request_id)
+
+        waiting = still_waiting
+        if len(waiting) > 0:
+            time.sleep(0.05)
+
+    if len(waiting) > 0:
+        raise TimeoutError(f"{len(waiting)} pages were not processed in time.")
+
+    return finished
+
+
+def wait_for_background_work(handler, request_ids, deadline):
+    """Waits for music exports and deferred captions of the pages, which run after their results are published."""
+    for request_id in request_ids:
+        while time.monotonic() < deadline:
+            pending_captions = os.path.exists(handler.get_pending_captions_file_path(request_id))
+
+            try:
+                with open(handler.get_music_manifest_file_path(request_id), "r") as file:
+                    pending_music = json.load(file)["status"] == "pending"
+            except (OSError, ValueError):
+                pending_music = False
+
+            if not pending_captions and not pending_music:
+                break
+
+            time.sleep(0.05)
+
+
+def load_traces(path, request_ids):
+    request_ids = set(request_ids)
+    records = []
+
+    with open(path, "r") as file:
+        for line in file:
+            record = json.loads(line)
+            if record["file_id"] in request_ids:
+                records.append(record)
+
+    return records
+
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64) * 1000
+
+    if len(values) == 0:
+        return None
+
+    return {
+        "count": len(values),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+        "total": float(values.sum())
+    }
+
+
+def get_stage_times(records):
+    """Distributions of stage durations of the pages, including waiting for the work queue and between stages."""
+    stages = defaultdict(list)
+
+    for record in records:
+        if record["event"] == "page" and record["status"] == "done":
+            stages["queue_wait"].append(record["wait_time"])
+            for stage, duration in record["stages"].items():
+                stages[stage].append(duration)
+            # waiting in the queues between the stages of the pipelined mode
+            stages["between_stages"].append(max(record["duration"] - sum(record["stages"].values()), 0.0))
+
+        elif record["event"] != "page":
+            # music export and deferred captions, which run after the result is published
+            stages[record["event"]].append(record["duration"])
+
+    return dict((stage, summarize(durations)) for stage, durations in stages.items())
+
+
+def print_summary(name, summary):
+    if summary is not None:
+        print(f"{name:>18} {summary['count']:>6} {summary['mean']:>10.1f} {summary['p50']:>10.1f} "
+              f"{summary['p95']:>10.1f} {summary['p99']:>10.1f} {summary['max']:>10.1f}")
+
+
+def main():
+    args = parse_arguments()
+
+    images = load_images(args.images, lines=args.lines)
+    if len(images) == 0:
+        print(f"No images found in {args.images}")
+        return 1
+
+    data_dir = args.data_dir if args.data_dir is not None else tempfile.mkdtemp(prefix="pero-pipeline-benchmark-")
+    paths = dict((name, os.path.join(data_dir, name)) for name in STORAGE_DIRECTORIES)
+    for name, path in paths.items():
+        os.makedirs(path, exist_ok=True)
+        if name not in {"tiles", "claims"}:
+            request_storage.create_shards(path)
+
+    caption_server = CaptionServer(args.caption_latency)
+    threading.Thread(target=caption_server.serve_forever, name="caption-server", daemon=True).start()
+    caption_client = CaptionClient("", url=caption_server.url, max_concurrency=args.caption_concurrency)
+    caption_cache = CaptionCache(os.path.join(data_dir, "captions.sqlite")) if args.caption_cache else None
+
+    jobs = job_registry.JobRegistry(os.path.join(data_dir, "jobs.sqlite"))
+    trace_path = os.path.join(data_dir, "trace.jsonl")
+    page_parser = StubPageParser(args.recognition_latency, args.line_latency, args.lines, args.image_regions, args.music_regions)
+
+    pipeline_log = sys.stdout if args.verbose else open(os.devnull, "w")
+    observer = Observer()
+
+    try:
+        with contextlib.redirect_stdout(pipeline_log):
+            handler = NewFileHandler(page_parser, paths["music"], paths["xmls"], paths["logits"], paths["errors"], jobs,
+                                     WorkQueue(), caption_client, caption_cache=caption_cache,
+                                     save_logits=not args.no_logits, claims_path=paths["claims"],
+                                     deferred_captions=args.deferred_captions, max_pixels=args.max_pixels,
+                                     tiles_path=None if args.no_tiles else paths["tiles"], trace_file=trace_path)
+
+            observer.schedule(handler, path=paths["images"], recursive=True)
+            observer.start()
+
+            if args.pipelined:
+                pipeline = StagedPipeline(handler, load_workers=args.load_workers,
+                                          recognition_workers=args.recognition_workers,
+                                          save_workers=args.save_workers, queue_size=args.stage_queue_size)
+                threading.Thread(target=pipeline.run, args=(3600,), name="pipeline", daemon=True).start()
+            else:
+                threading.Thread(target=handler.run, name="pipeline", daemon=True).start()
+
+            deadline = time.monotonic() + args.timeout
+
+            # the first pages are slow because of lazy initialization
+            warmup_ids = [upload(paths["images"], jobs, *images[i % len(images)]) for i in range(args.warmup)]
+            wait_for_results(jobs, warmup_ids, deadline)
+            wait_for_background_work(handler, warmup_ids, deadline)
+            caption_requests = caption_server.requests
+
+            request_ids = []
+            for i in range(args.pages):
+                request_ids.append(upload(paths["images"], jobs, *images[i % len(images)]))
+                if args.upload_interval > 0:
+                    time.sleep(args.upload_interval)
+
+            finished = wait_for_results(jobs, request_ids, deadline)
+            wait_for_background_work(handler, request_ids, deadline)
+
+        caption_requests = caption_server.requests - caption_requests
+        first_upload = min(job["created"] for job in finished.values())
+        last_result = max(job["finished"] for job in finished.values())
+        elapsed = last_result - first_upload
+        done = [job for job in finished.values() if job["state"] == job_registry.DONE]
+
+        results = {
+            "pages": args.pages,
+            "done": len(done),
+            "failed": args.pages - len(done),
+            "elapsed": elapsed,
+            "pages_per_second": args.pages / elapsed if elapsed > 0 else None,
+            "caption_requests": caption_requests,
+            "latency_ms": summarize([job["finished"] - job["created"] for job in done]),
+            "stages_ms": get_stage_times(load_traces(trace_path, request_ids))
+        }
+
+    finally:
+        observer.stop()
+        observer.join()
+        caption_server.shutdown()
+        if pipeline_log is not sys.stdout:
+            pipeline_log.close()
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f"{results['pages']} pages ({results['failed']} failed) in {results['elapsed']:.2f} s, "
+          f"{results['pages_per_second']:.2f} pages/s, {results['caption_requests']} caption requests")
+    print(f"{'':>18} {'count':>6} {'mean [ms]':>10} {'p50 [ms]':>10} {'p95 [ms]':>10} {'p99 [ms]':>10} {'max [ms]':>10}")
+    print_summary("upload to XML", results["latency_ms"])
+    for stage, summary in results["stages_ms"].items():
+        print_summary(stage, summary)
+
+    if args.output is not None:
+        output = {
+            "commit": get_commit(),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": vars(args),
+            "results": results
+        }
+
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,430 @@
+"""Reproducible HTTP benchmark of server.py on a synthetic corpus of results.
+
+The server is started with a temporary config whose data directories are filled with generated results (PAGE XML with
+text, image and music regions, confidences files stored next to the logits, music manifests and MIDI files, images and
+job registry entries). Throughput, latency percentiles and peak memory (RSS of the server and its worker processes)
+are measured for each endpoint and concurrency level. The OCR pipeline does not run, so no GPU, models or network
+access are needed. Results are saved as JSON, `--baseline` compares them with the results of another commit.
+
+Example:
+    python benchmarks/server_benchmark.py --concurrency 1 8 32 -o results/$(git rev-parse --short HEAD).json
+    python benchmarks/server_benchmark.py --workers 4 --baseline results/main.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+import requests
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_registry
+import request_storage
+from line_confidences import save_confidences
+from load_test import start_server, stop_server
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ("get_status", "get_lines", "get_image", "get_music", "upload_image")
+
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do", "eiusmod",
+         "tempor", "incididunt", "ut", "labore", "et", "dolore", "magna", "aliqua", "žluťoučký", "kůň", "úpěl",
+         "ďábelské", "ódy", "&", "<", "1848", "č.", "str.")
+
+PAGE_NAMESPACE = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15"
+
+# format 0 MIDI file with one track playing a single note
+MIDI_DATA = (b"MThd\x00\x00\x00\x06\x00\x00\x00\x01\x00\x60"
+             b"MTrk\x00\x00\x00\x0c\x00\x90\x3c\x40\x60\x80\x3c\x40\x00\xff\x2f\x00")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='Path of the JSON file with the results.')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with.')
+    parser.add_argument('--endpoints', help='Endpoints to measure.', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--concurrency', help='Numbers of concurrent clients to measure.', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', help='Number of measured requests of each endpoint and concurrency.', type=int, default=1000)
+    parser.add_argument('--warmup', help='Number of requests of each endpoint sent before the measurement.', type=int, default=50)
+    parser.add_argument('--workers', help='Number of server processes (gunicorn), 0 for the Flask development server.', type=int, default=0)
+    parser.add_argument('--threads', help='Number of threads of each server process.', type=int, default=8)
+    parser.add_argument('--port', help='Port of the benchmarked server.', type=int, default=8051)
+    parser.add_argument('--pages', help='Number of finished requests in the corpus.', type=int, default=50)
+    parser.add_argument('--queued', help='Number of queued requests in the corpus (used by get_status).', type=int, default=200)
+    parser.add_argument('--lines', help='Number of text lines of each page.', type=int, default=60)
+    parser.add_argument('--image-size', help='Width and height of the images.', type=int, nargs=2, default=[1600, 2200])
+    parser.add_argument('--lines-cache-size', help='Size of the /get_lines cache of the server, 0 measures parsing of each request.', type=int, default=256)
+    parser.add_argument('--seed', help='Seed of the generated corpus.', type=int, default=0)
+    parser.add_argument('--data-dir', help='Directory for the config and the corpus, kept after the benchmark (a temporary directory by default).')
+    args = parser.parse_args()
+    return args
+
+
+def write_config(data_dir, port, lines_cache_size):
+    path = os.path.join(data_dir, "config.ini")
+
+    with open(path, "w") as file:
+        file.write(f"""[common]
+host = 127.0.0.1
+port = {port}
+debug = False
+
+[requests]
+upload_path = images
+result_path = xmls
+logits_path = logits
+errors_path = errors
+music_path = music
+tiles_path = tiles
+jobs_path = jobs.sqlite
+lines_cache_size = {lines_cache_size}
+""")
+
+    return path
+
+
+def make_image(width, height, lines):
+    """JPEG with dark bars at the positions of the text lines."""
+    image = Image.new("RGB", (width, height), (250, 248, 240))
+    draw = ImageDraw.Draw(image)
+
+    for top, bottom in get_line_positions(height, lines):
+        draw.rectangle([width // 16, top, width - width // 16, bottom], fill=(40, 40, 40))
+
+    data = io.BytesIO()
+    image.save(data, format="JPEG", quality=85)
+    return data.getvalue()
+
+
+def get_line_positions(height, lines):
+    # text lines take the upper three quarters of the page, image and music regions the rest
+    line_height = height * 0.75 / max(lines, 1)
+    return [(round(i * line_height + line_height * 0.2), round((i + 1) * line_height - line_height * 0.2)) for i in range(lines)]
+
+
+def make_page_xml(page_id, width, height, lines, rng):
+    """PAGE XML in the format written by the OCR pipeline and the confidences of its text lines."""
+    left, right = width // 16, width - width // 16
+    line_confidences = []
+
+    text_lines = []
+    for i, (top, bottom) in enumerate(get_line_positions(height, lines)):
+        line_id = f"r000-l{i:03d}"
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        baseline = bottom - (bottom - top) // 5
+        custom = json.dumps({"heights": [float(baseline - top), float(bottom - baseline)], "category": "text"})
+        line_confidences.append((line_id, [rng.uniform(0.5, 1.0) for _ in text]))
+
+        text_lines.append(f"""      <TextLine id="{line_id}" index="{i}" custom={quoteattr(custom)}>
+        <Coords points="{left},{top} {right},{top} {right},{bottom} {left},{bottom}"/>
+        <Baseline points="{left},{baseline} {right},{baseline}"/>
+        <TextEquiv conf="{rng.uniform(0.5, 1.0):.3f}">
+          <Unicode>{escape(text)}</Unicode>
+        </TextEquiv>
+      </TextLine>
+""")
+
+    image_top, music_top = round(height * 0.78), round(height * 0.9)
+    xml = f"""<?xml version='1.0' encoding='utf-8'?>
+<PcGts xmlns="{PAGE_NAMESPACE}">
+  <Page imageFilename="{page_id}" imageWidth="{width}" imageHeight="{height}">
+    <TextRegion id="r000" custom='{{"category": "text"}}'>
+      <Coords points="{left},0 {right},0 {right},{round(height * 0.75)} {left},{round(height * 0.75)}"/>
+{"".join(text_lines)}    </TextRegion>
+    <TextRegion id="r001" custom='{{"category": "Obrázek"}}'>
+      <Coords points="{left},{image_top} {width // 2},{image_top} {width // 2},{music_top - 10} {left},{music_top - 10}"/>
+      <TextEquiv>
+        <Unicode>{escape(" ".join(rng.choice(WORDS) for _ in range(8)))}</Unicode>
+      </TextEquiv>
+    </TextRegion>
+    <TextRegion id="r002" custom='{{"category": "Notový zápis"}}'>
+      <Coords points="{left},{music_top} {right},{music_top} {right},{height - 10} {left},{height - 10}"/>
+    </TextRegion>
+  </Page>
+</PcGts>
+"""
+
+    return xml, line_confidences
+
+
+def create_corpus(data_dir, pages, queued, lines, image_size, seed):
+    """Creates results of `pages` finished requests and `queued` requests waiting for processing, returns their IDs."""
+    rng = random.Random(seed)
+    width, height = image_size
+    image = make_image(width, height, lines)
+    jobs = job_registry.JobRegistry(os.path.join(data_dir, "jobs.sqlite"))
+
+    page_ids = []
+    for _ in range(pages):
+        page_id = "%032x" % rng.getrandbits(128)
+        xml, line_confidences = make_page_xml(page_id, width, height, lines, rng)
+
+        write_file(os.path.join(data_dir, "images"), page_id, ".jpg", image)
+        write_file(os.path.join(data_dir, "xmls"), page_id, ".xml", xml.encode("utf-8"))
+        save_confidences(request_storage.make_shard_dirs(request_storage.get_file_path(os.path.join(data_dir, "logits"), page_id, ".conf")),
+                         [line_id for line_id, _ in line_confidences], [confidences for _, confidences in line_confidences])
+        write_file(os.path.join(data_dir, "music"), page_id, ".mid", MIDI_DATA)
+        write_file(os.path.join(data_dir, "music"), page_id, ".music.json",
+                   json.dumps({"status": "done", "page": True, "lines": []}).encode("utf-8"))
+
+        jobs.add(page_id, state=job_registry.DONE)
+        page_ids.append(page_id)
+
+    queued_ids = []
+    for _ in range(queued):
+        request_id = "%032x" % rng.getrandbits(128)
+        write_file(os.path.join(data_dir, "images"), request_id, ".jpg", image)
+        jobs.add(request_id)
+        queued_ids.append(request_id)
+
+    return page_ids, queued_ids, image
+
+
+def write_file(directory, request_id, suffix, data):
+    with open(request_storage.make_shard_dirs(request_storage.get_file_path(directory, request_id, suffix)), "wb") as file:
+        file.write(data)
+
+
+def remove_uploads(data_dir, request_ids):
+    """Removes requests created by the upload_image test, so each measurement starts with the same corpus."""
+    for request_id in request_ids:
+        for suffix in (".jpg", ".png"):
+            try:
+                os.remove(request_storage.get_file_path(os.path.join(data_dir, "images"), request_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    job_registry.JobRegistry(os.path.join(data_dir, "jobs.sqlite")).remove(request_ids)
+
+
+class MemoryMonitor:
+    """Samples the total RSS of a process and its descendants (Linux only), `peak` is None elsewhere."""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.peak = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="memory-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            return
+
+        while not self._stop.is_set():
+            rss = sum(get_rss(pid) for pid in get_process_tree(self.pid))
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+            self._stop.wait(self.interval)
+
+
+def get_process_tree(root_pid):
+    parents = {}
+
+    for entry in os.scandir("/proc"):
+        if entry.name.isdigit():
+            try:
+                with open(os.path.join(entry.path, "stat"), "r") as file:
+                    # the process name in parentheses may contain spaces
+                    parents[int(entry.name)] = int(file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+
+    tree = [root_pid]
+    for pid in tree:
+        tree.extend(child for child, parent in parents.items() if parent == pid)
+
+    return tree
+
+
+def get_rss(pid):
+    """Resident set size of the process in bytes, 0 if it does not exist anymore."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return 0
+
+
+def run_test(send_request, count, concurrency):
+    local = threading.local()
+
+    def timed_request(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = requests.Session()
+            local.session = session
+
+        start = time.perf_counter()
+        try:
+            status = send_request(session, i).status_code
+        except requests.RequestException:
+            status = None
+
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_request, range(count)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    statuses = Counter(str(status) for _, status in results)
+
+    return {
+        "requests": count,
+        "duration": elapsed,
+        "throughput": count / elapsed,
+        "errors": sum(1 for _, status in results if status is None or status >= 500),
+        "statuses": dict(statuses),
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())
+        }
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result, baseline=None):
+    latency = result["latency_ms"]
+    peak_rss = f"{result['peak_rss'] / 1024 ** 2:>9.1f}" if result["peak_rss"] is not None else f"{'-':>9}"
+    line = (f"{result['endpoint']:>13} {result['concurrency']:>5} {result['throughput']:>9.1f} {latency['p50']:>8.2f} "
+            f"{latency['p95']:>8.2f} {latency['p99']:>8.2f} {peak_rss} {result['errors']:>6}")
+
+    if baseline is not None:
+        throughput_change = (result["throughput"] / baseline["throughput"] - 1) * 100
+        p95_change = (latency["p95"] / baseline["latency_ms"]["p95"] - 1) * 100
+        line += f"   req/s {throughput_change:+6.1f} %, p95 {p95_change:+6.1f} %"
+
+    print(line)
+
+
+def main():
+    args = parse_arguments()
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = dict(((result["endpoint"], result["concurrency"]), result) for result in json.load(file)["results"])
+
+    data_dir = args.data_dir if args.data_dir is not None else tempfile.mkdtemp(prefix="pero-server-benchmark-")
+    os.makedirs(data_dir, exist_ok=True)
+
+    try:
+        config_path = write_config(data_dir, args.port, args.lines_cache_size)
+
+        print(f"Creating corpus of {args.pages} pages in {data_dir}")
+        page_ids, queued_ids, image = create_corpus(data_dir, args.pages, args.queued, args.lines, args.image_size, args.seed)
+        status_ids = page_ids + queued_ids
+
+        base_url = f"http://127.0.0.1:{args.port}"
+        process = start_server(config_path, args.workers, args.threads, base_url)
+        monitor = MemoryMonitor(process.pid)
+        results = []
+
+        try:
+            uploaded_ids = []
+            uploaded_ids_lock = threading.Lock()
+
+            def upload_image(session, i):
+                response = session.post(base_url + "/upload_image", data=image, headers={"Content-Type": "image/jpeg"})
+                if response.status_code == 200:
+                    with uploaded_ids_lock:
+                        uploaded_ids.append(response.json()["request_id"])
+                return response
+
+            requests_by_endpoint = {
+                "get_status": lambda session, i: session.get(f"{base_url}/get_status/{status_ids[i % len(status_ids)]}"),
+                "get_lines": lambda session, i: session.get(f"{base_url}/get_lines/{page_ids[i % len(page_ids)]}"),
+                "get_image": lambda session, i: session.get(f"{base_url}/get_image/{page_ids[i % len(page_ids)]}"),
+                "get_music": lambda session, i: session.get(f"{base_url}/get_music/{page_ids[i % len(page_ids)]}"),
+                "upload_image": upload_image
+            }
+
+            print(f"{'endpoint':>13} {'conc.':>5} {'req/s':>9} {'p50 [ms]':>8} {'p95 [ms]':>8} {'p99 [ms]':>8} "
+                  f"{'RSS [MB]':>9} {'errors':>6}")
+
+            for concurrency in args.concurrency:
+                for endpoint in args.endpoints:
+                    send_request = requests_by_endpoint[endpoint]
+                    if args.warmup > 0:
+                        run_test(send_request, args.warmup, concurrency)
+
+                    monitor.start()
+                    result = run_test(send_request, args.requests, concurrency)
+                    result = dict(endpoint=endpoint, concurrency=concurrency, peak_rss=monitor.stop(), **result)
+
+                    results.append(result)
+                    print_result(result, baseline.get((endpoint, concurrency)))
+
+                    if endpoint == "upload_image":
+                        remove_uploads(data_dir, uploaded_ids)
+                        uploaded_ids.clear()
+
+        finally:
+            stop_server(process)
+
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.output is not None:
+        output = {
+            "commit": get_commit(),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": vars(args),
+            "results": results
+        }
+
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""Client of the image captioning API (OpenAI compatible chat completions endpoint)."""
+
+import time
+import random
+import base64
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_URL = "https://api.openai.com/v1/chat/completions"
+DEFAULT_PROMPT = "Give me one short sentence describing the image."
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CaptionClient:
+    """Long-lived captioning client with a shared connection pool.
+
+    All calls go through one thread pool, so at most `max_concurrency` requests are in flight regardless of how
+    many threads ask for captions. Failed calls (connection errors, timeouts, 429 and 5xx responses) are retried
+    with exponential backoff; an empty caption is returned when all attempts fail.
+    """
+
+    def __init__(self, api_key, url=DEFAULT_URL, model="gpt-4o-mini", timeout=30.0, max_concurrency=4, retries=3,
+                 backoff=0.5, max_tokens=300):
+        self.api_key = api_key
+        self.url = url
+        self.model = model
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_tokens = max_tokens
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        })
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="caption")
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def caption_images(self, images):
+        return list(self._executor.map(self.caption_image, images))
+
+    def caption_image(self, image):
+        payload = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": DEFAULT_PROMPT
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{encode_image(image)}"
+                            }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": self.max_tokens
+        }
+
+        for attempt in range(self.retries + 1):
+            retry_after = None
+
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+
+                if response.status_code not in RETRY_STATUSES:
+                    self._count(failed=response.status_code != 200)
+                    return parse_caption(response)
+
+                retry_after = parse_retry_after(response)
+
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+
+            if attempt < self.retries:
+                delay = self.backoff * (2 ** attempt) * (1 + random.random())
+                time.sleep(max(delay, retry_after or 0))
+
+        self._count(failed=True)
+        return ""
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _count(self, failed):
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.failures += 1
+
+
+class CaptionCache:
+    """Persistent cache of captions keyed by a hash of the (resized) image crop.
+
+    Besides the exact SHA-256 key, a 64-bit difference hash (dHash) of each crop is stored. When `phash_distance`
+    is positive, a crop without an exact match reuses the caption of a cached crop whose dHash differs in at most
+    that many bits. The cache keeps at most `max_entries` captions and evicts the least recently used ones.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS captions (
+        key TEXT PRIMARY KEY,
+        phash INTEGER NOT NULL,
+        caption TEXT NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used);
+    """
+
+    def __init__(self, path, max_entries=10000, phash_distance=0):
+        self.path = path
+        self.max_entries = max_entries
+        self.phash_distance = phash_distance
+        self._local = threading.local()
+
+        self._connection().executescript(self.SCHEMA)
+
+    def get(self, image):
+        key = image_key(image)
+        connection = self._connection()
+
+        row = connection.execute("SELECT caption FROM captions WHERE key = ?", (key,)).fetchone()
+
+        if row is None and self.phash_distance > 0:
+            phash = image_phash(image)
+            best_distance = self.phash_distance + 1
+
+            for candidate_key, candidate_phash, caption in connection.execute("SELECT key, phash, caption FROM captions"):
+                distance = bin(phash ^ (candidate_phash & 0xFFFFFFFFFFFFFFFF)).count("1")
+                if distance < best_distance:
+                    key, row, best_distance = candidate_key, (caption,), distance
+
+        if row is None:
+            return None
+
+        connection.execute("UPDATE captions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, image, caption):
+        connection = self._connection()
+
+        # SQLite integers are signed 64-bit
+        phash = image_phash(image)
+        phash = phash - (1 << 64) if phash >= (1 << 63) else phash
+
+        connection.execute("INSERT OR REPLACE INTO captions (key, phash, caption, last_used) VALUES (?, ?, ?, ?)",
+                           (image_key(image), phash, caption, time.time()))
+        connection.execute("DELETE FROM captions WHERE key IN "
+                           "(SELECT key FROM captions ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+
+        return connection
+
+
+def image_key(image):
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha256(str(image.shape).encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def image_phash(image):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    image = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (image[:, 1:] > image[:, :-1]).flatten()
+
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def parse_caption(response):
+    try:
+        image_caption = response.json()["choices"][0]["message"]["content"]
+    except:
+        image_caption = ""
+
+    return image_caption
+
+
+def parse_retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_image(image):
+    image_jpg = cv2.imencode('.jpg', image)[1]
+    image_base64 = base64.b64encode(image_jpg).decode('utf-8')
+    return image_base64
+
+
+def create_caption_cache(configuration, path):
+    """Creates the cache from the optional [captioning] section of the server configuration, None if disabled."""
+    if int(configuration.get("cache_size", 10000)) <= 0:
+        return None
+
+    return CaptionCache(path,
+                        max_entries=int(configuration.get("cache_size", 10000)),
+                        phash_distance=int(configuration.get("phash_distance", 0)))
+
+
+def create_caption_client(configuration, api_key):
+    """Creates the client from the optional [captioning] section of the server configuration."""
+    return CaptionClient(api_key,
+                         url=configuration.get("url", DEFAULT_URL),
+                         model=configuration.get("model", "gpt-4o-mini"),
+                         timeout=float(configuration.get("timeout", 30)),
+                         max_concurrency=int(configuration.get("max_concurrency", 4)),
+                         retries=int(configuration.get("retries", 3)),
+                         backoff=float(configuration.get("backoff", 0.5)))
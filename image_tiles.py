@@ -0,0 +1,154 @@
+"""Tile pyramid of a page image for the Leaflet viewer, stored with a small preview in a single file.
+
+Zoom levels follow Leaflet's CRS.Simple: at zoom z one tile pixel covers 2^-z pixels of the original image, zoom 0
+is the original resolution and negative zooms are downscaled. The pyramid goes from `max_zoom` (the highest zoom not
+upscaling the processed image, 0 if it was not scaled down) to `min_zoom`, where the page fits in one tile. Edge
+tiles are padded to the full tile size. Layout of the file (little endian):
+
+    magic           8 bytes     b"PEROTILE"
+    version         uint32
+    tile size       uint32
+    width           uint32      size of the original image
+    height          uint32
+    min zoom        int32
+    max zoom        int32
+    tile count      uint32
+    offsets         uint64[tile count + 2]
+    JPEG images     tiles of the levels from max zoom to min zoom, each level row by row, then the preview
+"""
+
+import os
+import math
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b"PEROTILE"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIiiI")
+TILE_SIZE = 256
+PREVIEW_SIZE = 512
+JPEG_QUALITY = 85
+
+
+def get_zoom_range(width, height, image_width, tile_size=TILE_SIZE):
+    min_zoom = -max(math.ceil(math.log2(max(width, height) / tile_size)), 0)
+    max_zoom = min(math.floor(math.log2(image_width / width) + 1e-9), 0)
+    return min_zoom, max(max_zoom, min_zoom)
+
+
+def get_level_size(width, height, zoom):
+    return math.ceil(width * 2.0 ** zoom), math.ceil(height * 2.0 ** zoom)
+
+
+def get_level_tiles(width, height, zoom, tile_size=TILE_SIZE):
+    level_width, level_height = get_level_size(width, height, zoom)
+    return math.ceil(level_width / tile_size), math.ceil(level_height / tile_size)
+
+
+def save_tiles(path, image, page_size, tile_size=TILE_SIZE, preview_size=PREVIEW_SIZE, quality=JPEG_QUALITY):
+    """Saves the pyramid of the image, which may be scaled down from the original `page_size` (height, width)."""
+    import cv2
+
+    height, width = page_size
+    min_zoom, max_zoom = get_zoom_range(width, height, image.shape[1], tile_size)
+    parameters = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    blobs = []
+    level_image = image
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        # each level is made from the previous (twice as large) one
+        level_image = cv2.resize(level_image, get_level_size(width, height, zoom), interpolation=cv2.INTER_AREA)
+        columns, rows = get_level_tiles(width, height, zoom, tile_size)
+
+        for row in range(rows):
+            for column in range(columns):
+                tile = level_image[row * tile_size:(row + 1) * tile_size, column * tile_size:(column + 1) * tile_size]
+                tile = cv2.copyMakeBorder(tile, 0, tile_size - tile.shape[0], 0, tile_size - tile.shape[1],
+                                          cv2.BORDER_CONSTANT, value=(255, 255, 255))
+                blobs.append(cv2.imencode(".jpg", tile, parameters)[1].tobytes())
+
+    preview_scale = min(preview_size / max(image.shape[:2]), 1.0)
+    preview_image_size = (max(round(image.shape[1] * preview_scale), 1), max(round(image.shape[0] * preview_scale), 1))
+    preview = cv2.resize(image, preview_image_size, interpolation=cv2.INTER_AREA)
+    blobs.append(cv2.imencode(".jpg", preview, parameters)[1].tobytes())
+
+    offsets = np.zeros(len(blobs) + 1, dtype="<u8")
+    offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, tile_size, width, height, min_zoom, max_zoom, len(blobs) - 1))
+        file.write(offsets.tobytes())
+        for blob in blobs:
+            file.write(blob)
+
+    os.replace(tmp_path, path)
+
+
+class TilesFile:
+    """Memory mapped tiles file. Use as a context manager."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.tile_size, self.width, self.height, self.min_zoom, self.max_zoom, tile_count = \
+            HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"Unsupported tiles file: {path}")
+
+        self._offsets = np.frombuffer(self._buffer, dtype="<u8", count=tile_count + 2, offset=HEADER.size)
+        self._data_offset = HEADER.size + self._offsets.nbytes
+
+        # index of the first tile of each level
+        self._level_offsets = {}
+        index = 0
+        for zoom in range(self.max_zoom, self.min_zoom - 1, -1):
+            self._level_offsets[zoom] = index
+            columns, rows = get_level_tiles(self.width, self.height, zoom, self.tile_size)
+            index += columns * rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def info(self):
+        return {
+            "tile_size": self.tile_size,
+            "min_zoom": self.min_zoom,
+            "max_zoom": self.max_zoom
+        }
+
+    def get_tile(self, zoom, x, y):
+        """JPEG image of the tile, None for tiles outside of the pyramid."""
+        if zoom not in self._level_offsets:
+            return None
+
+        columns, rows = get_level_tiles(self.width, self.height, zoom, self.tile_size)
+        if not (0 <= x < columns and 0 <= y < rows):
+            return None
+
+        return self._get_blob(self._level_offsets[zoom] + y * columns + x)
+
+    def get_preview(self):
+        return self._get_blob(len(self._offsets) - 2)
+
+    def close(self):
+        self._offsets = None
+
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _get_blob(self, index):
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return bytes(self._buffer[self._data_offset + start:self._data_offset + end])
@@ -0,0 +1,257 @@
+"""Job state registry shared by the server and the OCR pipeline.
+
+Jobs are stored in a SQLite database in WAL mode, so the server can read job states while the pipeline updates them.
+"""
+
+import time
+import sqlite3
+import threading
+
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# jobs processing for more than this multiple of the average duration are not counted as running in the estimates
+STALE_PROCESSING_FACTOR = 10
+
+# priority classes of uploads in the order they are processed, stored in the database by their index
+PRIORITIES = (INTERACTIVE, BULK)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    request_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    image_hash TEXT,
+    alias_of TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state_created ON jobs (state, created);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+"""
+
+# columns added after the first version of the schema, databases created before get them by ALTER TABLE
+ADDED_COLUMNS = {
+    "image_hash": "TEXT",
+    "alias_of": "TEXT",
+    "priority": "INTEGER",
+    "client": "TEXT"
+}
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_image_hash ON jobs (image_hash);
+CREATE INDEX IF NOT EXISTS jobs_client_state ON jobs (client, state);
+"""
+
+
+class JobRegistry:
+    def __init__(self, path, duration_window=50):
+        self.path = path
+        self.duration_window = duration_window
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+
+        columns = set(row[1] for row in connection.execute("PRAGMA table_info(jobs)"))
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in columns:
+                connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+
+        connection.executescript(INDEXES)
+
+    def add(self, request_id, state=QUEUED, priority=INTERACTIVE, client=None):
+        now = time.time()
+        finished = now if state in {DONE, FAILED} else None
+        self._connection().execute("INSERT OR REPLACE INTO jobs (request_id, state, created, finished, priority, client) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)",
+                                   (request_id, state, now, finished, PRIORITIES.index(priority), client))
+
+    def start(self, request_id):
+        now = time.time()
+        self._connection().execute("INSERT INTO jobs (request_id, state, created, started) VALUES (?, ?, ?, ?) "
+                                   "ON CONFLICT (request_id) DO UPDATE SET state = excluded.state, started = excluded.started",
+                                   (request_id, PROCESSING, now, now))
+
+    def finish(self, request_id):
+        self._set_finished(request_id, DONE)
+
+    def fail(self, request_id):
+        self._set_finished(request_id, FAILED)
+
+    def add_alias(self, request_id, alias_of, image_hash):
+        """Registers a finished job whose results are the results of the `alias_of` job (an identical image)."""
+        now = time.time()
+        self._connection().execute("INSERT OR REPLACE INTO jobs (request_id, state, created, started, finished, image_hash, alias_of) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (request_id, DONE, now, now, now, image_hash, alias_of))
+
+    def set_image_hash(self, request_id, image_hash):
+        self._connection().execute("UPDATE jobs SET image_hash = ? WHERE request_id = ?", (image_hash, request_id))
+
+    def find_image(self, image_hash):
+        """Returns the ID of a finished job with results of the image with the hash, or None."""
+        row = self._connection().execute("SELECT COALESCE(alias_of, request_id) FROM jobs WHERE image_hash = ? AND state = ? "
+                                         "ORDER BY finished DESC LIMIT 1", (image_hash, DONE)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_alias(self, request_id):
+        row = self._connection().execute("SELECT alias_of FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_deduplication_stats(self):
+        """Number of uploads with a known image hash and how many of them reused results of an identical image."""
+        row = self._connection().execute("SELECT COUNT(*), COUNT(alias_of) FROM jobs WHERE image_hash IS NOT NULL").fetchone()
+        uploads, hits = row
+
+        return {
+            "uploads": uploads,
+            "hits": hits,
+            "hit_rate": hits / uploads if uploads > 0 else 0.0
+        }
+
+    def remove(self, request_ids, chunk_size=500):
+        """Removes the jobs and their aliases, e.g. when their files are removed by retention."""
+        connection = self._connection()
+
+        for i in range(0, len(request_ids), chunk_size):
+            chunk = request_ids[i:i + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            connection.execute(f"DELETE FROM jobs WHERE request_id IN ({placeholders}) OR alias_of IN ({placeholders})",
+                               chunk + chunk)
+
+    def get(self, request_id):
+        row = self._connection().execute("SELECT request_id, state, created, started, finished, "
+                                         "COALESCE(priority, 0) AS priority FROM jobs WHERE request_id = ?",
+                                         (request_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        job = dict(row)
+        job["priority"] = PRIORITIES[job["priority"]]
+        return job
+
+    def get_priority(self, request_id):
+        """Priority class of the job, jobs registered before priorities were introduced are interactive."""
+        row = self._connection().execute("SELECT priority FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+        return PRIORITIES[row[0]] if row is not None and row[0] is not None else INTERACTIVE
+
+    def get_status(self, request_id):
+        """Returns the job with its queue position, estimated start time (a timestamp) and estimated time to finish (in
+        seconds), or None."""
+        job = self.get(request_id)
+
+        if job is None or job["state"] not in {QUEUED, PROCESSING}:
+            return job
+
+        duration = self.get_average_duration()
+
+        if job["state"] == QUEUED:
+            job["queue_position"] = self.get_queue_position(job["priority"], job["created"])
+            wait_time = self.estimate_wait_time(job["queue_position"], duration)
+            job["estimated_start"] = None if wait_time is None else time.time() + wait_time
+            job["eta"] = None if wait_time is None else wait_time + duration
+        else:
+            job["queue_position"] = 0
+            job["estimated_start"] = job["started"]
+            job["eta"] = None if duration is None else max(duration - (time.time() - job["started"]), 0.0)
+
+        return job
+
+    def get_queue_position(self, priority, created=None):
+        """Number of queued jobs processed before a job of the priority created at `created` (a new job if None)."""
+        rank = PRIORITIES.index(priority)
+        created = created if created is not None else time.time()
+        row = self._connection().execute("SELECT COUNT(*) FROM jobs WHERE state = ? AND "
+                                         "(COALESCE(priority, 0) < ? OR (COALESCE(priority, 0) = ? AND created < ?))",
+                                         (QUEUED, rank, rank, created)).fetchone()
+        return row[0]
+
+    def estimate_wait_time(self, queue_position, duration=None):
+        """Estimated time in seconds until a job with `queue_position` jobs ahead of it starts, None without history.
+
+        Jobs are processing from the start of their recognition until their results are saved, the same period as their
+        duration, so the number of processing jobs divided by the duration is the throughput of the pipeline (including
+        pages recognized in one batch or saved while the next page is recognized) while any job is queued."""
+        if duration is None:
+            duration = self.get_average_duration()
+
+        if duration is None:
+            return None
+
+        # jobs processed for much longer than usual were left by a stopped pipeline worker
+        started_after = time.time() - STALE_PROCESSING_FACTOR * duration
+        row = self._connection().execute("SELECT COUNT(*) FROM jobs WHERE state = ? AND started >= ?",
+                                         (PROCESSING, started_after)).fetchone()
+        workers = max(row[0], 1)
+        return queue_position * duration / workers
+
+    def get_queued(self, created_before):
+        """IDs of the jobs queued since before `created_before`."""
+        rows = self._connection().execute("SELECT request_id FROM jobs WHERE state = ? AND created < ?",
+                                          (QUEUED, created_before)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_client_jobs(self, client):
+        """Number of queued and processing jobs of the client."""
+        row = self._connection().execute("SELECT COUNT(*) FROM jobs WHERE client = ? AND state IN (?, ?)",
+                                         (client, QUEUED, PROCESSING)).fetchone()
+        return row[0]
+
+    def get_average_duration(self):
+        # aliases of identical images were not processed, their zero durations would make the estimates too low
+        row = self._connection().execute("SELECT AVG(finished - started) FROM "
+                                         "(SELECT finished, started FROM jobs WHERE state = ? AND started IS NOT NULL AND alias_of IS NULL "
+                                         "ORDER BY finished DESC LIMIT ?)",
+                                         (DONE, self.duration_window)).fetchone()
+        return row[0]
+
+    def get_count(self, state):
+        row = self._connection().execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)).fetchone()
+        return row[0]
+
+    def get_counts(self):
+        rows = self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict((row[0], row[1]) for row in rows)
+
+    def get_history(self, period, bucket_size):
+        """Number of finished jobs (without aliases of identical images) and their average waiting and processing times
+        in buckets of the last period."""
+        since = time.time() - period
+        rows = self._connection().execute("SELECT CAST(finished / ? AS INTEGER) * ? AS bucket, state, COUNT(*), "
+                                          "AVG(started - created), AVG(finished - started) FROM jobs "
+                                          "WHERE finished >= ? AND alias_of IS NULL GROUP BY bucket, state ORDER BY bucket",
+                                          (bucket_size, bucket_size, since)).fetchall()
+
+        return [{
+            "time": row[0],
+            "state": row[1],
+            "count": row[2],
+            "wait_time": row[3],
+            "processing_time": row[4]
+        } for row in rows]
+
+    def _set_finished(self, request_id, state):
+        now = time.time()
+        self._connection().execute("INSERT INTO jobs (request_id, state, created, finished) VALUES (?, ?, ?, ?) "
+                                   "ON CONFLICT (request_id) DO UPDATE SET state = excluded.state, finished = excluded.finished",
+                                   (request_id, state, now, now))
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+
+        return connection
@@ -3,7 +3,7 @@
 class TextLine
 {
     constructor(id, annotated, text, confidences, ligatures_mapping, arabic, for_training, debug_line_container,
-                debug_line_container_2, category, page_id)
+                debug_line_container_2, category, page_id, has_music = true)
     {
         this.id = id;
         this.text = text;
@@ -25,13 +25,9 @@ class TextLine
         this.container.style.display = "block";
         this.container.style.lineHeight = "220%";
 
-        if (this.category == "music")
+        if (this.category == "music" && has_music)
         {
-            var midi_player = document.createElement("midi-player");
-            midi_player.setAttribute("src", "/get_music/" + this.page_id + "/" + this.id + "-l000");
-            midi_player.setAttribute("sound-font", "");
-
-            this.container.appendChild(midi_player)
+            this.add_midi_player();
         }
 
         if(confidences.length > 0){
@@ -113,6 +109,34 @@ class TextLine
         });
     }
 
+    get_music_line_id()
+    {
+        return this.id + "-l000";
+    }
+
+    add_midi_player()
+    {
+        var midi_player = document.createElement("midi-player");
+        midi_player.setAttribute("src", "/get_music/" + this.page_id + "/" + this.get_music_line_id());
+        midi_player.setAttribute("sound-font", "");
+
+        this.container.insertBefore(midi_player, this.container.firstChild);
+    }
+
+    update_text(text, confidences, ligatures_mapping)
+    {
+        while (this.container.firstChild)
+        {
+            this.container.firstChild.remove();
+        }
+
+        this.confidences = confidences;
+        this.ligatures_mapping = ligatures_mapping;
+        this.set_line_confidences_to_text_line_element(text, confidences);
+        this.text = this.get_text_content();
+        this.mutate();
+    }
+
     clear_confidence_colors()
     {
         let descendants = this.container.getElementsByTagName('*');
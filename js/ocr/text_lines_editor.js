@@ -228,7 +228,25 @@ class TextLinesEditor
         let bounds = [xy(0, -this.height), xy(this.width, 0)];
         //this.map.setView(xy(this.width / 2, -this.height / 2), -2);
         this.map.fitBounds(bounds);
-        L.imageOverlay("/get_image/" + image_id, bounds).addTo(this.map);
+        if (data['tiles'])
+        {
+            // a small preview is shown right away, tiles load the detail of the visible part at the current zoom
+            let tiles = data['tiles'];
+            L.imageOverlay("/get_preview/" + image_id, bounds).addTo(this.map);
+            L.tileLayer("/get_tile/" + image_id + "/{z}/{x}/{y}", {
+                tileSize: tiles['tile_size'],
+                minNativeZoom: tiles['min_zoom'],
+                maxNativeZoom: tiles['max_zoom'],
+                minZoom: this.map.getMinZoom(),
+                maxZoom: this.map.getMaxZoom(),
+                bounds: bounds,
+                noWrap: true
+            }).addTo(this.map);
+        }
+        else
+        {
+            L.imageOverlay("/get_image/" + image_id, bounds).addTo(this.map);
+        }
 
         let self = this;
         let observer = new MutationObserver(function(mutations){
@@ -241,12 +259,18 @@ class TextLinesEditor
         let debug_line_container = document.getElementById('debug-line-container');
         let debug_line_container_2 = document.getElementById('debug-line-container-2');
         let focused = false;
+        // without the music manifest (older results) every music line gets a player
+        let music = data['music'];
+        let music_lines = new Set(music && music['status'] == "done" ? music['lines'] : []);
+
         for (let l of data['lines'])
         {
+            let has_music = !music || music_lines.has(l.id + "-l000");
             let line = new TextLine(l.id, l.annotated, l.text, l.np_confidences, l.ligatures_mapping, l.arabic, l.for_training,
-                                    debug_line_container, debug_line_container_2, l.category, image_id)
+                                    debug_line_container, debug_line_container_2, l.category, image_id, has_music)
             line.np_points = l.np_points;
             line.np_heights = l.np_heights;
+            line.caption_pending = l.caption_pending == true;
             line.focus = false;
             this.add_line_to_map(i, line);
             this.lines.push(line);
@@ -273,6 +297,82 @@ class TextLinesEditor
         else{
             this.map_element.focus();
         }
+
+        if (data['pending_captions'] && data['pending_captions'].length > 0){
+            this.schedule_captions_refresh(image_id);
+        }
+
+        if (music && music['status'] == "pending"){
+            this.schedule_music_refresh(image_id);
+        }
+    }
+
+    schedule_music_refresh(image_id)
+    {
+        clearTimeout(this.music_refresh);
+        this.music_refresh = setTimeout(this.refresh_music.bind(this, image_id), 3000);
+    }
+
+    async refresh_music(image_id)
+    {
+        // music is exported after the result is published, players are added to the lines when their MIDI is ready
+        if (this.image_id != image_id){
+            return;
+        }
+
+        let response = await fetch("/get_music_status/" + image_id);
+        if (response.status != 200 || this.image_id != image_id){
+            return;
+        }
+
+        let music = await response.json();
+        if (music['status'] == "pending"){
+            this.schedule_music_refresh(image_id);
+            return;
+        }
+
+        let music_lines = new Set(music['lines'] || []);
+        for (let line of this.lines)
+        {
+            if (line.category == "music" && music_lines.has(line.get_music_line_id())){
+                line.add_midi_player();
+            }
+        }
+    }
+
+    schedule_captions_refresh(image_id)
+    {
+        clearTimeout(this.captions_refresh);
+        this.captions_refresh = setTimeout(this.refresh_pending_captions.bind(this, image_id), 3000);
+    }
+
+    async refresh_pending_captions(image_id)
+    {
+        // captions of image regions are generated after the result is published, only these lines are updated
+        if (this.image_id != image_id){
+            return;
+        }
+
+        let response = await fetch("/get_lines/" + image_id);
+        let data = await response.json();
+
+        if (this.image_id != image_id){
+            return;
+        }
+
+        let pending_captions = new Set(data['pending_captions'] || []);
+        for (let l of data['lines'])
+        {
+            let line = this.lines.find(x => x.id == l.id);
+            if (line && line.caption_pending && !pending_captions.has(l.id) && !line.edited){
+                line.update_text(l.text, l.np_confidences, l.ligatures_mapping);
+                line.caption_pending = false;
+            }
+        }
+
+        if (pending_captions.size > 0){
+            this.schedule_captions_refresh(image_id);
+        }
     }
 
     add_line_to_map(i, line)
@@ -0,0 +1,209 @@
+"""Per-character line confidences and their compact on-disk format.
+
+The confidences file stores confidences of all lines of a page as a single float16 array with a per-line offset
+index, so the server does not need to load full logits. Layout (little endian):
+
+    magic           8 bytes     b"PEROCONF"
+    version         uint32
+    line count      uint32
+    IDs size        uint64      size of the newline separated UTF-8 line IDs
+    line IDs        IDs size bytes, zero padded to a multiple of 8
+    offsets         uint64[line count + 1]
+    confidences     float16[offsets[-1]]
+"""
+
+import os
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b"PEROCONF"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+ALIGNMENT = 8
+
+
+def calculate_line_confidence(line):
+    from pero_ocr.core.confidence_estimation import get_line_confidence
+
+    if line.transcription is not None and line.transcription != "":
+        char_map = dict([(c, i) for i, c in enumerate(line.characters)])
+        c_idx = np.asarray([char_map[c] for c in line.transcription])
+
+        try:
+            confidences = get_line_confidence(line, c_idx)
+
+        except ValueError:
+            confidences = np.ones(len(line.transcription))
+
+    else:
+        confidences = np.array([])
+
+    confidences = [float(confidence) for confidence in confidences]
+
+    return confidences
+
+
+def calculate_lines_confidences(lines):
+    """Same result as calculate_line_confidence for each line, with label lookup done at once for all lines."""
+    from pero_ocr.core.confidence_estimation import get_line_confidence
+
+    transcriptions = [line.transcription if line.transcription is not None else "" for line in lines]
+    labels = get_labels(lines, transcriptions)
+
+    lines_confidences = []
+    for line, transcription, line_labels in zip(lines, transcriptions, labels):
+        if transcription != "":
+            try:
+                confidences = get_line_confidence(line, line_labels)
+
+            except ValueError:
+                confidences = np.ones(len(transcription))
+
+            lines_confidences.append(np.asarray(confidences, dtype=np.float64).tolist())
+
+        else:
+            lines_confidences.append([])
+
+    return lines_confidences
+
+
+def get_labels(lines, transcriptions):
+    codes = np.frombuffer("".join(transcriptions).encode("utf-32-le"), dtype="<u4")
+    offsets = np.cumsum([0] + [len(transcription) for transcription in transcriptions]).tolist()
+
+    if len(codes) == 0:
+        return [np.array([], dtype=np.int64) for _ in lines]
+
+    characters = [line.characters for line, transcription in zip(lines, transcriptions) if transcription != ""]
+    if all(line_characters is characters[0] for line_characters in characters):
+        labels = lookup_labels(codes, build_characters_table(characters[0]))
+        return [labels[offsets[i]:offsets[i + 1]] for i in range(len(lines))]
+
+    tables = {}
+    result = []
+    for i, (line, transcription) in enumerate(zip(lines, transcriptions)):
+        if transcription == "":
+            result.append(np.array([], dtype=np.int64))
+            continue
+
+        table = tables.get(id(line.characters))
+        if table is None:
+            table = build_characters_table(line.characters)
+            tables[id(line.characters)] = table
+
+        result.append(lookup_labels(codes[offsets[i]:offsets[i + 1]], table))
+
+    return result
+
+
+def build_characters_table(characters):
+    # the last occurrence of a character wins, the same as in the char_map of calculate_line_confidence
+    char_map = dict([(c, i) for i, c in enumerate(characters) if len(c) == 1])
+    char_codes = np.fromiter((ord(c) for c in char_map), dtype=np.int64, count=len(char_map))
+    char_indices = np.fromiter(char_map.values(), dtype=np.int64, count=len(char_map))
+
+    order = np.argsort(char_codes)
+    return char_codes[order], char_indices[order]
+
+
+def lookup_labels(codes, table):
+    char_codes, char_indices = table
+    positions = np.searchsorted(char_codes, codes)
+    positions = np.minimum(positions, len(char_codes) - 1)
+
+    missing = char_codes[positions] != codes
+    if np.any(missing):
+        raise KeyError(chr(int(codes[np.argmax(missing)])))
+
+    return char_indices[positions]
+
+
+def save_confidences(path, line_ids, line_confidences):
+    encoded_ids = "\n".join(line_ids).encode("utf-8")
+    padding = b"\0" * (-len(encoded_ids) % ALIGNMENT)
+
+    offsets = np.zeros(len(line_ids) + 1, dtype="<u8")
+    offsets[1:] = np.cumsum([len(confidences) for confidences in line_confidences])
+
+    if len(line_confidences) > 0:
+        confidences = np.concatenate([np.asarray(confidences, dtype="<f2") for confidences in line_confidences])
+    else:
+        confidences = np.array([], dtype="<f2")
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(line_ids), len(encoded_ids)))
+        file.write(encoded_ids)
+        file.write(padding)
+        file.write(offsets.tobytes())
+        file.write(confidences.astype("<f2").tobytes())
+
+    os.replace(tmp_path, path)
+
+
+class ConfidencesFile:
+    """Memory mapped confidences file. Use as a context manager; values returned by `get` stay valid after close."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, line_count, ids_size = HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"Unsupported confidences file: {path}")
+
+        ids_offset = HEADER.size
+        ids = bytes(self._buffer[ids_offset:ids_offset + ids_size]).decode("utf-8")
+        self._line_index = dict((line_id, i) for i, line_id in enumerate(ids.split("\n"))) if line_count > 0 else {}
+
+        offsets_offset = ids_offset + ids_size + (-ids_size % ALIGNMENT)
+        self._offsets = np.frombuffer(self._buffer, dtype="<u8", count=line_count + 1, offset=offsets_offset)
+
+        confidences_offset = offsets_offset + self._offsets.nbytes
+        self._confidences = np.frombuffer(self._buffer, dtype="<f2", count=int(self._offsets[-1]),
+                                          offset=confidences_offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._line_index)
+
+    def get(self, line_id, default=None):
+        index = self._line_index.get(line_id)
+
+        if index is None:
+            return default
+
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return self._confidences[start:end].astype(np.float64).tolist()
+
+    def get_batch(self, line_ids, default=None):
+        """Same as calling `get` for each line ID, but all confidences are converted in one pass."""
+        confidences = self._confidences.astype(np.float64).tolist()
+        offsets = self._offsets.tolist()
+
+        result = []
+        for line_id in line_ids:
+            index = self._line_index.get(line_id)
+            result.append(default if index is None else confidences[offsets[index]:offsets[index + 1]])
+
+        return result
+
+    def close(self):
+        self._offsets = None
+        self._confidences = None
+
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,329 @@
+"""Counters, gauges and histograms of the server and the OCR pipeline, rendered in the Prometheus text format.
+
+Each process keeps its metrics in a MetricsRegistry. The server and the pipeline workers run in separate processes, so
+each of them periodically writes a JSON snapshot of its registry to the metrics directory (SnapshotWriter) and the
+server's /metrics endpoint renders all of them together, distinguished by the `process` label.
+"""
+
+import os
+import json
+import math
+import time
+import threading
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+# upper bounds of histogram buckets in seconds, from fast HTTP requests to OCR of large pages
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+SNAPSHOT_EXTENSION = ".json"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} has labels {self.label_names}, got {tuple(labels)}")
+
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get_labels(self, key):
+        return dict(zip(self.label_names, key))
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "type": self.type,
+            "help": self.documentation,
+            "samples": self.samples()
+        }
+
+    def samples(self):
+        """List of [name, labels, value] of the current values."""
+        with self._lock:
+            return [[self.name, self.get_labels(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Sets the value of a counter maintained elsewhere (e.g. hits of a cache)."""
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            # counts of the buckets (not cumulative, the last one is +Inf), sum and count of the observed values
+            values = self._values.get(key)
+            if values is None:
+                values = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = values
+
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the time spent in the with block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        samples = []
+
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = self.get_labels(key)
+
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    samples.append([f"{self.name}_bucket", dict(labels, le=format_value(bound)), cumulative])
+
+                samples.append([f"{self.name}_sum", labels, total])
+                samples.append([f"{self.name}_count", labels, count])
+
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def register(self, metric):
+        """Adds the metric, returns the metric registered before under the same name, if any."""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def snapshot(self, labels=None):
+        """JSON serializable list of the metric families, `labels` are added to all samples."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        families = [metric.snapshot() for metric in metrics]
+
+        if labels:
+            for family in families:
+                for sample in family["samples"]:
+                    sample[1] = dict(labels, **sample[1])
+
+        return families
+
+    def render(self):
+        return render(self.snapshot())
+
+
+class SnapshotWriter:
+    """Periodically writes the snapshot of the registry to a file, calling `collect` (which updates gauges) before."""
+
+    def __init__(self, registry, path, labels=None, interval=15, collect=None):
+        self.registry = registry
+        self.path = path
+        self.labels = labels
+        self.interval = interval
+        self.collect = collect
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            try:
+                self.write()
+            except:
+                log("Exception raised during writing metrics:")
+                log(traceback.format_exc())
+
+            time.sleep(self.interval)
+
+    def write(self):
+        if self.collect is not None:
+            self.collect()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(self.registry.snapshot(self.labels), file)
+
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Trace:
+    """Durations of the stages of processing one item, e.g. one page in the OCR pipeline."""
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self.stages = OrderedDict()
+        self.started = time.time()
+
+        self._start = time.monotonic()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - start
+
+    def finish(self, **fields):
+        """Returns the trace record with the total duration and the stage durations."""
+        record = dict(self.fields, **fields)
+        record["started"] = self.started
+        record["duration"] = time.monotonic() - self._start
+        record["stages"] = dict(self.stages)
+        return record
+
+
+class TraceWriter:
+    """Appends trace records to a JSON lines file, which may be shared by several processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = (json.dumps(record) + "\n").encode("utf-8")
+
+        # each record is written by a single write to a file opened for appending, so records of processes do not mix
+        with self._lock:
+            descriptor = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(descriptor, line)
+            finally:
+                os.close(descriptor)
+
+
+def load_snapshots(directory, max_age, exclude=None):
+    """Metric families of the snapshot files in the directory, files not updated for `max_age` seconds (of stopped
+    processes) are skipped, as well as the `exclude` path."""
+    families = []
+    now = time.time()
+
+    if not os.path.isdir(directory):
+        return families
+
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if not entry.name.endswith(SNAPSHOT_EXTENSION) or entry.path == exclude:
+            continue
+
+        try:
+            if now - entry.stat().st_mtime > max_age:
+                continue
+
+            with open(entry.path, "r") as file:
+                families.extend(json.load(file))
+
+        except (OSError, ValueError):
+            # the file was removed or replaced in the meantime
+            continue
+
+    return families
+
+
+def render(families):
+    """Renders metric families in the Prometheus text format, samples of families with the same name are merged."""
+    merged = OrderedDict()
+    for family in families:
+        if family["name"] in merged:
+            merged[family["name"]]["samples"].extend(family["samples"])
+        else:
+            merged[family["name"]] = dict(family, samples=list(family["samples"]))
+
+    lines = []
+    for name, family in merged.items():
+        lines.append(f"# HELP {name} {escape_help(family['help'])}")
+        lines.append(f"# TYPE {name} {family['type']}")
+
+        for sample_name, labels, value in family["samples"]:
+            lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def log(message, log_source="METRICS"):
+    print(f"[{log_source}|{datetime.utcnow()}] {message}")
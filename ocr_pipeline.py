@@ -3,99 +3,870 @@ import cv2
 import sys
 import time
 import torch
-import base64
 import argparse
-import requests
 import traceback
 import numpy as np
 import configparser
+import PIL.Image
+import queue
+import socket
+import threading
 import faulthandler
+import json
 import config_helper
-from functools import partial
+import job_registry
+import metrics
+import request_storage
+from captioning import create_caption_cache, create_caption_client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from image_tiles import save_tiles
+from line_confidences import calculate_line_confidence, save_confidences
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime
-from multiprocessing import Pool
+from multiprocessing import get_context
 
 from pero_ocr.core.layout import PageLayout
 from pero_ocr.document_ocr.page_parser import PageParser
 from pero_ocr.music.music_exporter import MusicPageExporter
 
 
+MUSIC_CATEGORY = "Notový zápis"
+
+# manifest of pages without music regions, written right away instead of running the export
+NO_MUSIC_MANIFEST = {"status": "done", "page": False, "lines": []}
+
+
+class WorkQueue:
+    """Queue of images waiting for processing. Images of a higher priority class (interactive uploads) are processed
+    before all images of lower ones (bulk uploads), images of the same class in FIFO order. Images already waiting in
+    the queue are not added twice."""
+
+    def __init__(self):
+        self.processed = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+        self._items = dict((priority, deque()) for priority in job_registry.PRIORITIES)
+        self._queued = set()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queued)
+
+    def put(self, file_id, image_path, created=None, priority=job_registry.INTERACTIVE):
+        with self._condition:
+            if file_id in self._queued:
+                return False
+
+            self._queued.add(file_id)
+            self._items[priority].append((file_id, image_path, created if created is not None else time.time()))
+            self._condition.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Returns (file_id, image_path, wait_time) of the oldest image of the highest priority, or None if the queue
+        stays empty."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self._queued) > 0, timeout=timeout):
+                return None
+
+            items = next(items for items in self._items.values() if len(items) > 0)
+            file_id, image_path, created = items.popleft()
+            self._queued.discard(file_id)
+
+            wait_time = max(time.time() - created, 0.0)
+            self.processed += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+            return file_id, image_path, wait_time
+
+    def stats(self):
+        with self._condition:
+            return {
+                "length": len(self._queued),
+                "lengths": dict((priority, len(items)) for priority, items in self._items.items()),
+                "processed": self.processed,
+                "average_wait_time": self.total_wait_time / self.processed if self.processed > 0 else 0.0,
+                "max_wait_time": self.max_wait_time
+            }
+
+
+class PageTask:
+    def __init__(self, file_id, image_path, image, page_layout, page_size=None, trace=None):
+        self.file_id = file_id
+        self.image_path = image_path
+        self.image = image
+        self.page_layout = page_layout
+        # (height, width) of the original image, when the image was scaled down for processing
+        self.page_size = page_size
+        self.trace = trace
+
+
+class PipelineStage:
+    """Group of threads running one step of the processing, with statistics of the time spent working."""
+
+    def __init__(self, name, function, workers):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processed = 0
+        self.busy_time = 0.0
+
+        self._started = None
+        self._lock = threading.Lock()
+
+    def start(self, worker):
+        self._started = time.monotonic()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=worker, args=(self,), name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+
+    def run(self, *args):
+        start = time.monotonic()
+        try:
+            return self.function(*args)
+        finally:
+            with self._lock:
+                self.processed += 1
+                self.busy_time += time.monotonic() - start
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+            return {
+                "workers": self.workers,
+                "processed": self.processed,
+                "busy_time": self.busy_time,
+                "utilization": self.busy_time / (elapsed * self.workers) if elapsed > 0 else 0.0
+            }
+
+
+class StagedPipeline:
+    """Loads, recognizes and saves different pages at the same time.
+
+    The stages are connected by bounded queues, so the next page is decoded and the previous one saved while
+    the current page is being recognized, and a slow stage holds back the stages before it.
+    """
+
+    def __init__(self, handler, load_workers=1, recognition_workers=1, save_workers=1, queue_size=2, batching=None):
+        if batching is None and recognition_workers > 1:
+            # the OCR engines are called by one thread at a time, the rest of the parser is serialized by its lock
+            batching = DynamicBatching(handler.page_parser, max_delay=0.0, parser_lock=handler.parser_lock)
+
+        self.handler = handler
+        self.batching = batching
+        self.recognition_queue = queue.Queue(maxsize=queue_size)
+        self.save_queue = queue.Queue(maxsize=queue_size)
+
+        self.load_stage = PipelineStage("load", handler.load_page, load_workers)
+        self.recognition_stage = PipelineStage("recognize", handler.recognize_page, recognition_workers)
+        self.save_stage = PipelineStage("save", handler.save_page, save_workers)
+
+    def run(self, report_interval=60):
+        self.load_stage.start(self._load_worker)
+        self.recognition_stage.start(self._recognition_worker)
+        self.save_stage.start(self._save_worker)
+
+        while True:
+            time.sleep(report_interval)
+            log(f"Pipeline statistics: {self.stats()}")
+
+    def stats(self):
+        stats = {
+            "queue": self.handler.work_queue.stats(),
+            "stages": dict((stage.name, stage.stats()) for stage in (self.load_stage, self.recognition_stage, self.save_stage))
+        }
+
+        if self.batching is not None:
+            stats["batching"] = self.batching.stats()
+
+        return stats
+
+    def _load_worker(self, stage):
+        while True:
+            file_id = None
+
+            try:
+                item = self.handler.work_queue.get(timeout=1)
+
+                if item is not None:
+                    file_id, image_path, wait_time = item
+                    log(f"Processing started (waited {wait_time:.2f} s)", file_id)
+                    task = stage.run(file_id, image_path, wait_time)
+
+                    if task is not None:
+                        self.recognition_queue.put(task)
+
+            except:
+                self._handle_worker_exception(file_id)
+
+    def _recognition_worker(self, stage):
+        while True:
+            task = self.recognition_queue.get()
+
+            try:
+                if self.batching is not None:
+                    self.batching.page_started()
+                    try:
+                        result = stage.run(task)
+                    finally:
+                        self.batching.page_finished()
+                else:
+                    result = stage.run(task)
+
+                if result is not None:
+                    self.save_queue.put(result)
+
+            except:
+                self._handle_worker_exception(task.file_id)
+
+    def _save_worker(self, stage):
+        while True:
+            task = self.save_queue.get()
+
+            try:
+                stage.run(task)
+                log("Processing finished", task.file_id)
+
+            except:
+                # save_page fails the page itself, the exception was raised after its result was saved or failed
+                log("Exception raised in the pipeline:", task.file_id)
+                log(traceback.format_exc(), task.file_id)
+
+    def _handle_worker_exception(self, file_id):
+        """Fails the page whose exception escaped the stage function, so that the worker thread keeps running."""
+        if file_id is None:
+            log("Exception raised in the pipeline:")
+            log(traceback.format_exc())
+            return
+
+        try:
+            self.handler.handle_exception(file_id)
+
+        except:
+            log("Exception raised while failing the page:", file_id)
+            log(traceback.format_exc(), file_id)
+
+
+class LineBatcher:
+    """Replacement of `process_lines` of an OCR engine which pools line crops of concurrently processed pages.
+
+    Calls are held back until every page being recognized waits here or `max_delay` passes, then the crops of all
+    waiting calls go through the engine at once and the results are split back to the callers. The engine runs one
+    batch at a time. The callers hold `parser_lock` (if given) around the rest of the page parser, which is released
+    while they wait here, so other pages can get to the engine in the meantime.
+    """
+
+    def __init__(self, process_lines, max_delay, parser_lock=None):
+        self.process_lines = process_lines
+        self.max_delay = max_delay
+        self.parser_lock = parser_lock
+        self.active_pages = 0
+        self.batches = 0
+        self.batched_calls = 0
+        self.batched_lines = 0
+
+        self._pending = []
+        self._running = False
+        self._condition = threading.Condition()
+
+    def page_started(self):
+        with self._condition:
+            self.active_pages += 1
+
+    def page_finished(self):
+        with self._condition:
+            self.active_pages -= 1
+            self._condition.notify_all()
+
+    def __call__(self, crops, *args, **kwargs):
+        if self.parser_lock is None:
+            return self._call(crops, *args, **kwargs)
+
+        self.parser_lock.release()
+        try:
+            return self._call(crops, *args, **kwargs)
+        finally:
+            self.parser_lock.acquire()
+
+    def _call(self, crops, *args, **kwargs):
+        call = {"crops": crops, "args": args, "kwargs": kwargs, "done": False, "result": None, "error": None}
+        deadline = time.monotonic() + self.max_delay
+
+        with self._condition:
+            self._pending.append(call)
+            self._condition.notify_all()
+
+            while not call["done"]:
+                remaining = deadline - time.monotonic()
+                if not self._running and (len(self._pending) >= self.active_pages or remaining <= 0):
+                    batch = self._pending
+                    self._pending = []
+                    self._running = True
+
+                    self._condition.release()
+                    try:
+                        self._process_batch(batch)
+                    finally:
+                        self._condition.acquire()
+                        self._running = False
+                        self._condition.notify_all()
+
+                else:
+                    self._condition.wait(timeout=remaining if remaining > 0 else None)
+
+        if call["error"] is not None:
+            raise call["error"]
+
+        return call["result"]
+
+    def _process_batch(self, batch):
+        crops = [crop for call in batch for crop in call["crops"]]
+        counts = [len(call["crops"]) for call in batch]
+
+        try:
+            results = self.process_lines(crops, *batch[0]["args"], **batch[0]["kwargs"])
+            results = self._split(results, counts)
+        except Exception as error:
+            results = [None] * len(batch)
+            for call in batch:
+                call["error"] = error
+
+        for call, result in zip(batch, results):
+            call["result"] = result
+            call["done"] = True
+
+        self.batches += 1
+        self.batched_calls += len(batch)
+        self.batched_lines += len(crops)
+
+    def _split(self, results, counts):
+        if isinstance(results, tuple):
+            parts = [self._split(part, counts) for part in results]
+            return [tuple(part[i] for part in parts) for i in range(len(counts))]
+
+        split = []
+        offset = 0
+        for count in counts:
+            split.append(results[offset:offset + count])
+            offset += count
+
+        return split
+
+
+class DynamicBatching:
+    """Installs LineBatcher into all OCR engines of a PageParser. Pages are processed by the parser while holding
+    `parser_lock`, as nothing but the OCR engines is known to be thread-safe."""
+
+    def __init__(self, page_parser, max_delay, parser_lock=None):
+        self.engines = find_ocr_engines(page_parser)
+        self.batchers = []
+
+        for engine in self.engines:
+            batcher = LineBatcher(engine.process_lines, max_delay, parser_lock)
+            engine.process_lines = batcher
+            self.batchers.append(batcher)
+
+    def uninstall(self):
+        for engine in self.engines:
+            # removes the instance attribute, the class method is visible again
+            del engine.process_lines
+
+    def page_started(self):
+        for batcher in self.batchers:
+            batcher.page_started()
+
+    def page_finished(self):
+        for batcher in self.batchers:
+            batcher.page_finished()
+
+    def stats(self):
+        batches = sum(batcher.batches for batcher in self.batchers)
+        calls = sum(batcher.batched_calls for batcher in self.batchers)
+        lines = sum(batcher.batched_lines for batcher in self.batchers)
+        return {
+            "batches": batches,
+            "pages_per_batch": calls / batches if batches > 0 else 0.0,
+            "lines_per_batch": lines / batches if batches > 0 else 0.0
+        }
+
+
+def find_ocr_engines(page_parser):
+    ocrs = []
+
+    if isinstance(getattr(page_parser, "ocrs", None), dict):
+        ocrs += list(page_parser.ocrs.values())
+
+    if getattr(page_parser, "ocr", None) is not None:
+        ocrs.append(page_parser.ocr)
+
+    return [ocr.ocr_engine for ocr in ocrs if getattr(ocr, "ocr_engine", None) is not None]
+
+
 class NewFileHandler(FileSystemEventHandler):
-    def __init__(self, page_parser, music_exporter, output_xmls_path, output_logits_path, output_error_path, pad_to_a4=False):
+    image_extensions = {".jpg", ".png"}
+
+    def __init__(self, page_parser, music_path, output_xmls_path, output_logits_path, output_error_path, jobs,
+                 work_queue, caption_client, caption_cache=None, pad_to_a4=False, save_logits=True, claims_path=None,
+                 deferred_captions=False, max_pixels=0, tiles_path=None, trace_file=None, max_pending_captions=16):
         self.page_parser = page_parser
-        self.music_exporter = music_exporter
+        self.caption_client = caption_client
+        self.caption_cache = caption_cache
+        self.music_path = music_path
         self.output_xmls_path = output_xmls_path
         self.output_logits_path = output_logits_path
         self.output_error_path = output_error_path
+        self.jobs = jobs
+        self.work_queue = work_queue
+        self.claims_path = claims_path
         self.pad_to_a4 = pad_to_a4
+        self.save_logits = save_logits
+        self.max_pixels = max_pixels
+        self.tiles_path = tiles_path
+
+        # held by the recognition threads around the page parser, only its OCR engines release it (see LineBatcher)
+        self.parser_lock = threading.Lock()
 
         self._caption_categories = ["Obrázek", "Kreslený humor/karikatura/komiks", "Fotografie", "Graf", "Mapa",
                                     "Ozdobný nápis", "Schéma", "Půdorys", "Ostatní výkresy", "Geometrické výkresy"]
 
-        self._api_key = self.load_api_key()
         self.max_image_size = 512
 
-    def load_api_key(self):
-        api_key_file = os.path.join("api_key.txt")
-        with open(api_key_file, "r") as file:
-            return file.readline().strip()
-
-    def on_created(self, event):
-        new_file_path = event.src_path
-        _, file_name = os.path.split(new_file_path)
-        file_id, _ = os.path.splitext(file_name)
-        log("New file detected", file_id)
-        
-        if new_file_path.endswith(".jpg"):
-            log("Processing started", file_id)
-            self.process_file(file_id, new_file_path)
-            log("Processing finished", file_id)
-
-    def process_file(self, file_id, image_path):
-        attempts = 3
-        delay = 1
-        
-        image = cv2.imread(image_path, 1)
+        # music files are stored in shard directories, the exporter writes to a fixed folder, so there is one per shard
+        self._music_exporters = {}
+        self._music_lock = threading.Lock()
 
-        if image is None:
-            for i in range(attempts):
-                time.sleep(delay)
-                image = cv2.imread(image_path, 1)
+        # music export is slow, it runs in the background after the result is published
+        self._music_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="music")
+
+        self.deferred_captions = deferred_captions
+        self._caption_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="deferred-captions") if deferred_captions else None
+        # crops of pages waiting for their captions are held in memory, the save stage waits when there are too many
+        self._pending_captions = threading.BoundedSemaphore(max_pending_captions)
+
+        # metrics of the worker are shared with the server through a snapshot file, traces of pages in a JSON lines file
+        self.process_name = f"pipeline-{socket.gethostname()}-{os.getpid()}"
+        self.trace_writer = metrics.TraceWriter(trace_file) if trace_file is not None else None
+        self.metrics = metrics.MetricsRegistry()
+        self.stage_duration = self.metrics.histogram(
+            "pero_pipeline_stage_seconds", "Time spent in stages of processing pages.", ["stage"])
+        self.page_duration = self.metrics.histogram(
+            "pero_pipeline_page_seconds", "Time from the start of processing of a page to its published result.")
+        self.wait_duration = self.metrics.histogram(
+            "pero_pipeline_queue_wait_seconds", "Time from the upload of a page to the start of its processing.")
+        self.processed_pages = self.metrics.counter(
+            "pero_pipeline_pages_total", "Number of pages by the result of their processing.", ["status"])
+        self.queue_length = self.metrics.gauge(
+            "pero_pipeline_queue_length", "Number of images waiting in the queue of the worker by their priority.", ["priority"])
+
+    def on_moved(self, event):
+        # the server writes uploads to a temporary file and renames it, so the image is complete at this point
+        if not event.is_directory:
+            self.enqueue(event.dest_path)
+
+    def on_closed(self, event):
+        # images copied directly into the upload directory are complete once the writer closes them
+        if not event.is_directory:
+            self.enqueue(event.src_path)
+
+    def enqueue(self, image_path, created=None):
+        _, file_name = os.path.split(image_path)
+        file_id, extension = os.path.splitext(file_name)
+
+        if extension in self.image_extensions:
+            # the server registers the job with its priority before it saves the image
+            priority = self.jobs.get_priority(file_id)
+
+            if self.work_queue.put(file_id, image_path, created, priority):
+                log(f"New file queued ({priority}, queue length {len(self.work_queue)})", file_id)
+
+    def enqueue_backlog(self, input_path):
+        """Queues images uploaded while the pipeline was not running, oldest first."""
+        backlog = []
+
+        for entry in request_storage.iterate_files(input_path):
+            file_id, extension = os.path.splitext(entry.name)
+
+            if extension in self.image_extensions and not self.is_processed(file_id):
+                backlog.append((entry.stat().st_mtime, entry.path))
+
+        for created, image_path in sorted(backlog):
+            self.enqueue(image_path, created)
+
+        return len(backlog)
+
+    def is_processed(self, file_id):
+        return os.path.exists(self.get_xml_file_path(file_id)) or os.path.exists(self.get_error_file_path(file_id))
+
+    def run(self, timeout=1):
+        while True:
+            item = self.work_queue.get(timeout=timeout)
 
-                if image is not None:
-                    break
+            if item is not None:
+                file_id, image_path, wait_time = item
+                log(f"Processing started (waited {wait_time:.2f} s)", file_id)
+                self.process_file(file_id, image_path, wait_time)
+                log(f"Processing finished, queue statistics: {self.work_queue.stats()}", file_id)
+
+    def process_file(self, file_id, image_path, wait_time=0.0):
+        task = self.load_page(file_id, image_path, wait_time)
+
+        if task is not None:
+            task = self.recognize_page(task)
+
+        if task is not None:
+            self.save_page(task)
+
+    def load_page(self, file_id, image_path, wait_time=0.0):
+        trace = metrics.Trace(event="page", file_id=file_id, process=self.process_name, wait_time=wait_time)
+
+        if not self.claim(file_id):
+            log("Image claimed or already processed by another worker, skipping.", file_id)
+            self.finish_trace(trace, "skipped")
+            return None
+
+        self.create_shard_dirs(file_id)
+
+        with trace.stage("load"):
+            image, page_size = load_image(image_path, self.max_pixels)
 
         if image is None:
             log("Cannot load image. Saving error file.", file_id)
             self.save_error_file(file_id)
+            self.finish_trace(trace, "failed")
+            return None
 
-        else:
-            output_xml_path = self.get_xml_file_path(file_id)
-            output_logits_path = self.get_logits_file_path(file_id)
+        try:
+            page_layout = PageLayout(id=file_id, page_size=(image.shape[0], image.shape[1]))
 
-            try:
-                page_layout = PageLayout(id=file_id, page_size=(image.shape[0], image.shape[1]))
-                
-                if self.pad_to_a4:
+            if page_size != page_layout.page_size:
+                log(f"Image scaled down from {page_size[1]}x{page_size[0]} to {image.shape[1]}x{image.shape[0]}", file_id)
+            else:
+                page_size = None
+
+            if self.pad_to_a4:
+                with trace.stage("padding"):
                     image = self.add_padding(image)
 
-                page_layout = self.page_parser.process_page(image, page_layout)
+        except:
+            self.handle_exception(file_id)
+            self.finish_trace(trace, "failed")
+            return None
 
-                self.generate_image_captions(image, page_layout)
+        return PageTask(file_id, image_path, image, page_layout, page_size, trace)
 
-                page_layout.to_pagexml(output_xml_path)
-                page_layout.save_logits(output_logits_path)
+    def recognize_page(self, task):
+        try:
+            # marked as processing only now, in pipelined mode loaded pages may wait for the recognition stage
+            self.jobs.start(task.file_id)
 
-                self.music_exporter.process_page(page_layout)
+            with task.trace.stage("recognize"), self.parser_lock:
+                task.page_layout = self.page_parser.process_page(task.image, task.page_layout)
 
-            except:
-                log("Exception raised during processing:", file_id)
-                log(traceback.format_exc(), file_id)
-                log("Saving error file.", file_id)
-                self.save_error_file(file_id)
+        except:
+            self.handle_exception(task.file_id)
+            self.finish_trace(task.trace, "failed")
+            return None
+
+        return task
+
+    def save_page(self, task):
+        file_id = task.file_id
+        page_layout = task.page_layout
+        trace = task.trace
+        status = "failed"
+
+        output_xml_path = self.get_xml_file_path(file_id)
+        output_logits_path = self.get_logits_file_path(file_id)
+        output_confidences_path = self.get_confidences_file_path(file_id)
+
+        try:
+            with trace.stage("captions"):
+                if self.deferred_captions:
+                    caption_regions, caption_images = self.get_caption_crops(task.image, page_layout)
+                    if len(caption_regions) > 0:
+                        self.save_pending_captions_file(file_id, caption_regions)
+                else:
+                    self.generate_image_captions(task.image, page_layout)
+
+            if self.tiles_path is not None:
+                with trace.stage("tiles"):
+                    # without the A4 padding, the layout has the size of the processed image at this point
+                    processed_height, processed_width = page_layout.page_size
+                    save_tiles(self.get_tiles_file_path(file_id), task.image[:processed_height, :processed_width],
+                               task.page_size or page_layout.page_size)
+
+            # results are stored in coordinates of the original image, caption crops are taken before that
+            if task.page_size is not None:
+                scale_page_layout(page_layout, task.page_size)
+
+            with trace.stage("confidences"):
+                self.save_confidences(page_layout, output_confidences_path)
+
+            if self.save_logits:
+                with trace.stage("logits"):
+                    page_layout.save_logits(output_logits_path)
+
+            has_music = any(region.category == MUSIC_CATEGORY for region in page_layout.regions)
+            self.save_music_manifest(file_id, {"status": "pending"} if has_music else NO_MUSIC_MANIFEST)
+
+            # the XML is written last and atomically, its presence signals a finished result to the server
+            with trace.stage("xml"):
+                self.save_xml(page_layout, output_xml_path)
+            self.jobs.finish(file_id)
+            status = "done"
+
+            if self.deferred_captions and len(caption_regions) > 0:
+                self.submit_captions(file_id, [region.id for region in caption_regions], caption_images)
+
+            if has_music:
+                # the export needs only the transcriptions, logits of all lines would wait in the queue with the page
+                for line in page_layout.lines_iterator():
+                    line.logits = None
+                self._music_executor.submit(self.export_music, page_layout)
+
+        except:
+            self.handle_exception(file_id)
+
+        finally:
+            self.release_claim(file_id)
+            self.finish_trace(trace, status)
+
+    def finish_trace(self, trace, status):
+        """Records durations of the stages of the processed page in metrics and in the trace file."""
+        record = trace.finish(status=status)
+
+        for stage, duration in trace.stages.items():
+            self.stage_duration.observe(duration, stage=stage)
+
+        self.processed_pages.inc(status=status)
+        if status != "skipped":
+            self.wait_duration.observe(record["wait_time"])
+            self.page_duration.observe(record["duration"])
+
+        if self.trace_writer is not None:
+            self.trace_writer.write(record)
+
+    def finish_background_trace(self, trace, status):
+        """Records work done after the page was published (music export, deferred captions) as a separate event."""
+        record = trace.finish(status=status)
+        self.stage_duration.observe(record["duration"], stage=record["event"])
+
+        if self.trace_writer is not None:
+            self.trace_writer.write(record)
+
+    def collect_metrics(self):
+        for priority, length in self.work_queue.stats()["lengths"].items():
+            self.queue_length.set(length, priority=priority)
+
+    def export_music(self, page_layout):
+        """Exports MIDI and MusicXML files of the page and replaces its pending music manifest by the list of them."""
+        file_id = page_layout.id
+        shard_path = request_storage.get_shard_path(self.music_path, file_id)
+        trace = metrics.Trace(event="music_export", file_id=file_id, process=self.process_name)
+
+        try:
+            with self._music_lock:
+                music_exporter = self._music_exporters.get(shard_path)
+                if music_exporter is None:
+                    os.makedirs(shard_path, exist_ok=True)
+                    music_exporter = MusicPageExporter(output_folder=shard_path, export_midi=True, export_musicxml=True)
+                    self._music_exporters[shard_path] = music_exporter
+
+                with trace.stage("music_export"):
+                    music_exporter.process_page(page_layout)
+
+            manifest = self.get_music_files(file_id)
+
+        except:
+            log("Exception raised during music export:", file_id)
+            log(traceback.format_exc(), file_id)
+            manifest = {"status": "failed"}
+
+        self.save_music_manifest(file_id, manifest)
+        self.finish_background_trace(trace, manifest["status"])
+
+    def get_music_files(self, file_id):
+        page = False
+        lines = []
+
+        line_prefix = f"{file_id}_"
+        for entry in os.scandir(request_storage.get_shard_path(self.music_path, file_id)):
+            if entry.name == f"{file_id}.mid":
+                page = True
+            elif entry.name.startswith(line_prefix) and entry.name.endswith(".mid"):
+                lines.append(entry.name[len(line_prefix):-len(".mid")])
+
+        return {
+            "status": "done",
+            "page": page,
+            "lines": sorted(lines)
+        }
+
+    def save_music_manifest(self, file_id, manifest):
+        path = request_storage.make_shard_dirs(self.get_music_manifest_file_path(file_id))
+        with open(path + ".tmp", "w") as file:
+            json.dump(manifest, file)
+
+        os.replace(path + ".tmp", path)
+
+    def resume_music_export(self):
+        """Exports music of pages whose export was interrupted by a restart of the pipeline."""
+        resumed = 0
+
+        for entry in request_storage.iterate_files(self.music_path):
+            if entry.name.endswith(".music.json"):
+                with open(entry.path, "r") as file:
+                    manifest = json.load(file)
+
+                file_id = entry.name[:-len(".music.json")]
+                if manifest["status"] == "pending" and os.path.isfile(self.get_xml_file_path(file_id)):
+                    self._music_executor.submit(self.export_music, PageLayout(file=self.get_xml_file_path(file_id)))
+                    resumed += 1
+
+        return resumed
+
+    def save_xml(self, page_layout, path):
+        page_layout.to_pagexml(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def submit_captions(self, file_id, region_ids, images):
+        self._pending_captions.acquire()
+        future = self._caption_executor.submit(self.complete_captions, file_id, region_ids, images)
+        future.add_done_callback(lambda future: self._pending_captions.release())
+
+    def complete_captions(self, file_id, region_ids, images):
+        """Generates captions of the regions of a page published without them and rewrites its XML."""
+        trace = metrics.Trace(event="deferred_captions", file_id=file_id, process=self.process_name)
+        status = "failed"
+
+        try:
+            with trace.stage("captions"):
+                image_captions = self.get_image_captions(file_id, images)
+
+            # the published result is loaded again, the layout with logits of all lines is not kept until now
+            page_layout = PageLayout(file=self.get_xml_file_path(file_id))
+            captions = dict(zip(region_ids, image_captions))
+            for region in page_layout.regions:
+                if region.id in captions:
+                    region.transcription = captions[region.id]
+
+            with trace.stage("xml"):
+                self.save_xml(page_layout, self.get_xml_file_path(file_id))
+            log("Deferred captions saved", file_id)
+            status = "done"
+
+        except:
+            log("Exception raised during generating deferred captions:", file_id)
+            log(traceback.format_exc(), file_id)
+
+        finally:
+            self.remove_pending_captions_file(file_id)
+            self.finish_background_trace(trace, status)
+
+    def resume_deferred_captions(self, input_path):
+        """Completes captions of pages whose captioning was interrupted by a restart of the pipeline."""
+        resumed = 0
+
+        for entry in request_storage.iterate_files(self.output_xmls_path):
+            file_id, extension = os.path.splitext(entry.name)
+
+            if extension == ".captions":
+                image_path = next((path for path in (self.get_file_path(input_path, file_id, image_extension)
+                                                     for image_extension in self.image_extensions)
+                                   if os.path.isfile(path)), None)
+
+                if image_path is None:
+                    os.remove(entry.path)
+                    continue
+
+                # the image is loaded in the task, so the queue of resumed pages holds only their IDs
+                self._caption_executor.submit(self.resume_captions, file_id, image_path)
+                resumed += 1
+
+        return resumed
+
+    def resume_captions(self, file_id, image_path):
+        try:
+            image = cv2.imread(image_path, 1)
+            regions, images = self.get_caption_crops(image, PageLayout(file=self.get_xml_file_path(file_id)))
+        except:
+            log("Exception raised during loading a page with pending captions:", file_id)
+            log(traceback.format_exc(), file_id)
+            self.remove_pending_captions_file(file_id)
+            return
+
+        self.complete_captions(file_id, [region.id for region in regions], images)
+
+    def remove_pending_captions_file(self, file_id):
+        try:
+            os.remove(self.get_pending_captions_file_path(file_id))
+        except FileNotFoundError:
+            pass
+
+    def save_pending_captions_file(self, file_id, regions):
+        path = self.get_pending_captions_file_path(file_id)
+        with open(path + ".tmp", "w") as file:
+            json.dump([region.id for region in regions], file)
+
+        os.replace(path + ".tmp", path)
+
+    def claim(self, file_id):
+        """Atomically claims the image for this worker, so that workers sharing the upload directory skip it."""
+        if self.claims_path is None:
+            return True
+
+        try:
+            descriptor = os.open(self.get_claim_file_path(file_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(descriptor, "w") as file:
+            file.write(f"{socket.gethostname()}:{os.getpid()}")
+
+        # another worker may have finished the image and released its claim after this one queued it
+        if self.is_processed(file_id):
+            self.release_claim(file_id)
+            return False
+
+        return True
+
+    def release_claim(self, file_id):
+        if self.claims_path is not None:
+            try:
+                os.remove(self.get_claim_file_path(file_id))
+            except FileNotFoundError:
+                pass
+
+    def remove_stale_claims(self):
+        """Removes claims of dead worker processes of this host."""
+        hostname = socket.gethostname()
+        removed = 0
+
+        for entry in os.scandir(self.claims_path):
+            try:
+                with open(entry.path, "r") as file:
+                    claim_hostname, pid = file.read().rsplit(":", 1)
+            except (OSError, ValueError):
+                continue
+
+            if claim_hostname == hostname and not is_process_alive(int(pid)):
+                self.release_claim(os.path.splitext(entry.name)[0])
+                removed += 1
+
+        return removed
+
+    def handle_exception(self, file_id):
+        log("Exception raised during processing:", file_id)
+        log(traceback.format_exc(), file_id)
+        log("Saving error file.", file_id)
+        self.save_error_file(file_id)
 
     def add_padding(self, image):
         a4_height, a4_width = 2970, 2100
@@ -111,12 +882,18 @@ class NewFileHandler(FileSystemEventHandler):
             target_height = image_height
             target_width = round(image_height * a4_ratio)
 
-        target_image = np.full((target_height, target_width, 3), 255, dtype=np.uint8)
-        target_image[:image_height, :image_width] = image
-
-        return target_image
+        # the padding is added to the bottom and right side only, so coordinates of the image do not change
+        return cv2.copyMakeBorder(image, 0, target_height - image_height, 0, target_width - image_width,
+                                  cv2.BORDER_CONSTANT, value=(255, 255, 255))
 
     def generate_image_captions(self, page_image, page_layout):
+        regions, images = self.get_caption_crops(page_image, page_layout)
+        image_captions = self.get_image_captions(page_layout.id, images)
+
+        for region, image_caption in zip(regions, image_captions):
+            region.transcription = image_caption
+
+    def get_caption_crops(self, page_image, page_layout):
         regions = []
         images = []
         for region in page_layout.regions:
@@ -144,72 +921,145 @@ class NewFileHandler(FileSystemEventHandler):
                     images.append(image)
                     regions.append(region)
 
-        processing_function = partial(generate_image_caption, api_key=self._api_key)
+        return regions, images
 
-        with Pool(4) as p:
-            image_captions = p.map(processing_function, images)
+    def get_image_captions(self, file_id, images):
+        image_captions = [None] * len(images)
 
-        for region, image_caption in zip(regions, image_captions):
-            region.transcription = image_caption
+        if self.caption_cache is not None:
+            image_captions = [self.caption_cache.get(image) for image in images]
+
+        missing = [i for i, image_caption in enumerate(image_captions) if image_caption is None]
+        new_captions = self.caption_client.caption_images([images[i] for i in missing])
+
+        for i, image_caption in zip(missing, new_captions):
+            image_captions[i] = image_caption
+
+            # failed requests return an empty caption, these are not cached
+            if self.caption_cache is not None and image_caption != "":
+                self.caption_cache.put(images[i], image_caption)
+
+        if len(images) > 0:
+            log(f"Image captions: {len(images) - len(missing)} cache hits, {len(missing)} cache misses", file_id)
+
+        return image_captions
+
+    def save_confidences(self, page_layout, path):
+        line_ids = []
+        line_confidences = []
+
+        for line in page_layout.lines_iterator():
+            line_ids.append(line.id)
+            line_confidences.append(calculate_line_confidence(line))
+
+        save_confidences(path, line_ids, line_confidences)
+
+    def create_shard_dirs(self, file_id):
+        for path in [self.get_xml_file_path(file_id), self.get_logits_file_path(file_id)]:
+            request_storage.make_shard_dirs(path)
+
+        if self.tiles_path is not None:
+            request_storage.make_shard_dirs(self.get_tiles_file_path(file_id))
 
     def save_error_file(self, file_id):
-        path = self.get_error_file_path(file_id)
+        path = request_storage.make_shard_dirs(self.get_error_file_path(file_id))
         with open(path, 'w') as file:
             pass
 
+        self.jobs.fail(file_id)
+        self.release_claim(file_id)
+
+    def get_claim_file_path(self, file_id):
+        # claims are removed after processing, they are not sharded
+        return os.path.join(self.claims_path, file_id + ".claim")
+
     def get_error_file_path(self, file_id):
         return self.get_file_path(self.output_error_path, file_id, ".txt")
 
     def get_logits_file_path(self, file_id):
         return self.get_file_path(self.output_logits_path, file_id, ".logits")
 
+    def get_confidences_file_path(self, file_id):
+        return self.get_file_path(self.output_logits_path, file_id, ".conf")
+
+    def get_pending_captions_file_path(self, file_id):
+        return self.get_file_path(self.output_xmls_path, file_id, ".captions")
+
+    def get_music_manifest_file_path(self, file_id):
+        return self.get_file_path(self.music_path, file_id, ".music.json")
+
+    def get_tiles_file_path(self, file_id):
+        return self.get_file_path(self.tiles_path, file_id, ".tiles")
+
     def get_xml_file_path(self, file_id):
         return self.get_file_path(self.output_xmls_path, file_id, ".xml")
 
     def get_file_path(self, path, file_id, extension):
-        return os.path.join(path, file_id + extension)
-
-def generate_image_caption(image, api_key):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-
-    payload = {
-        "model": "gpt-4o-mini",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Give me one short sentence describing the image."
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{encode_image(image)}"
-                        }
-                    }
-                ]
-            }
-        ],
-        "max_tokens": 300
-    }
+        return request_storage.get_file_path(path, file_id, extension)
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+def load_image(path, max_pixels=0):
+    """Loads the image scaled down to at most `max_pixels` pixels (0 for no limit).
 
-    try:
-        image_caption = response.json()["choices"][0]["message"]["content"]
-    except:
-        image_caption = ""
+    Large JPEGs are decoded directly at 1/2, 1/4 or 1/8 of their resolution, so the full size image is never
+    allocated. Returns the image (None if it cannot be loaded) and the (height, width) of the original image.
+    cv2.imread applies the EXIF orientation, the original size is reported with the orientation applied.
+    """
+    flags = cv2.IMREAD_COLOR
+    reduction = 1
+    page_size = None
+
+    if max_pixels > 0:
+        try:
+            with PIL.Image.open(path) as header:
+                width, height = header.size
+                if header.getexif().get(0x0112, 1) in {5, 6, 7, 8}:
+                    width, height = height, width
+                page_size = (height, width)
+
+                if header.format == "JPEG":
+                    for reduction, flags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                             (2, cv2.IMREAD_REDUCED_COLOR_2), (1, cv2.IMREAD_COLOR)):
+                        if width * height >= max_pixels * reduction ** 2:
+                            break
+
+        except:
+            page_size = None
+
+    image = cv2.imread(path, flags)
 
-    return image_caption
+    if image is None:
+        return None, None
 
-def encode_image(image):
-    image_jpg = cv2.imencode('.jpg', image)[1]
-    image_base64 = base64.b64encode(image_jpg).decode('utf-8')
-    return image_base64
+    if page_size is None or reduction == 1:
+        page_size = (image.shape[0], image.shape[1])
+
+    pixels = image.shape[0] * image.shape[1]
+    if 0 < max_pixels < pixels:
+        scale = (max_pixels / pixels) ** 0.5
+        size = (max(round(image.shape[1] * scale), 1), max(round(image.shape[0] * scale), 1))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    return image, page_size
+
+
+def scale_page_layout(page_layout, page_size):
+    """Scales coordinates of the layout processed on a resized image to the original `page_size` (height, width)."""
+    scale_y = page_size[0] / page_layout.page_size[0]
+    scale_x = page_size[1] / page_layout.page_size[1]
+    scale = np.array([scale_x, scale_y])
+
+    for region in page_layout.regions:
+        region.polygon = np.asarray(region.polygon) * scale
+
+        for line in region.lines:
+            if line.polygon is not None:
+                line.polygon = np.asarray(line.polygon) * scale
+            if line.baseline is not None:
+                line.baseline = np.asarray(line.baseline) * scale
+            if line.heights is not None:
+                line.heights = [height * scale_y for height in line.heights]
+
+    page_layout.page_size = tuple(page_size)
 
 
 def parse_arguments():
@@ -217,10 +1067,47 @@ def parse_arguments():
     parser.add_argument('-s', '--server-config', help='Path to server config file.', required=True)
     parser.add_argument('-p', '--pipeline-config', help='Path to OCR pipeline config file.', required=True)
     parser.add_argument('--pad-to-a4', help='Pad images to A4 format.', action='store_true')
+    parser.add_argument('--max-pixels', help='Scale larger images down to this number of pixels before processing, 0 for no limit.', type=int, default=0)
+    parser.add_argument('--device', help='Torch device used for OCR, e.g. cuda, cuda:1 or cpu.', default='cuda')
+    parser.add_argument('--workers', help='Number of worker processes, each with its own PageParser.', type=int, default=1)
+    parser.add_argument('--threads-per-worker', help='Number of torch intra-op threads of each worker '
+                                                     '(default: CPU cores divided by the number of workers).', type=int)
+    parser.add_argument('--deferred-captions', help='Publish results before image captions are generated.', action='store_true')
+    parser.add_argument('--max-pending-captions', help='Maximal number of published pages waiting for deferred captions.', type=int, default=16)
+    parser.add_argument('--no-logits', help='Do not store full logits, only the precomputed confidences.', action='store_true')
+    parser.add_argument('--no-tiles', help='Do not generate tile pyramids of the images for the viewer.', action='store_true')
+    parser.add_argument('--pipelined', help='Load, recognize and save different pages concurrently.', action='store_true')
+    parser.add_argument('--load-workers', help='Number of threads loading images in pipelined mode.', type=int, default=1)
+    parser.add_argument('--recognition-workers', help='Number of threads running OCR in pipelined mode.', type=int, default=1)
+    parser.add_argument('--save-workers', help='Number of threads saving results in pipelined mode.', type=int, default=2)
+    parser.add_argument('--stage-queue-size', help='Maximal number of pages waiting between stages in pipelined mode.', type=int, default=2)
+    parser.add_argument('--batch-size', help='Recognize lines of up to this many pages in one batch (implies --pipelined).', type=int, default=1)
+    parser.add_argument('--batch-delay', help='Maximal time in seconds a page waits for other pages to join its batch.', type=float, default=0.05)
+    parser.add_argument('--trace-file', help='Append durations of the processing stages of each page to this JSON lines file.')
     args = parser.parse_args()
     return args
 
 
+def load_api_key(api_key_file):
+    if not os.path.isfile(api_key_file):
+        log(f"API key file {api_key_file} not found, captioning requests are sent without it")
+        return ""
+
+    with open(api_key_file, "r") as file:
+        return file.readline().strip()
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
 def log(message, log_source="SCRIPT"):
     print(f"[{log_source}|{datetime.utcnow()}] {message}")
 
@@ -229,13 +1116,52 @@ def get_absolute_path(config_path, path):
     config_dir = os.path.dirname(config_path)
     return os.path.join(config_dir, path)
 
+
+def start_retention(server_config_path):
+    """Starts removing old results in the background if the server config has a [retention] section."""
+    server_config = config_helper.parse_configuration(server_config_path)
+    jobs_path = get_absolute_path(os.path.abspath(server_config_path), server_config["requests"].get("jobs_path", "jobs.sqlite"))
+
+    retention_task = request_storage.create_retention_task(server_config, server_config_path, job_registry.JobRegistry(jobs_path))
+    if retention_task is not None:
+        log(f"Starting retention (max age {retention_task.max_age} s, max size {retention_task.max_size} B)")
+        retention_task.start()
+
+
 def main():
     faulthandler.enable()
 
     log("Script started")
     args = parse_arguments()
-    
-    log("Parsing server configuration")
+
+    start_retention(args.server_config)
+
+    if args.workers <= 1:
+        return run_worker(args)
+
+    # workers are spawned, not forked, so that each of them initializes its own torch and CUDA state
+    context = get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(args, i), name=f"worker-{i}") for i in range(args.workers)]
+
+    log(f"Starting {args.workers} workers")
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+    return 0
+
+
+def run_worker(args, worker_id=0):
+    faulthandler.enable()
+    log_source = f"WORKER-{worker_id}"
+
+    log("Parsing server configuration", log_source)
     server_config = config_helper.parse_configuration(args.server_config)
     abs_config_path = os.path.abspath(args.server_config)
     input_path = get_absolute_path(abs_config_path, server_config["requests"]["upload_path"])
@@ -243,32 +1169,93 @@ def main():
     logits_path = get_absolute_path(abs_config_path, server_config["requests"]["logits_path"])
     errors_path = get_absolute_path(abs_config_path, server_config["requests"]["errors_path"])
     music_path = get_absolute_path(abs_config_path, server_config["requests"]["music_path"])
+    tiles_path = None if args.no_tiles else get_absolute_path(abs_config_path, server_config["requests"].get("tiles_path", "tiles"))
+    jobs_path = get_absolute_path(abs_config_path, server_config["requests"].get("jobs_path", "jobs.sqlite"))
+    claims_path = get_absolute_path(abs_config_path, server_config["requests"].get("claims_path", "claims"))
+    os.makedirs(claims_path, exist_ok=True)
+    metrics_config = server_config.get("metrics", {})
+    metrics_path = get_absolute_path(abs_config_path, metrics_config.get("path", "metrics"))
 
-    log("Parsing OCR pipeline configuration")
+    threads = args.threads_per_worker
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // max(1, args.workers))
+    torch.set_num_threads(threads)
+    log(f"Using device {args.device} with {threads} threads", log_source)
+
+    log("Parsing OCR pipeline configuration", log_source)
     pipeline_config = configparser.ConfigParser()
     pipeline_config.read(args.pipeline_config)
 
-    log("Initializing PageParser")
-    page_parser = PageParser(pipeline_config, torch.device('cuda'), config_path=os.path.dirname(args.pipeline_config))
+    log("Initializing PageParser", log_source)
+    page_parser = PageParser(pipeline_config, torch.device(args.device), config_path=os.path.dirname(args.pipeline_config))
+
+    log("Initializing captioning client", log_source)
+    captioning_config = server_config.get("captioning", {})
+    api_key = load_api_key(get_absolute_path(abs_config_path, captioning_config.get("api_key_path", "api_key.txt")))
+    caption_client = create_caption_client(captioning_config, api_key)
+    caption_cache_path = get_absolute_path(abs_config_path, captioning_config.get("cache_path", "captions.sqlite"))
+    caption_cache = create_caption_cache(captioning_config, caption_cache_path)
 
-    log("Initializing MusicPageExporter")
-    music_exporter = MusicPageExporter(output_folder=music_path, export_midi=True, export_musicxml=True)
+    log("Opening job registry", log_source)
+    jobs = job_registry.JobRegistry(jobs_path)
 
-    log("Initializing observer and handler")
+    log("Initializing observer and handler", log_source)
     observer = Observer()
-    event_handler = NewFileHandler(page_parser, music_exporter, output_path, logits_path, errors_path, pad_to_a4=args.pad_to_a4)
+    work_queue = WorkQueue()
+    event_handler = NewFileHandler(page_parser, music_path, output_path, logits_path, errors_path, jobs,
+                                   work_queue, caption_client, caption_cache=caption_cache, pad_to_a4=args.pad_to_a4, save_logits=not args.no_logits,
+                                   claims_path=claims_path, deferred_captions=args.deferred_captions,
+                                   max_pending_captions=args.max_pending_captions,
+                                   max_pixels=args.max_pixels, tiles_path=tiles_path, trace_file=args.trace_file)
 
-    observer.schedule(event_handler, path=input_path)
+    metrics_writer = metrics.SnapshotWriter(event_handler.metrics,
+                                            os.path.join(metrics_path, event_handler.process_name + metrics.SNAPSHOT_EXTENSION),
+                                            {"process": event_handler.process_name}, metrics_config.get("interval", 15),
+                                            event_handler.collect_metrics)
+    metrics_writer.start()
+
+    stale_claims = event_handler.remove_stale_claims()
+    log(f"Removed {stale_claims} stale claims", log_source)
+
+    if args.deferred_captions and worker_id == 0:
+        resumed_captions = event_handler.resume_deferred_captions(input_path)
+        log(f"Resumed generating captions of {resumed_captions} pages", log_source)
+
+    # all shards are created in advance, so no upload in a new shard directory is missed
+    for path in [input_path, output_path, logits_path, errors_path, music_path]:
+        request_storage.create_shards(path)
+
+    if worker_id == 0:
+        resumed_music = event_handler.resume_music_export()
+        log(f"Resumed music export of {resumed_music} pages", log_source)
+
+    observer.schedule(event_handler, path=input_path, recursive=True)
     observer.start()
 
-    # sleep until keyboard interrupt, then stop + rejoin the observer
+    # the observer is started first, so no upload is missed between the scan and the start of watching
+    backlog_size = event_handler.enqueue_backlog(input_path)
+    log(f"Queued {backlog_size} unprocessed images from the upload directory", log_source)
+
+    # process queued images until keyboard interrupt, then stop + rejoin the observer
     try:
-        while True:
-            time.sleep(1)
+        if args.batch_size > 1:
+            batching = DynamicBatching(page_parser, max_delay=args.batch_delay, parser_lock=event_handler.parser_lock)
+            pipeline = StagedPipeline(event_handler, load_workers=args.load_workers, recognition_workers=args.batch_size,
+                                      save_workers=args.save_workers, queue_size=max(args.stage_queue_size, args.batch_size),
+                                      batching=batching)
+            pipeline.run()
+        elif args.pipelined:
+            pipeline = StagedPipeline(event_handler, load_workers=args.load_workers,
+                                      recognition_workers=args.recognition_workers, save_workers=args.save_workers,
+                                      queue_size=args.stage_queue_size)
+            pipeline.run()
+        else:
+            event_handler.run()
     except KeyboardInterrupt:
         observer.stop()
 
     observer.join()
+    metrics_writer.remove()
     return 0
 
 
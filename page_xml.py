@@ -0,0 +1,171 @@
+"""Minimal reader of PAGE XML results for the server.
+
+Reads only what /get_lines needs (page size and the ID, category, polygon and transcription of regions and their text
+lines with heights) by incremental parsing, without building the full pero_ocr PageLayout and without importing
+pero_ocr and its dependencies. The values are the same as pero_ocr.core.layout.PageLayout reads from the file, the
+heights of lines missing them are guessed by pero_ocr, which is imported only in that case.
+"""
+
+import re
+import json
+from xml.etree.ElementTree import iterparse
+
+import numpy as np
+
+
+class TextLine:
+    __slots__ = ("id", "polygon", "baseline", "heights", "transcription", "category")
+
+    def __init__(self, id, heights=None, category=None):
+        self.id = id
+        self.polygon = None
+        self.baseline = None
+        self.heights = heights
+        self.transcription = None
+        self.category = category
+
+
+class TextRegion:
+    __slots__ = ("id", "polygon", "transcription", "category", "lines")
+
+    def __init__(self, id, category=None):
+        self.id = id
+        self.polygon = None
+        self.transcription = None
+        self.category = category
+        self.lines = []
+
+
+class Page:
+    def __init__(self, id, page_size, regions):
+        self.id = id
+        self.page_size = page_size  # (height, width)
+        self.regions = regions
+
+
+def read_page(file):
+    """Reads the PAGE XML file (a path or a binary file object), returns a Page."""
+    page_id = None
+    page_size = (0, 0)
+    regions = []
+
+    # local names of the open elements, the region and line being read
+    tags = []
+    region_stack = []
+    line = None
+
+    for event, element in iterparse(file, events=("start", "end")):
+        tag = element.tag.rpartition("}")[2]
+
+        if event == "start":
+            tags.append(tag)
+
+            if tag == "Page":
+                page_id = element.get("imageFilename")
+                page_size = (int(element.get("imageHeight")), int(element.get("imageWidth")))
+
+            elif tag == "TextRegion":
+                region = TextRegion(element.get("id"), get_region_category(element.get("custom")))
+                regions.append(region)
+                region_stack.append(region)
+
+            elif tag == "TextLine":
+                heights, category = parse_line_custom(element.get("custom"))
+                line = TextLine(element.get("id"), heights, category)
+
+            continue
+
+        tags.pop()
+        parent = tags[-1] if tags else None
+        owner = line if parent == "TextLine" else region_stack[-1] if parent == "TextRegion" else None
+
+        if tag == "Coords" and owner is not None and owner.polygon is None:
+            owner.polygon = parse_points(element)
+
+        elif tag == "Baseline" and line is not None and parent == "TextLine" and line.baseline is None:
+            line.baseline = parse_points(element)
+
+        elif tag == "Unicode" and parent == "TextEquiv" and len(tags) >= 2 and tags[-2] in {"TextLine", "TextRegion"}:
+            owner = line if tags[-2] == "TextLine" else region_stack[-1]
+            # only the first TextEquiv of a line or a region is used
+            if owner.transcription is None:
+                owner.transcription = element.text if element.text is not None else ""
+
+        elif tag == "TextLine":
+            # lines without a baseline are skipped by pero_ocr as well
+            if line.baseline is not None and region_stack:
+                if not line.heights:
+                    line.heights = guess_line_heights(line)
+                region_stack[-1].lines.append(line)
+            line = None
+            element.clear()
+
+        elif tag == "TextRegion":
+            region_stack.pop()
+            element.clear()
+
+    return Page(page_id, page_size, regions)
+
+
+def get_region_category(custom):
+    if custom is None:
+        return None
+
+    try:
+        custom = json.loads(custom)
+    except ValueError:
+        return None
+
+    return custom.get("category") if isinstance(custom, dict) else None
+
+
+def parse_line_custom(custom):
+    """Heights and category of a text line from its custom attribute, in any of the formats written by pero_ocr."""
+    if custom is None:
+        return None, None
+
+    try:
+        data = json.loads(custom)
+    except ValueError:
+        data = None
+
+    if isinstance(data, dict):
+        return data.get("heights"), data.get("category")
+
+    if "heights_v2" in custom:
+        heights = None
+        for word in custom.split():
+            if "heights_v2" in word:
+                heights = json.loads(word.split(":")[1])
+        return heights, None
+
+    if re.findall("heights", custom):
+        values = [float(x) for x in re.findall(r"\d+", custom)]
+        # pero_ocr converts the legacy formats through a float32 array
+        if len(values) == 4:
+            return np.asarray([values[0], values[2]], dtype=np.float32).tolist(), None
+        elif len(values) == 3:
+            return np.asarray([values[1], values[2] - values[0]], dtype=np.float32).tolist(), None
+        return values, None
+
+    return None, None
+
+
+def parse_points(element):
+    points = element.get("points")
+    if points is not None:
+        coordinates = [point.split(",") for point in points.split(" ")]
+        return [[int(round(float(x))), int(round(float(y)))] for x, y in coordinates]
+
+    # coordinates of Point elements are integers in the PAGE schema, the converters truncate them to integers anyway
+    return [[int(float(point.get("x"))), int(float(point.get("y")))] for point in element if point.tag.endswith("Point")]
+
+
+def guess_line_heights(line):
+    """Heights of a line without them (e.g. imported from Transkribus), estimated from its polygon by pero_ocr."""
+    from pero_ocr.core.layout import TextLine as PeroTextLine, guess_line_heights_from_polygon
+
+    pero_line = PeroTextLine(id=line.id, baseline=np.asarray(line.baseline),
+                             polygon=np.asarray(line.polygon) if line.polygon is not None else None)
+    guess_line_heights_from_polygon(pero_line, use_center=False, n=len(line.baseline))
+    return pero_line.heights
@@ -0,0 +1,249 @@
+"""Layout of the request files shared by the server and the OCR pipeline, their retention and migration.
+
+Files of a request are stored in a subdirectory of each storage directory named by the first SHARD_LENGTH characters
+of the request ID, e.g. `xmls/3f/3f2a...c1.xml`, so that directories stay small even with millions of requests.
+Flat directories of older versions are converted by:
+
+    python request_storage.py -c config.ini
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+import traceback
+from datetime import datetime
+
+import config_helper
+
+SHARD_LENGTH = 2
+SHARD_CHARACTERS = "0123456789abcdef"
+
+# storage directories of the [requests] section of the server config by their names
+STORAGE_PATHS = {
+    "upload": "upload_path",
+    "result": "result_path",
+    "logits": "logits_path",
+    "errors": "errors_path",
+    "music": "music_path",
+    "tiles": "tiles_path"
+}
+
+# default values of optional storage directories
+STORAGE_DEFAULTS = {
+    "tiles_path": "tiles"
+}
+
+# the pipeline writes all files of a request under its ID, except music files of lines named <request_id>_<line_id>
+SEPARATED_IDS = {"music"}
+
+
+def get_shard_path(directory, request_id):
+    return os.path.join(directory, request_id[:SHARD_LENGTH])
+
+
+def get_file_path(directory, request_id, suffix):
+    return os.path.join(get_shard_path(directory, request_id), request_id + suffix)
+
+
+def make_shard_dirs(path):
+    """Creates the shard directory of the file path, returns the path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def create_shards(directory):
+    """Creates shard directories of all hexadecimal request IDs (generated by the server) in advance, so watchdog
+    watches them before the first file is written there."""
+    for first in SHARD_CHARACTERS:
+        for second in SHARD_CHARACTERS:
+            os.makedirs(os.path.join(directory, first + second), exist_ok=True)
+
+
+def iterate_files(directory):
+    """Yields os.DirEntry objects of all files in the shard directories."""
+    for shard in os.scandir(directory):
+        if shard.is_dir():
+            for entry in os.scandir(shard.path):
+                if entry.is_file():
+                    yield entry
+
+
+def get_request_id(file_name, storage_name=None):
+    request_id = file_name.split(".", 1)[0]
+
+    if storage_name in SEPARATED_IDS:
+        request_id = request_id.split("_", 1)[0]
+
+    return request_id
+
+
+def get_storage_paths(configuration, config_path):
+    """Absolute paths of the storage directories by their names, relative paths are relative to the config file."""
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    return dict((name, os.path.join(config_dir, configuration["requests"].get(key, STORAGE_DEFAULTS.get(key))))
+                for name, key in STORAGE_PATHS.items())
+
+
+class RetentionTask:
+    """Periodically removes (or moves to `archive_path`) files of requests last modified more than `max_age` seconds
+    ago and of the oldest requests while all files take more than `max_size` bytes. Requests still waiting for their
+    result are kept.
+    """
+
+    def __init__(self, storage_paths, jobs, max_age=None, max_size=None, archive_path=None, interval=3600):
+        self.storage_paths = storage_paths
+        self.jobs = jobs
+        self.max_age = max_age
+        self.max_size = max_size
+        self.archive_path = archive_path
+        self.interval = interval
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="retention", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            try:
+                removed, freed = self.run_once()
+                log(f"Removed {removed} requests, freed {freed / 1024 ** 2:.1f} MB")
+            except:
+                log("Exception raised during retention:")
+                log(traceback.format_exc())
+
+            time.sleep(self.interval)
+
+    def run_once(self):
+        requests = self.collect_requests()
+        total_size = sum(request["size"] for request in requests.values())
+        now = time.time()
+
+        removed_ids = []
+        freed = 0
+
+        # oldest first, the order in which requests are removed to fit the size budget
+        for request_id, request in sorted(requests.items(), key=lambda item: item[1]["modified"]):
+            if not request["finished"]:
+                continue
+
+            expired = self.max_age is not None and now - request["modified"] > self.max_age
+            over_budget = self.max_size is not None and total_size - freed > self.max_size
+
+            if not expired and not over_budget:
+                break
+
+            self.remove_request(request)
+            removed_ids.append(request_id)
+            freed += request["size"]
+
+        self.jobs.remove(removed_ids)
+
+        return len(removed_ids), freed
+
+    def collect_requests(self):
+        requests = {}
+
+        for storage_name, directory in self.storage_paths.items():
+            if not os.path.isdir(directory):
+                continue
+
+            for entry in iterate_files(directory):
+                request_id = get_request_id(entry.name, storage_name)
+                request = requests.get(request_id)
+                if request is None:
+                    request = {"files": [], "size": 0, "modified": 0.0, "image": False, "result": False}
+                    requests[request_id] = request
+
+                stat = entry.stat()
+                request["files"].append((storage_name, entry.path))
+                request["size"] += stat.st_size
+                request["modified"] = max(request["modified"], stat.st_mtime)
+
+                if storage_name == "upload":
+                    request["image"] = True
+                elif storage_name in {"result", "errors"} and entry.name.endswith((".xml", ".txt")):
+                    request["result"] = True
+
+        # a request with an uploaded image is in progress until the result or error file exists
+        for request in requests.values():
+            request["finished"] = request["result"] or not request["image"]
+
+        return requests
+
+    def remove_request(self, request):
+        for storage_name, path in request["files"]:
+            try:
+                if self.archive_path is None:
+                    os.remove(path)
+                else:
+                    shard_name = os.path.basename(os.path.dirname(path))
+                    archive_path = make_shard_dirs(os.path.join(self.archive_path, storage_name, shard_name,
+                                                                os.path.basename(path)))
+                    shutil.move(path, archive_path)
+
+            except FileNotFoundError:
+                pass
+
+
+def create_retention_task(configuration, config_path, jobs):
+    """Creates the task from the optional [retention] section of the server configuration, None if not configured."""
+    retention_config = configuration.get("retention")
+    if not retention_config:
+        return None
+
+    max_age_hours = retention_config.get("max_age_hours")
+    max_size_mb = retention_config.get("max_size_mb")
+    archive_path = retention_config.get("archive_path")
+
+    if archive_path is not None:
+        archive_path = os.path.join(os.path.dirname(os.path.abspath(config_path)), archive_path)
+
+    return RetentionTask(get_storage_paths(configuration, config_path), jobs,
+                         max_age=max_age_hours * 3600 if max_age_hours is not None else None,
+                         max_size=max_size_mb * 1024 ** 2 if max_size_mb is not None else None,
+                         archive_path=archive_path,
+                         interval=retention_config.get("interval", 3600))
+
+
+def migrate_directory(directory, storage_name=None):
+    """Moves files from the top level of the directory to their shard directories, returns the number of moved files."""
+    moved = 0
+
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            request_id = get_request_id(entry.name, storage_name)
+            os.replace(entry.path, make_shard_dirs(os.path.join(get_shard_path(directory, request_id), entry.name)))
+            moved += 1
+
+    return moved
+
+
+def log(message, log_source="RETENTION"):
+    print(f"[{log_source}|{datetime.utcnow()}] {message}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Moves request files of flat storage directories to shard directories.")
+    parser.add_argument('-c', '--config-file', help='Path to server config file.', required=True)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_arguments()
+    configuration = config_helper.parse_configuration(args.config_file)
+
+    for storage_name, directory in get_storage_paths(configuration, args.config_file).items():
+        if os.path.isdir(directory):
+            moved = migrate_directory(directory, storage_name)
+            log(f"Moved {moved} files in {directory}", "MIGRATION")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,47 +1,443 @@
 import os
+import math
 import uuid
 import base64
+import hashlib
+import time
+import socket
 import argparse
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 
 import numpy as np
-from flask import Flask, send_from_directory, send_file, json, request
-
-from pero_ocr.core.layout import PageLayout, RegionLayout
-from pero_ocr.core.confidence_estimation import get_line_confidence
+from flask import Blueprint, Flask, current_app, g, send_from_directory, send_file, json, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 
 import config_helper
+import job_registry
+import metrics
+import page_xml
+from image_tiles import TilesFile
+import request_storage
+import static_assets
+from line_confidences import ConfidencesFile, calculate_line_confidence, calculate_lines_confidences
+
+EXTENSION_NAME = "pero_demo"
+
+# routes are registered on the blueprint, applications are created by create_app
+bp = Blueprint(EXTENSION_NAME, __name__)
+
+# objects of the application handling the current request, see ServerState
+configuration = LocalProxy(lambda: get_state().configuration)
+lines_cache = LocalProxy(lambda: get_state().lines_cache)
+status_notifier = LocalProxy(lambda: get_state().status_notifier)
+jobs = LocalProxy(lambda: get_state().jobs)
+assets = LocalProxy(lambda: get_state().assets)
+server_metrics = LocalProxy(lambda: get_state().metrics)
+
+# JSON responses compressed on the fly for clients accepting compressed responses
+COMPRESSED_ENDPOINTS = {f"{EXTENSION_NAME}.get_lines", f"{EXTENSION_NAME}.get_status", f"{EXTENSION_NAME}.wait_status"}
+# a low level is much faster than the maximal one and compresses JSON almost as well
+DYNAMIC_COMPRESSION_LEVELS = {"br": 4, "gzip": 6}
+# seconds a rejected client should wait before uploading again, when there is no history to estimate it from
+DEFAULT_RETRY_AFTER = 30
+# seconds before the next /wait_status of a client which was not allowed to wait
+WAIT_STATUS_RETRY_AFTER = 2
+# seconds after which a queued job without an uploaded image is failed (e.g. the server stopped during its upload)
+ORPHANED_JOB_TIMEOUT = 600
+# seconds between the checks of queued jobs for orphaned ones in each server process
+ORPHANED_JOBS_INTERVAL = 60
+
+
+class ResponseCache:
+    """Bounded LRU cache of serialized responses.
+
+    Entries are stored per request ID together with a signature (modification times of the files the response was
+    built from). A lookup with a different signature is treated as a miss and the stale entry is dropped.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, signature, count=True):
+        """Returns the cached value or None, `count` tells whether the lookup is counted in the hit/miss stats."""
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] != signature:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += count
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += count
+            return entry[1]
+
+    def put(self, key, signature, value):
+        if self.max_entries <= 0 or len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (signature, value)
+            self._size += len(value)
+
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._size
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+
+class StatusNotifier(FileSystemEventHandler):
+    """Wakes up requests waiting in /wait_status when the OCR pipeline creates a result or an error file."""
+
+    statuses = {
+        ".xml": 200,
+        ".txt": 500
+    }
+
+    def __init__(self, max_waiters=None):
+        self.max_waiters = max_waiters
+        self._waiting = 0
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.notify_file(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.notify_file(event.dest_path)
+
+    def notify_file(self, path):
+        _, extension = os.path.splitext(path)
+        if extension in self.statuses:
+            self.notify(get_file_id(path), self.statuses[extension])
+
+    def notify(self, request_id, status):
+        with self._lock:
+            waiters = self._events.get(request_id)
+            if waiters is not None:
+                waiters[2] = status
+                waiters[0].set()
+
+    def wait(self, request_id, get_request_status, timeout):
+        """Returns the status of the request once it is finished or the timeout passes, None without waiting if
+        `max_waiters` requests are waiting already, so that they do not occupy all threads of the server."""
+        status = get_request_status(request_id)
+        if status != 202:
+            return status
+
+        waiters = self._register(request_id)
+        if waiters is None:
+            return None
+
+        try:
+            deadline = time.monotonic() + timeout
+            # check again after registration so that a notification sent in between is not missed
+            status = get_request_status(request_id)
+
+            while status == 202:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not waiters[0].wait(remaining):
+                    break
+
+                # the created file tells the status even before the pipeline updates the job registry
+                waiters[0].clear()
+                status = waiters[2] if waiters[2] is not None else get_request_status(request_id)
+
+        finally:
+            self._unregister(request_id)
+
+        return status
+
+    def _register(self, request_id):
+        with self._lock:
+            if self.max_waiters is not None and self._waiting >= self.max_waiters:
+                return None
+
+            self._waiting += 1
+            waiters = self._events.get(request_id)
+            if waiters is None:
+                waiters = [threading.Event(), 0, None]
+                self._events[request_id] = waiters
+            waiters[1] += 1
+            return waiters
+
+    def _unregister(self, request_id):
+        with self._lock:
+            self._waiting -= 1
+            waiters = self._events[request_id]
+            waiters[1] -= 1
+            if waiters[1] == 0:
+                del self._events[request_id]
+
+
+class ServerMetrics:
+    """Metrics of one server process. Other processes (gunicorn workers, OCR pipeline workers) share theirs through
+    snapshot files in the metrics directory."""
+
+    def __init__(self, lines_cache, path, interval):
+        self.lines_cache = lines_cache
+        self.path = path
+        self.interval = interval
+        self.registry = metrics.MetricsRegistry()
+
+        self.request_duration = self.registry.histogram(
+            "pero_http_request_duration_seconds", "Time of handling HTTP requests.", ["endpoint", "method", "status"])
+        self.get_lines_duration = self.registry.histogram(
+            "pero_get_lines_stage_seconds", "Time spent in stages of building /get_lines responses.", ["stage"])
+        self.cache_lookups = self.registry.counter(
+            "pero_lines_cache_lookups_total", "Lookups in the /get_lines cache by their result.", ["result"])
+        self.cache_entries = self.registry.gauge(
+            "pero_lines_cache_entries", "Number of responses in the /get_lines cache.")
+        self.cache_bytes = self.registry.gauge(
+            "pero_lines_cache_bytes", "Size of the responses in the /get_lines cache.")
+        self.rejected_uploads = self.registry.counter(
+            "pero_uploads_rejected_total", "Uploads rejected by the admission control by the reason.", ["reason"])
+
+        self.process = f"server-{socket.gethostname()}-{os.getpid()}"
+        self.writer = metrics.SnapshotWriter(self.registry, os.path.join(path, self.process + metrics.SNAPSHOT_EXTENSION),
+                                             {"process": self.process}, interval, self.collect)
+
+    def collect(self):
+        cache_stats = self.lines_cache.stats()
+        self.cache_lookups.set(cache_stats["hits"], result="hit")
+        self.cache_lookups.set(cache_stats["misses"], result="miss")
+        self.cache_entries.set(cache_stats["entries"])
+        self.cache_bytes.set(cache_stats["bytes"])
+
+    def get_families(self):
+        """Metric families of this process and of the other processes which updated their snapshots recently."""
+        self.collect()
+        families = self.registry.snapshot({"process": self.process})
+        families.extend(metrics.load_snapshots(self.path, max_age=3 * self.interval, exclude=self.writer.path))
+        return families
+
+
+class ServerState:
+    """Configuration and shared objects of one server application, stored in its `extensions`.
+
+    Each process (e.g. each gunicorn worker) creates its own state, including the watchdog observer waking up the
+    requests waiting in /wait_status.
+    """
+
+    def __init__(self, configuration, root_path, max_status_waiters=None):
+        self.configuration = configuration
+        self.lines_cache = create_lines_cache(configuration)
+        self.assets = static_assets.StaticAssets(root_path)
+        self.jobs = job_registry.JobRegistry(configuration["requests"]["jobs_path"])
+        self.orphaned_jobs_checked = 0.0
+        self.status_notifier = StatusNotifier(configuration["requests"].get("wait_status_max_waiters", max_status_waiters))
+        self.metrics = ServerMetrics(self.lines_cache, configuration["metrics"]["path"],
+                                     configuration["metrics"].get("interval", 15))
+
+        self.observer = Observer()
+        self.observer.schedule(self.status_notifier, path=configuration["requests"]["result_path"], recursive=True)
+        self.observer.schedule(self.status_notifier, path=configuration["requests"]["errors_path"], recursive=True)
+
+    def start(self):
+        self.observer.start()
+        self.metrics.writer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+        self.metrics.writer.remove()
+
+
+def get_state():
+    return current_app.extensions[EXTENSION_NAME]
+
+
+def create_app(config_path, max_status_waiters=None):
+    """Creates the WSGI application serving requests of the server config file. `max_status_waiters` is the default
+    of the `wait_status_max_waiters` option."""
+    configuration = config_helper.parse_configuration(config_path)
+    make_absolute_paths(configuration, os.path.abspath(config_path))
+
+    create_dirs(configuration["requests"]["upload_path"])
+    create_dirs(configuration["requests"]["result_path"])
+    create_dirs(configuration["requests"]["logits_path"])
+    create_dirs(configuration["requests"]["errors_path"])
+
+    # watched directories have all shards created in advance, so no event in a new shard directory is missed
+    request_storage.create_shards(configuration["requests"]["upload_path"])
+    request_storage.create_shards(configuration["requests"]["result_path"])
+    request_storage.create_shards(configuration["requests"]["errors_path"])
+
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+
+    # behind reverse proxies, the client address (the key of max_client_jobs) is taken from X-Forwarded-For
+    trusted_proxies = configuration.get("admission", {}).get("trusted_proxies", 0)
+    if trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(trusted_proxies))
+
+    state = ServerState(configuration, app.root_path, max_status_waiters)
+    app.extensions[EXTENSION_NAME] = state
 
-configuration = None
-app = Flask(__name__)
+    with app.app_context():
+        # rejects oversized multipart and JSON uploads before they are parsed, with some space for the form and encoding
+        app.config["MAX_CONTENT_LENGTH"] = get_max_upload_size() * 2
+
+    state.start()
+
+    return app
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config-file', required=True, help='Path to configuration file.')
+    parser.add_argument('--workers', help='Number of server processes (gunicorn), 0 for the Flask development server.', type=int, default=0)
+    parser.add_argument('--threads', help='Number of threads of each server process, half of them may wait in /wait_status.', type=int, default=16)
     args = parser.parse_args()
     return args
 
 
-@app.route('/', defaults={'filename': 'index.html'})
-@app.route('/<path:filename>')
+@bp.route('/', defaults={'filename': 'index.html'})
+@bp.route('/<path:filename>')
 def application(filename):
-    return send_from_directory('./', filename)
+    asset = assets.get(filename)
+
+    if asset is None:
+        return send_from_directory('./', filename)
+
+    encoding = static_assets.choose_encoding(request.accept_encodings, asset.variants)
 
+    response = current_app.response_class(
+        response=asset.variants[encoding] if encoding is not None else asset.data,
+        status=200,
+        mimetype=asset.mimetype
+    )
+
+    # each encoding is a different representation and needs its own ETag
+    response.set_etag(asset.version if encoding is None else f"{asset.version}-{encoding}")
+    response.vary.add("Accept-Encoding")
+    response.content_encoding = encoding
+
+    # URLs with the current version (as referenced from index.html) never change, others are revalidated
+    if request.args.get("v") == asset.version:
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+
+    return response.make_conditional(request)
+
+
+@bp.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+
+# registered before compress_response, so it runs after it and the measured time includes the compression
+@bp.after_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        endpoint = request.endpoint.rsplit(".", 1)[-1] if request.endpoint is not None else "none"
+        server_metrics.request_duration.observe(time.monotonic() - started, endpoint=endpoint, method=request.method,
+                                                status=response.status_code)
+
+    return response
+
+
+@bp.after_request
+def compress_response(response):
+    if request.endpoint not in COMPRESSED_ENDPOINTS or response.direct_passthrough or response.content_encoding:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+
+    encoding = static_assets.choose_encoding(request.accept_encodings)
+    if encoding is not None and len(data) >= static_assets.MIN_COMPRESSED_SIZE:
+        response.set_data(static_assets.compress(data, encoding, DYNAMIC_COMPRESSION_LEVELS[encoding]))
+        response.content_encoding = encoding
+
+    return response
 
-@app.route('/upload_image', methods=["POST"])
+
+@bp.route('/upload_image', methods=["POST"])
 def upload_image():
-    encoded_image = request.json["image"]
+    priority = request.args.get("priority", job_registry.INTERACTIVE)
+    if priority not in job_registry.PRIORITIES:
+        return current_app.response_class(
+            response=json.dumps({"error": f"Unknown priority, use one of: {', '.join(job_registry.PRIORITIES)}."}),
+            status=400,
+            mimetype='application/json'
+        )
+
+    client = request.remote_addr
+
+    rejection = check_admission(priority, client)
+    if rejection is not None:
+        return rejection
 
     request_id = uuid.uuid4().hex
-    image_file_path = get_image_path(request_id)
-    save_image_result = save_encoded_image(encoded_image, image_file_path)
 
-    if not save_image_result:
+    # the job is registered before the image is saved, the pipeline may start processing it right away
+    jobs.add(request_id, priority=priority, client=client)
+
+    try:
+        if request.mimetype == "application/json":
+            # images encoded as data URLs, kept for compatibility with older clients
+            save_image_result = save_encoded_image(request.json["image"], request_id)
+
+        elif request.mimetype == "multipart/form-data":
+            image_file = request.files.get("image")
+            save_image_result = save_image_stream(image_file.stream, request_id) if image_file is not None else None
+
+        else:
+            save_image_result = save_image_stream(request.stream, request_id)
+
+        if save_image_result:
+            publish_image(request_id, *save_image_result)
+        else:
+            save_error_file(request_id)
+            jobs.fail(request_id)
+
+    except:
+        # e.g. a too large upload, malformed JSON or a client disconnected in the middle of the upload, the job must
+        # not stay queued
+        remove_partial_image(request_id)
         save_error_file(request_id)
+        jobs.fail(request_id)
+        raise
 
-    data = {"request_id": request_id}
-    response = app.response_class(
+    data = {"request_id": request_id, "priority": priority}
+    response = current_app.response_class(
         response=json.dumps(data),
         status=200,
         mimetype='application/json'
@@ -49,15 +445,185 @@ def upload_image():
     return response
 
 
-@app.route('/get_image/<string:request_id>')
+def check_admission(priority, client):
+    """Returns the error response if the upload exceeds a limit of the optional [admission] section, None if it is
+    accepted."""
+    admission_config = configuration.get("admission")
+    if not admission_config:
+        return None
+
+    fail_orphaned_jobs(admission_config.get("orphaned_job_timeout", ORPHANED_JOB_TIMEOUT))
+
+    max_client_jobs = admission_config.get("max_client_jobs")
+    if max_client_jobs is not None and jobs.get_client_jobs(client) >= max_client_jobs:
+        duration = jobs.get_average_duration()
+        return reject_upload("client_limit", 429, f"Too many unfinished uploads, at most {max_client_jobs} are allowed.",
+                             duration if duration is not None else DEFAULT_RETRY_AFTER)
+
+    # interactive uploads are processed first, so only uploads of the same or a higher priority are ahead of them
+    queue_position = jobs.get_queue_position(priority)
+
+    max_queue_length = admission_config.get(f"max_{priority}_queue_length", admission_config.get("max_queue_length"))
+    if max_queue_length is not None and queue_position >= max_queue_length:
+        retry_after = jobs.estimate_wait_time(queue_position - max_queue_length + 1)
+        return reject_upload("queue_length", 503, "The queue is full, try it again later.",
+                             retry_after if retry_after is not None else DEFAULT_RETRY_AFTER)
+
+    max_wait_time = admission_config.get(f"max_{priority}_wait_time", admission_config.get("max_wait_time"))
+    if max_wait_time is not None:
+        wait_time = jobs.estimate_wait_time(queue_position)
+        if wait_time is not None and wait_time > max_wait_time:
+            return reject_upload("wait_time", 503, "The server is overloaded, try it again later.",
+                                 wait_time - max_wait_time)
+
+    return None
+
+
+def fail_orphaned_jobs(timeout):
+    """Fails jobs queued for more than `timeout` seconds without an uploaded image and without a part of it written in
+    the last `timeout` seconds, so they do not count for the admission limits forever. Checked at most once per
+    ORPHANED_JOBS_INTERVAL."""
+    state = get_state()
+    now = time.time()
+    if now - state.orphaned_jobs_checked < ORPHANED_JOBS_INTERVAL:
+        return
+
+    state.orphaned_jobs_checked = now
+
+    for request_id in jobs.get_queued(now - timeout):
+        if os.path.isfile(find_image_path(request_id)):
+            continue
+
+        # an upload over a slow connection is still being written
+        try:
+            if now - os.path.getmtime(get_image_path(request_id, "part")) < timeout:
+                continue
+        except FileNotFoundError:
+            pass
+
+        remove_partial_image(request_id)
+        save_error_file(request_id)
+        jobs.fail(request_id)
+
+
+def reject_upload(reason, status, message, retry_after):
+    server_metrics.rejected_uploads.inc(reason=reason)
+    retry_after = max(math.ceil(retry_after), 1)
+
+    response = current_app.response_class(
+        response=json.dumps({"error": message, "retry_after": retry_after}),
+        status=status,
+        mimetype='application/json'
+    )
+
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@bp.route('/get_image/<string:request_id>')
 def get_image(request_id):
-    image_file_path = get_image_path(request_id)
+    image_file_path = find_image_path(resolve_request_id(request_id))
     return send_file(image_file_path, as_attachment=True)
 
 
-@app.route('/get_status/<string:request_id>')
+@bp.route('/get_tile/<string:request_id>/<int(signed=True):zoom>/<int:x>/<int:y>')
+def get_tile(request_id, zoom, x, y):
+    return send_tiles_file_image(request_id, lambda tiles_file: tiles_file.get_tile(zoom, x, y))
+
+
+@bp.route('/get_preview/<string:request_id>')
+def get_preview(request_id):
+    return send_tiles_file_image(request_id, lambda tiles_file: tiles_file.get_preview())
+
+
+def send_tiles_file_image(request_id, get_image):
+    try:
+        with TilesFile(get_tiles_path(resolve_request_id(request_id))) as tiles_file:
+            image = get_image(tiles_file)
+    except FileNotFoundError:
+        image = None
+
+    if image is None:
+        return current_app.response_class(
+            status=404
+        )
+
+    response = current_app.response_class(
+        response=image,
+        status=200,
+        mimetype='image/jpeg'
+    )
+
+    # request IDs are never reused, so the images never change
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@bp.route('/get_status/<string:request_id>')
 def get_status(request_id):
-    image_file_path = get_image_path(request_id)
+    job = jobs.get_status(request_id)
+
+    if job is not None and job["state"] in {job_registry.QUEUED, job_registry.PROCESSING}:
+        data = {
+            "state": job["state"],
+            "priority": job["priority"],
+            "queue_position": job["queue_position"],
+            "estimated_start": job["estimated_start"],
+            "eta": job["eta"]
+        }
+
+        response = current_app.response_class(
+            response=json.dumps(data),
+            status=202,
+            mimetype='application/json'
+        )
+
+    else:
+        response = current_app.response_class(
+            status=get_request_status(request_id, job),
+        )
+
+    return response
+
+
+@bp.route('/wait_status/<string:request_id>')
+def wait_status(request_id):
+    max_timeout = configuration["requests"].get("wait_status_timeout", 30)
+    timeout = min(request.args.get("timeout", default=max_timeout, type=float), max_timeout)
+
+    status = status_notifier.wait(request_id, get_request_status, timeout)
+
+    if status is None:
+        # too many requests are waiting in this process, the client checks again later instead of occupying a thread
+        response = current_app.response_class(
+            status=202
+        )
+        response.headers["Retry-After"] = str(WAIT_STATUS_RETRY_AFTER)
+        return response
+
+    response = current_app.response_class(
+        status=status,
+    )
+
+    return response
+
+
+def get_request_status(request_id, job=None):
+    job_states = {
+        job_registry.QUEUED: 202,
+        job_registry.PROCESSING: 202,
+        job_registry.DONE: 200,
+        job_registry.FAILED: 500
+    }
+
+    if job is None:
+        job = jobs.get(request_id)
+
+    if job is not None:
+        return job_states[job["state"]]
+
+    # requests uploaded before the job registry was introduced
+    image_file_path = find_image_path(request_id)
     xml_file_path = get_xml_path(request_id)
     error_file_path = get_errors_path(request_id)
 
@@ -71,129 +637,282 @@ def get_status(request_id):
 
     if os.path.isfile(xml_file_path):
         status = 200
-    
-    response = app.response_class(
-        status=status,
-    )
 
-    return response
+    return status
 
 
-@app.route('/get_lines/<string:request_id>')
+@bp.route('/get_lines/<string:request_id>')
 def get_lines(request_id):
-    xml_file_path = get_xml_path(request_id)
-    logits_file_path = get_logits_path(request_id)
+    # duplicate uploads share the result files of the first upload of the image
+    result_id = resolve_request_id(request_id)
+    xml_file_path = get_xml_path(result_id)
+    confidences_file_path = get_confidences_path(result_id)
+    logits_file_path = get_logits_path(result_id)
+    pending_captions_file_path = get_pending_captions_path(result_id)
+    tiles_file_path = get_tiles_path(result_id)
+    music_manifest_file_path = get_music_manifest_path(result_id)
+
+    # the pending captions file is removed when the pipeline adds the captions to the XML, which invalidates the cache
+    signature = get_files_signature(xml_file_path, confidences_file_path, logits_file_path, pending_captions_file_path,
+                                    tiles_file_path, music_manifest_file_path)
+
+    if signature[0] is None:
+        return current_app.response_class(
+            status=404
+        )
+
+    data = lines_cache.get(request_id, signature)
+
+    if data is None:
+        stage_duration = server_metrics.get_lines_duration
+
+        if signature[1] is not None:
+            with stage_duration.time(stage="parse"):
+                page_layout = page_xml.read_page(xml_file_path)
+            with stage_duration.time(stage="convert"), ConfidencesFile(confidences_file_path) as line_confidences:
+                lines = convert_lines_batch(page_layout, line_confidences)
+        else:
+            # results processed before confidences files were introduced need pero_ocr to read the logits
+            from pero_ocr.core.layout import PageLayout
+
+            with stage_duration.time(stage="parse"):
+                page_layout = PageLayout(file=xml_file_path)
+            with stage_duration.time(stage="load_logits"):
+                page_layout.load_logits(logits_file_path)
+            with stage_duration.time(stage="convert"):
+                lines = convert_lines_batch(page_layout)
 
-    if xml_file_path:
-        page_layout = PageLayout(file=xml_file_path)
         height, width = page_layout.page_size
 
-        page_layout.load_logits(logits_file_path)
+        pending_captions = load_pending_captions(pending_captions_file_path) if signature[3] is not None else []
+        mark_pending_captions(lines, pending_captions)
+
+        # results processed before tile pyramids were introduced are shown from the full image
+        tiles = None
+        if signature[4] is not None:
+            with TilesFile(tiles_file_path) as tiles_file:
+                tiles = tiles_file.info()
+
+        # None for results processed before music manifests were introduced, their music files have to be probed
+        music = load_music_manifest(music_manifest_file_path) if signature[5] is not None else None
+
+        with stage_duration.time(stage="encode"):
+            data = json.dumps({
+                "image_id": request_id,
+                "width": width,
+                "height": height,
+                "lines": lines,
+                "pending_captions": pending_captions,
+                "tiles": tiles,
+                "music": music
+            }).encode("utf-8")
+
+        lines_cache.put(request_id, signature, data)
+
+    response = current_app.response_class(
+        response=data,
+        status=200,
+        mimetype='application/json'
+    )
 
-        lines = convert_lines(page_layout)
+    # compressed responses are cached as well, dense pages have megabytes of JSON
+    encoding = static_assets.choose_encoding(request.accept_encodings)
+    if encoding is not None and len(data) >= static_assets.MIN_COMPRESSED_SIZE:
+        # lookups of the compressed variants are not counted, each /get_lines is counted once by the lookup above
+        compressed_data = lines_cache.get((request_id, encoding), signature, count=False)
 
-        data = {
-            "image_id": request_id,
-            "width": width,
-            "height": height,
-            "lines": lines
-        }
+        if compressed_data is None:
+            with server_metrics.get_lines_duration.time(stage="compress"):
+                compressed_data = static_assets.compress(data, encoding, DYNAMIC_COMPRESSION_LEVELS[encoding])
+            lines_cache.put((request_id, encoding), signature, compressed_data)
 
-        response = app.response_class(
-            response=json.dumps(data),
-            status=200,
-            mimetype='application/json'
-        )
+        response.set_data(compressed_data)
+        response.content_encoding = encoding
+
+    return response
 
-    else:
-        response = app.response_class(
-            status=404
-        )        
 
+@bp.route('/get_cache_stats')
+def get_cache_stats():
+    response = current_app.response_class(
+        response=json.dumps(dict(lines_cache.stats(), deduplication=jobs.get_deduplication_stats())),
+        status=200,
+        mimetype='application/json'
+    )
     return response
 
 
-@app.route('/get_music/<string:request_id>', defaults={'line_id': None})
-@app.route('/get_music/<string:request_id>/<string:line_id>')
+@bp.route('/metrics')
+def get_metrics():
+    families = server_metrics.get_families() + get_jobs_metric_families()
+
+    response = current_app.response_class(
+        response=metrics.render(families),
+        status=200,
+        mimetype='text/plain; version=0.0.4'
+    )
+    return response
+
+
+def get_jobs_metric_families():
+    """Metrics of the job registry, shared by all processes, so they are collected on each request."""
+    registry = metrics.MetricsRegistry()
+
+    job_states = registry.gauge("pero_jobs", "Number of jobs in the job registry by their state.", ["state"])
+    counts = jobs.get_counts()
+    for state in (job_registry.QUEUED, job_registry.PROCESSING, job_registry.DONE, job_registry.FAILED):
+        job_states.set(counts.get(state, 0), state=state)
+
+    average_duration = registry.gauge("pero_jobs_average_duration_seconds",
+                                      "Average processing time of the recently finished jobs.")
+    average_duration.set(jobs.get_average_duration() or 0.0)
+
+    return registry.snapshot()
+
+
+@bp.route('/get_jobs_history')
+def get_jobs_history():
+    period = request.args.get("period", default=3600, type=float)
+    bucket_size = request.args.get("bucket", default=60, type=float)
+
+    response = current_app.response_class(
+        response=json.dumps(jobs.get_history(period, bucket_size)),
+        status=200,
+        mimetype='application/json'
+    )
+    return response
+
+
+@bp.route('/get_music/<string:request_id>', defaults={'line_id': None})
+@bp.route('/get_music/<string:request_id>/<string:line_id>')
 def get_music(request_id, line_id):
-    midi_file_path = get_midi_path(request_id, line_id)
+    midi_file_path = get_midi_path(resolve_request_id(request_id), line_id)
 
     if os.path.isfile(midi_file_path):
         return send_file(midi_file_path)
     else:
-        return app.response_class(
+        return current_app.response_class(
             status=204
         )
 
 
-def get_image_path(request_id):
-    return os.path.join(configuration["requests"]["upload_path"], f"{request_id}.jpg")
+@bp.route('/get_music_status/<string:request_id>')
+def get_music_status(request_id):
+    music = load_music_manifest(get_music_manifest_path(resolve_request_id(request_id)))
+
+    if music is None:
+        return current_app.response_class(
+            status=404
+        )
+
+    response = current_app.response_class(
+        response=json.dumps(music),
+        status=200,
+        mimetype='application/json'
+    )
+    return response
+
+
+def load_music_manifest(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def get_image_path(request_id, extension="jpg"):
+    return request_storage.get_file_path(configuration["requests"]["upload_path"], request_id, f".{extension}")
+
+
+def find_image_path(request_id):
+    for extension in IMAGE_EXTENSIONS:
+        image_file_path = get_image_path(request_id, extension)
+        if os.path.isfile(image_file_path):
+            return image_file_path
+
+    return get_image_path(request_id)
 
 
 def get_xml_path(request_id):
-    return os.path.join(configuration["requests"]["result_path"], f"{request_id}.xml")
+    return request_storage.get_file_path(configuration["requests"]["result_path"], request_id, ".xml")
 
 
 def get_logits_path(request_id):
-    return os.path.join(configuration["requests"]["logits_path"], f"{request_id}.logits")
+    return request_storage.get_file_path(configuration["requests"]["logits_path"], request_id, ".logits")
+
+
+def get_confidences_path(request_id):
+    return request_storage.get_file_path(configuration["requests"]["logits_path"], request_id, ".conf")
+
+
+def get_pending_captions_path(request_id):
+    return request_storage.get_file_path(configuration["requests"]["result_path"], request_id, ".captions")
+
+
+def get_tiles_path(request_id):
+    return request_storage.get_file_path(configuration["requests"]["tiles_path"], request_id, ".tiles")
 
 
 def get_errors_path(request_id):
-    return os.path.join(configuration["requests"]["errors_path"], f"{request_id}.txt")
+    return request_storage.get_file_path(configuration["requests"]["errors_path"], request_id, ".txt")
 
 
 def get_midi_path(request_id, line_id=None):
-    file_name = f"{request_id}.mid" if line_id is None else f"{request_id}_{line_id}.mid"
-    return os.path.join(configuration["requests"]["music_path"], file_name)
+    suffix = ".mid" if line_id is None else f"_{line_id}.mid"
+    return request_storage.get_file_path(configuration["requests"]["music_path"], request_id, suffix)
+
+
+def get_music_manifest_path(request_id):
+    return request_storage.get_file_path(configuration["requests"]["music_path"], request_id, ".music.json")
 
 
 def get_music_xml_path(request_id):
-    return os.path.join(configuration["requests"]["music_path"], f"{request_id}.xml")
+    return request_storage.get_file_path(configuration["requests"]["music_path"], request_id, ".xml")
 
 
-def convert_lines(page_layout):
-    lines = []
+def get_files_signature(*paths):
+    signature = []
 
-    counts = defaultdict(int)
-    converters = {
-        "Obrázek": (convert_image, "image"),
-        "Kreslený humor/karikatura/komiks": (convert_image, "image"),
+    for path in paths:
+        try:
+            signature.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            signature.append(None)
 
-        "Fotografie": (convert_photo, "photo"),
+    return tuple(signature)
 
-        "Graf": (convert_graph, "graph"),
 
-        "Iniciála": (convert_initial, "initial"),
+def load_pending_captions(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        # the captions were completed in the meantime
+        return []
 
-        "Mapa": (convert_map, "map"),
 
-        "Ozdobný nápis": (convert_decorative_text, "decorative_text"),
+def mark_pending_captions(lines, pending_captions):
+    pending_captions = set(pending_captions)
 
-        "Razítko": (convert_stamp, "stamp"),
+    for line in lines:
+        if line["id"] in pending_captions:
+            line["caption_pending"] = True
 
-        "QR a čárový kód": (convert_code, "code"),
 
-        "Schéma": (convert_schema, "schema"),
-        "Půdorys": (convert_schema, "schema"),
-        "Ostatní výkresy": (convert_schema, "schema"),
-        "Geometrické výkresy": (convert_schema, "schema"),
+def convert_lines(page_layout, line_confidences=None):
+    lines = []
 
-        "Erb/cejch/logo/symbol": (convert_other, "other"),
-        "Ex libris": (convert_other, "other"),
-        "Ostatní knižní dekor": (convert_other, "other"),
-        "Signet": (convert_other, "other"),
-        "Viněta": (convert_other, "other"),
-        "Vlys": (convert_other, "other"),
-    }
+    counts = defaultdict(int)
 
     for region in page_layout.regions:
         if region.category in {"text", None}:
             for line in region.lines:
                 if line.category in {"text", None}:
-                    lines.append(convert_line(line))
+                    lines.append(convert_line(line, line_confidences))
 
-        elif region.category in converters:
-            converter, category = converters[region.category]
+        elif region.category in REGION_CONVERTERS:
+            converter, category = REGION_CONVERTERS[region.category]
             counts[category] += 1
             lines.append(converter(region, counts[category]))
 
@@ -203,13 +922,84 @@ def convert_lines(page_layout):
     return lines
 
 
-def convert_line(line):
+def convert_lines_batch(page_layout, line_confidences=None):
+    """Produces the same output as convert_lines, but converts all text lines of the page at once."""
+    lines = []
+    text_lines = []
+    text_lines_positions = []
+
+    counts = defaultdict(int)
+
+    for region in page_layout.regions:
+        if region.category in {"text", None}:
+            for line in region.lines:
+                if line.category in {"text", None}:
+                    text_lines_positions.append(len(lines))
+                    text_lines.append(line)
+                    lines.append(None)
+
+        elif region.category in REGION_CONVERTERS:
+            converter, category = REGION_CONVERTERS[region.category]
+            counts[category] += 1
+            lines.append(converter(region, counts[category]))
+
+        elif region.category == "Notový zápis":
+            lines.append(convert_music(region))
+
+    for position, line in zip(text_lines_positions, convert_text_lines(text_lines, line_confidences)):
+        lines[position] = line
+
+    return lines
+
+
+def convert_text_lines(text_lines, line_confidences=None):
+    if len(text_lines) == 0:
+        return []
+
+    transcriptions = [line.transcription if line.transcription is not None else "" for line in text_lines]
+
+    polygons = [np.asarray(line.polygon).reshape(-1, 2) for line in text_lines]
+    points = np.concatenate(polygons).astype(np.int64).tolist()
+    points_offsets = np.cumsum([0] + [len(polygon) for polygon in polygons]).tolist()
+
+    if line_confidences is not None:
+        confidences = line_confidences.get_batch([line.id for line in text_lines])
+        confidences = [line_confidence if line_confidence is not None else [1.0] * len(transcription)
+                       for line_confidence, transcription in zip(confidences, transcriptions)]
+    else:
+        confidences = calculate_lines_confidences(text_lines)
+
+    ligatures_mapping = [[x] for x in range(max(len(transcription) for transcription in transcriptions))]
+
+    lines = []
+    for i, line in enumerate(text_lines):
+        lines.append({
+            "id": line.id,
+            "text": line.transcription,
+            "np_points": points[points_offsets[i]:points_offsets[i + 1]],
+            "np_heights": list(line.heights),
+            "np_confidences": confidences[i],
+            "ligatures_mapping": ligatures_mapping[:len(transcriptions[i])],
+            "category": "text"
+        })
+
+    return lines
+
+
+def convert_line(line, line_confidences=None):
+    if line_confidences is not None:
+        confidences = line_confidences.get(line.id)
+        if confidences is None:
+            confidences = [1.0] * len(line.transcription or "")
+    else:
+        confidences = calculate_line_confidence(line)
+
     return {
         "id": line.id,
         "text": line.transcription,
         "np_points": [[int(coordinates[0]), int(coordinates[1])] for coordinates in line.polygon],
         "np_heights": list(line.heights),
-        "np_confidences": calculate_line_confidence(line),
+        "np_confidences": confidences,
         "ligatures_mapping": [[x] for x in range(len(line.transcription))],
         "category": "text"
     }
@@ -259,9 +1049,46 @@ def convert_other(region, index):
     return convert_region_object(region, "other", text=f"[Other object #{index}]")
 
 
+IMAGE_EXTENSIONS = ("jpg", "png")
+# bytes needed to detect the image type, the length of the PNG signature
+IMAGE_SIGNATURE_SIZE = 8
+
+REGION_CONVERTERS = {
+    "Obrázek": (convert_image, "image"),
+    "Kreslený humor/karikatura/komiks": (convert_image, "image"),
+
+    "Fotografie": (convert_photo, "photo"),
+
+    "Graf": (convert_graph, "graph"),
+
+    "Iniciála": (convert_initial, "initial"),
+
+    "Mapa": (convert_map, "map"),
+
+    "Ozdobný nápis": (convert_decorative_text, "decorative_text"),
+
+    "Razítko": (convert_stamp, "stamp"),
+
+    "QR a čárový kód": (convert_code, "code"),
+
+    "Schéma": (convert_schema, "schema"),
+    "Půdorys": (convert_schema, "schema"),
+    "Ostatní výkresy": (convert_schema, "schema"),
+    "Geometrické výkresy": (convert_schema, "schema"),
+
+    "Erb/cejch/logo/symbol": (convert_other, "other"),
+    "Ex libris": (convert_other, "other"),
+    "Ostatní knižní dekor": (convert_other, "other"),
+    "Signet": (convert_other, "other"),
+    "Viněta": (convert_other, "other"),
+    "Vlys": (convert_other, "other"),
+}
+
+
 def convert_region_object(region, category, text="", use_region_transcription=False):
-    y1 = min([point[1] for point in region.polygon])
-    y2 = max([point[1] for point in region.polygon])
+    polygon = np.asarray(region.polygon).reshape(-1, 2)
+    y1 = polygon[:, 1].min()
+    y2 = polygon[:, 1].max()
 
     height = y2 - y1
 
@@ -271,7 +1098,7 @@ def convert_region_object(region, category, text="", use_region_transcription=Fa
     return {
         "id": region.id,
         "text": text,
-        "np_points": [[int(coordinates[0]), int(coordinates[1])] for coordinates in region.polygon],
+        "np_points": polygon.astype(np.int64).tolist(),
         "np_heights": [float(height), 0],
         "np_confidences": [1.0] * len(text),
         "ligatures_mapping": [[x] for x in range(len(text))],
@@ -298,46 +1125,121 @@ def convert_region_object(region, category, text="", use_region_transcription=Fa
 #     }
 
 
-def calculate_line_confidence(line):
-    if line.transcription is not None and line.transcription != "":
-        char_map = dict([(c, i) for i, c in enumerate(line.characters)])
-        c_idx = np.asarray([char_map[c] for c in line.transcription])
-        
-        try:
-            confidences = get_line_confidence(line, c_idx)
-    
-        except ValueError:
-            confidences = np.ones(len(line.transcription))
-    
-    else:
-        confidences = np.array([])
+def save_error_file(request_id):
+    path = request_storage.make_shard_dirs(get_errors_path(request_id))
+    with open(path, 'w') as file:
+        pass
 
-    confidences = [float(confidence) for confidence in confidences]
 
-    return confidences
+def save_encoded_image(encoded_image, request_id):
+    """Saves the data URL encoded image to a temporary file. Returns its extension and SHA-256 hash, None if the
+    data is not a JPEG or PNG image."""
+    decoded_image, extension = decode_image(encoded_image)
 
+    if decoded_image is not None and len(decoded_image) > get_max_upload_size():
+        raise RequestEntityTooLarge()
 
-def save_error_file(request_id):
-    path = get_errors_path(request_id)
-    with open(path, 'w') as file:
+    if decoded_image is None or get_image_extension(decoded_image) != extension:
+        return None
+
+    with open(request_storage.make_shard_dirs(get_image_path(request_id, "part")), "wb") as file:
+        file.write(decoded_image)
+
+    return extension, hashlib.sha256(decoded_image).hexdigest()
+
+
+def save_image_stream(stream, request_id, chunk_size=64 * 1024):
+    """Streams the uploaded image to a temporary file in chunks. Returns its extension and SHA-256 hash, None if
+    the data is not a JPEG or PNG image."""
+    max_size = get_max_upload_size()
+    tmp_path = request_storage.make_shard_dirs(get_image_path(request_id, "part"))
+
+    digest = hashlib.sha256()
+    extension = None
+    header = b""
+    size = 0
+
+    try:
+        with open(tmp_path, "wb") as file:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+
+                if extension is None:
+                    # a read may return fewer bytes than the signature has
+                    header += chunk
+                    if len(header) < IMAGE_SIGNATURE_SIZE:
+                        continue
+
+                    extension = get_image_extension(header)
+                    if extension is None:
+                        break
+
+                    chunk = header
+
+                size += len(chunk)
+                if size > max_size:
+                    raise RequestEntityTooLarge()
+
+                digest.update(chunk)
+                file.write(chunk)
+
+        if extension is None:
+            remove_partial_image(request_id)
+            return None
+
+    except:
+        remove_partial_image(request_id)
+        raise
+
+    return extension, digest.hexdigest()
+
+
+def remove_partial_image(request_id):
+    try:
+        os.remove(get_image_path(request_id, "part"))
+    except FileNotFoundError:
         pass
 
 
-def save_encoded_image(encoded_image, path):
-    decoded_image, extension = decode_image(encoded_image)
+def publish_image(request_id, extension, image_hash):
+    """Moves the saved image where the OCR pipeline picks it up, or, if an identical image was already processed,
+    makes the request an alias of its results."""
+    tmp_path = get_image_path(request_id, "part")
+
+    original_request_id = None
+    if configuration["requests"].get("deduplicate_uploads", True):
+        original_request_id = jobs.find_image(image_hash)
+
+    if original_request_id is not None:
+        os.remove(tmp_path)
+        jobs.add_alias(request_id, original_request_id, image_hash)
 
-    if decoded_image is not None:
-        save_decoded_image(decoded_image, path)
-        result = True
     else:
-        result = False
+        jobs.set_image_hash(request_id, image_hash)
 
-    return result
+        # renamed only when complete, so the OCR pipeline never sees a partially written image
+        os.replace(tmp_path, get_image_path(request_id, extension))
 
 
-def save_decoded_image(decoded_image, path):
-    with open(path, "wb") as file: 
-        file.write(decoded_image)
+def resolve_request_id(request_id):
+    """ID of the request whose result files hold the results of the request."""
+    return jobs.get_alias(request_id) or request_id
+
+
+def get_image_extension(data):
+    # the real image type is detected from its signature, the declared content type is not trusted
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    elif data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    else:
+        return None
+
+
+def get_max_upload_size():
+    return int(configuration["requests"].get("max_upload_size", 32) * 1024 * 1024)
 
 
 def decode_image(encoded_image):
@@ -364,6 +1266,12 @@ def decode_image(encoded_image):
     return decoded_image, extension
 
 
+def get_file_id(path):
+    file_name = os.path.basename(path)
+    file_id, _ = os.path.splitext(file_name)
+    return file_id
+
+
 def create_dirs(path):
     os.makedirs(path, exist_ok=True)
 
@@ -373,39 +1281,89 @@ def get_absolute_path(config_path, path):
     return os.path.join(config_dir, path)
 
 
-def make_absolute_paths(config_path):
-    global configuration
-
-    configuration["ssl"]["certificate_path"] = get_absolute_path(config_path, configuration["ssl"]["certificate_path"])
-    configuration["ssl"]["private_key_path"] = get_absolute_path(config_path, configuration["ssl"]["private_key_path"])
+def make_absolute_paths(configuration, config_path):
+    if "ssl" in configuration:
+        configuration["ssl"]["certificate_path"] = get_absolute_path(config_path, configuration["ssl"]["certificate_path"])
+        configuration["ssl"]["private_key_path"] = get_absolute_path(config_path, configuration["ssl"]["private_key_path"])
 
     configuration["requests"]["upload_path"] = get_absolute_path(config_path, configuration["requests"]["upload_path"])
     configuration["requests"]["result_path"] = get_absolute_path(config_path, configuration["requests"]["result_path"])
     configuration["requests"]["logits_path"] = get_absolute_path(config_path, configuration["requests"]["logits_path"])
     configuration["requests"]["errors_path"] = get_absolute_path(config_path, configuration["requests"]["errors_path"])
     configuration["requests"]["music_path"] = get_absolute_path(config_path, configuration["requests"]["music_path"])
+    configuration["requests"]["tiles_path"] = get_absolute_path(config_path, configuration["requests"].get("tiles_path", "tiles"))
+    configuration["requests"]["jobs_path"] = get_absolute_path(config_path, configuration["requests"].get("jobs_path", "jobs.sqlite"))
+
+    configuration.setdefault("metrics", {})
+    configuration["metrics"]["path"] = get_absolute_path(config_path, configuration["metrics"].get("path", "metrics"))
+
+
+def create_lines_cache(configuration):
+    max_entries = configuration["requests"].get("lines_cache_size", 256)
+    max_megabytes = configuration["requests"].get("lines_cache_memory", 64)
+    return ResponseCache(max_entries=int(max_entries), max_bytes=int(max_megabytes * 1024 * 1024))
+
+
+def get_ssl_paths(configuration):
+    """Certificate and private key paths, None without the [ssl] section (e.g. behind a TLS terminating proxy)."""
+    if "ssl" not in configuration:
+        return None
+
+    return configuration["ssl"]["certificate_path"], configuration["ssl"]["private_key_path"]
+
+
+def run_production_server(config_path, host, port, workers, threads, ssl_paths, wait_status_timeout):
+    """Runs the application in gunicorn worker processes, each of them creates its own application. At most half of
+    the threads of each worker wait in /wait_status (unless wait_status_max_waiters is configured), the others serve
+    the other requests."""
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{host}:{port}",
+                "workers": workers,
+                "threads": threads,
+                "worker_class": "gthread",
+                # /wait_status requests are held open for up to wait_status_timeout seconds
+                "timeout": wait_status_timeout + 30
+            }
+
+            if ssl_paths is not None:
+                options["certfile"], options["keyfile"] = ssl_paths
+
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return create_app(config_path, max_status_waiters=max(threads // 2, 1))
+
+    ProductionServer().run()
 
 
 def main():
     args = parse_args()
 
-    global configuration
     configuration = config_helper.parse_configuration(args.config_file)
-    make_absolute_paths(os.path.abspath(args.config_file))
+    make_absolute_paths(configuration, os.path.abspath(args.config_file))
 
     host = configuration["common"]["host"]
     port = configuration["common"]["port"]
     debug = configuration["common"]["debug"]
 
-    certificate_path = configuration["ssl"]["certificate_path"]
-    private_key_path = configuration["ssl"]["private_key_path"]
+    ssl_paths = get_ssl_paths(configuration)
 
-    create_dirs(configuration["requests"]["upload_path"])
-    create_dirs(configuration["requests"]["result_path"])
-    create_dirs(configuration["requests"]["logits_path"])
-    create_dirs(configuration["requests"]["errors_path"])
+    if args.workers > 0:
+        run_production_server(args.config_file, host, port, args.workers, args.threads, ssl_paths,
+                              configuration["requests"].get("wait_status_timeout", 30))
+        return
+
+    app = create_app(args.config_file)
 
-    app.run(host=host, port=port, debug=debug, ssl_context=(certificate_path, private_key_path), threaded=True)
+    try:
+        app.run(host=host, port=port, debug=debug, ssl_context=ssl_paths, threaded=True)
+    finally:
+        app.extensions[EXTENSION_NAME].stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+"""Static files of the web application, loaded and compressed once at startup.
+
+Local URLs in index.html get a `?v=<content hash>` suffix, so browsers may cache the referenced files forever
+(`Cache-Control: immutable`) and still load a new version after each change. All assets have content hashed ETags
+and gzip (and brotli, if the `brotli` package is installed) variants of the text files are built in advance.
+"""
+
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# asset files are the files with these extensions in the application directory and in ASSET_DIRECTORIES
+ASSET_EXTENSIONS = {".html", ".js", ".css", ".map", ".png", ".ico", ".svg"}
+ASSET_DIRECTORIES = ("js", "icons")
+COMPRESSIBLE_EXTENSIONS = {".html", ".js", ".css", ".map", ".svg"}
+INDEX = "index.html"
+
+# preferred encodings first
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# smaller responses are sent uncompressed, the savings would not pay for the compression
+MIN_COMPRESSED_SIZE = 1024
+
+URL_ATTRIBUTE = re.compile(r'((?:src|href)=")([^":#?]+)(?:\?[^"#]*)?(")')
+
+
+class StaticAsset:
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.mimetype = mimetype
+        self.version = hashlib.sha256(data).hexdigest()[:16]
+        self.variants = {}
+
+    def compress(self):
+        if len(self.data) < MIN_COMPRESSED_SIZE:
+            return
+
+        for encoding in ENCODINGS:
+            compressed = compress(self.data, encoding)
+            if len(compressed) < len(self.data):
+                self.variants[encoding] = compressed
+
+
+class StaticAssets:
+    """Asset files of the application by their path relative to `root`."""
+
+    def __init__(self, root):
+        self.root = root
+        self.assets = {}
+
+        for path in self.find_files():
+            with open(os.path.join(root, path), "rb") as file:
+                data = file.read()
+
+            mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            self.assets[path] = StaticAsset(data, mimetype)
+
+        # the index refers to the assets by versioned URLs, so it has to be processed after them
+        if INDEX in self.assets:
+            index = self.assets[INDEX]
+            self.assets[INDEX] = StaticAsset(self.add_versions(index.data.decode("utf-8")).encode("utf-8"),
+                                             index.mimetype)
+
+        for path, asset in self.assets.items():
+            if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS:
+                asset.compress()
+
+    def get(self, path):
+        return self.assets.get(path)
+
+    def find_files(self):
+        for entry in os.scandir(self.root):
+            if entry.is_file() and os.path.splitext(entry.name)[1] in ASSET_EXTENSIONS:
+                yield entry.name
+
+        for directory in ASSET_DIRECTORIES:
+            for dir_path, _, file_names in os.walk(os.path.join(self.root, directory)):
+                for file_name in file_names:
+                    if os.path.splitext(file_name)[1] in ASSET_EXTENSIONS:
+                        path = os.path.relpath(os.path.join(dir_path, file_name), self.root)
+                        yield path.replace(os.sep, "/")
+
+    def add_versions(self, html):
+        def add_version(match):
+            asset = self.assets.get(match.group(2).lstrip("/"))
+            if asset is None:
+                return match.group(0)
+
+            return f"{match.group(1)}{match.group(2)}?v={asset.version}{match.group(3)}"
+
+        return URL_ATTRIBUTE.sub(add_version, html)
+
+
+def compress(data, encoding, level=None):
+    """Compresses the data, the maximal compression level is used by default."""
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if level is None else level)
+    else:
+        return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+
+
+def choose_encoding(accept_encodings, encodings=ENCODINGS):
+    """Returns the first of the encodings accepted by the client (werkzeug Accept object), None for no encoding."""
+    for encoding in encodings:
+        if accept_encodings[encoding] > 0:
+            return encoding
+
+    return None
@@ -0,0 +1,247 @@
+"""Parity of the batched /get_lines conversion (convert_lines_batch) with the per-line conversion (convert_lines), and
+the output of both for a fixed page compared with the output of the original implementation in
+data/convert_lines_expected.json.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import page_xml
+import server
+from line_confidences import ConfidencesFile, save_confidences
+
+try:
+    import scipy.sparse
+    from pero_ocr.core.layout import PageLayout, RegionLayout, TextLine
+except ImportError:
+    PageLayout = None
+
+EXPECTED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "convert_lines_expected.json")
+
+CHARACTERS = list(" abcdefghijklmnopqrstuvwxyzáčďéěíňóřšťúůýž0123456789.,")
+
+# region categories of a page in the order they are generated, with None (a text region of older results)
+REGION_CATEGORIES = ["text", "Obrázek", None, "Notový zápis", "Fotografie", "text", "Razítko", "Obrázek", "Schéma",
+                     "unknown", "text"]
+
+
+def create_transcription(rng):
+    return "".join(rng.choice(CHARACTERS) for _ in range(rng.randint(0, 40)))
+
+
+def create_polygon(rng):
+    left, top = rng.uniform(0, 2000), rng.uniform(0, 3000)
+    return [[left + rng.uniform(0, 800), top + rng.uniform(0, 100)] for _ in range(rng.randint(4, 12))]
+
+
+def create_logits(transcription, rng):
+    """Noisy CTC logits with a frame of each character between blank frames."""
+    blank = len(CHARACTERS)
+    labels = dict((character, i) for i, character in enumerate(CHARACTERS))
+
+    logits = np.asarray([[rng.gauss(0.0, 2.0) for _ in range(blank + 1)] for _ in range(2 * len(transcription) + 1)],
+                        dtype=np.float32)
+    logits[0::2, blank] += 4.0
+    for i, character in enumerate(transcription):
+        logits[2 * i + 1, labels[character]] += 4.0
+
+    return logits
+
+
+def create_page_xml_page(rng):
+    regions = []
+
+    for i, category in enumerate(REGION_CATEGORIES):
+        region = page_xml.TextRegion(f"r{i}", category)
+        region.polygon = create_polygon(rng)
+        region.transcription = "caption" if i % 2 else None
+
+        if category in {"text", None}:
+            for j in range(rng.randint(0, 30)):
+                line = page_xml.TextLine(f"r{i}-l{j}", [rng.uniform(5, 30), rng.uniform(2, 10)],
+                                         "text" if j % 7 else None)
+                line.polygon = create_polygon(rng)
+                line.transcription = create_transcription(rng)
+                region.lines.append(line)
+
+        regions.append(region)
+
+    return page_xml.Page("page", (3200, 2800), regions)
+
+
+def create_pero_page_layout(rng):
+    page_layout = PageLayout(id="page", page_size=(3200, 2800))
+
+    for i, category in enumerate(REGION_CATEGORIES):
+        region = RegionLayout(f"r{i}", np.asarray(create_polygon(rng)))
+        region.category = category
+        region.transcription = "caption" if i % 2 else None
+
+        if category in {"text", None}:
+            for j in range(rng.randint(0, 30)):
+                transcription = create_transcription(rng)
+                polygon = np.asarray(create_polygon(rng))
+                line = TextLine(id=f"r{i}-l{j}", baseline=polygon[:2], polygon=polygon,
+                                heights=[rng.uniform(5, 30), rng.uniform(2, 10)], transcription=transcription,
+                                logits=scipy.sparse.csc_matrix(create_logits(transcription, rng)),
+                                characters=CHARACTERS, logit_coords=[0, 100])
+                line.category = "text"
+                region.lines.append(line)
+
+        page_layout.regions.append(region)
+
+    return page_layout
+
+
+# (category, polygon, transcription) of the regions of the fixed page, with fractional coordinates
+FIXED_REGIONS = [
+    ("text", [[10.7, 20.2], [500.5, 20.9], [500, 300.6], [10, 300]], "region text"),
+    ("Obrázek", [[600, 400.5], [900.9, 400], [900, 700.25], [600, 700]], "caption of the image"),
+    ("Obrázek", [[600, 800], [900, 800], [900, 950], [600, 950]], None),
+    ("Kreslený humor/karikatura/komiks", [[10, 1000], [300, 1000], [300, 1200], [10, 1200]], "comics"),
+    ("Fotografie", [[10, 1300], [300, 1300], [300, 1500], [10, 1500]], "photo"),
+    ("Graf", [[10, 1600], [300, 1600], [300, 1700], [10, 1700]], "graph"),
+    ("Iniciála", [[10, 1800], [60, 1800], [60, 1860.5], [10, 1860]], "I"),
+    ("Mapa", [[400, 1000], [700, 1000], [700, 1300], [400, 1300]], "map"),
+    ("Ozdobný nápis", [[400, 1400], [700, 1400], [700, 1450], [400, 1450]], "decorative text"),
+    ("Razítko", [[400, 1500], [450, 1500], [450, 1550], [400, 1550]], "stamp"),
+    ("QR a čárový kód", [[500, 1500], [550, 1500], [550, 1550], [500, 1550]], None),
+    ("Schéma", [[10, 2000], [300, 2000], [300, 2200], [10, 2200]], "schema"),
+    ("Půdorys", [[400, 2000], [700, 2000], [700, 2200], [400, 2200]], None),
+    ("Ostatní výkresy", [[10, 2300], [300, 2300], [300, 2400], [10, 2400]], "drawing"),
+    ("Geometrické výkresy", [[400, 2300], [700, 2300], [700, 2400], [400, 2400]], None),
+    ("Erb/cejch/logo/symbol", [[10, 2500], [100, 2500], [100, 2600], [10, 2600]], "logo"),
+    ("Ex libris", [[200, 2500], [300, 2500], [300, 2600], [200, 2600]], None),
+    ("Ostatní knižní dekor", [[400, 2500], [500, 2500], [500, 2600], [400, 2600]], None),
+    ("Signet", [[600, 2500], [700, 2500], [700, 2600], [600, 2600]], None),
+    ("Viněta", [[800, 2500], [900, 2500], [900, 2600], [800, 2600]], None),
+    ("Vlys", [[1000, 2500], [1100, 2500], [1100, 2600], [1000, 2600]], None),
+    ("Notový zápis", [[10, 2700], [1100, 2700.5], [1100, 2800], [10, 2800]], None),
+    (None, [[10, 2900], [1100, 2900], [1100, 3000], [10, 3000]], None),
+    ("unknown", [[10, 3100], [1100, 3100], [1100, 3150], [10, 3150]], "unknown"),
+    ("Obrázek", [[10, 3200], [100, 3200], [100, 3300], [10, 3300]], "second image"),
+]
+
+# (region index, category, polygon, heights, transcription, confidences) of the text lines of the fixed page
+FIXED_LINES = [
+    (0, "text", [[12.9, 30.1], [480.5, 30], [480, 60.7], [12, 60]], [12, 5], "první řádek",
+     [0.5, 0.625, 1.0, 0.875, 0.75, 1.0, 1.0, 0.125, 0.25, 1.0, 0.5]),
+    (0, None, [[12, 70], [480, 70], [480, 100], [12, 100]], [14.5, 6.0], "ab", [0.25, 0.375]),
+    (0, "text", [[12, 110], [480, 110], [480, 140], [12, 140]], [10.0, 40.0], "", []),
+    (0, "other", [[12, 150], [480, 150], [480, 180], [12, 180]], [10, 4], "skipped", [1.0] * 7),
+    (0, "text", [[12, 190], [480, 190], [480, 220], [12, 220]], [11, 3], "not in the confidences file", None),
+    (22, "text", [[12, 2910], [1000, 2910], [1000, 2950], [12, 2950]], [20.25, 8.5], "x, y.",
+     [0.0, 0.5, 1.0, 0.5, 0.0]),
+]
+
+
+def create_fixed_page():
+    regions = []
+
+    for i, (category, polygon, transcription) in enumerate(FIXED_REGIONS):
+        region = page_xml.TextRegion(f"r{i}", category)
+        region.polygon = polygon
+        region.transcription = transcription
+        regions.append(region)
+
+    for i, (region_index, category, polygon, heights, transcription, _) in enumerate(FIXED_LINES):
+        line = page_xml.TextLine(f"l{i}", heights, category)
+        line.polygon = polygon
+        line.transcription = transcription
+        regions[region_index].lines.append(line)
+
+    return page_xml.Page("page", (3400, 1200), regions)
+
+
+def create_fixed_pero_page_layout():
+    page_layout = PageLayout(id="page", page_size=(3400, 1200))
+
+    for i, (category, polygon, transcription) in enumerate(FIXED_REGIONS):
+        region = RegionLayout(f"r{i}", np.asarray(polygon))
+        region.category = category
+        region.transcription = transcription
+        page_layout.regions.append(region)
+
+    for i, (region_index, category, polygon, heights, transcription, _) in enumerate(FIXED_LINES):
+        polygon = np.asarray(polygon)
+        line = TextLine(id=f"l{i}", baseline=polygon[:2], polygon=polygon, heights=heights, transcription=transcription,
+                        logits=scipy.sparse.csc_matrix(create_logits(transcription, random.Random(i))),
+                        characters=CHARACTERS, logit_coords=[0, 100])
+        line.category = category
+        page_layout.regions[region_index].lines.append(line)
+
+    return page_layout
+
+
+def load_expected_output(name):
+    # the expected output was produced by the original per-line implementation, the JSON texts are compared, so
+    # integers and floats are told apart
+    with open(EXPECTED_PATH, "r", encoding="utf-8") as file:
+        return json.dumps(json.load(file)[name])
+
+
+def save_fixed_confidences(path):
+    stored_lines = [(f"l{i}", line[5]) for i, line in enumerate(FIXED_LINES) if line[5] is not None]
+    save_confidences(path, [line_id for line_id, _ in stored_lines], [confidences for _, confidences in stored_lines])
+
+
+class ConvertLinesTest(unittest.TestCase):
+    def test_expected_output(self):
+        expected = load_expected_output("confidences_file")
+        page = create_fixed_page()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "page.conf")
+            save_fixed_confidences(path)
+
+            with ConfidencesFile(path) as confidences_file:
+                self.assertEqual(json.dumps(server.convert_lines_batch(page, confidences_file)), expected)
+                self.assertEqual(json.dumps(server.convert_lines(page, confidences_file)), expected)
+
+    def test_confidences_file(self):
+        rng = random.Random(0)
+        page = create_page_xml_page(rng)
+
+        lines = [line for region in page.regions for line in region.lines]
+        # one line is missing in the file, its characters get confidence 1
+        stored_lines = lines[1:]
+        line_confidences = [[rng.random() for _ in line.transcription] for line in stored_lines]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "page.conf")
+            save_confidences(path, [line.id for line in stored_lines], line_confidences)
+
+            with ConfidencesFile(path) as confidences_file:
+                self.assertEqual(server.convert_lines_batch(page, confidences_file),
+                                 server.convert_lines(page, confidences_file))
+
+    def test_empty_page(self):
+        page = page_xml.Page("page", (100, 100), [page_xml.TextRegion("r0", "text")])
+        self.assertEqual(server.convert_lines_batch(page), server.convert_lines(page))
+
+    @unittest.skipIf(PageLayout is None, "pero_ocr is not installed")
+    def test_expected_logits_output(self):
+        expected = load_expected_output("logits")
+        page_layout = create_fixed_pero_page_layout()
+
+        self.assertEqual(json.dumps(server.convert_lines_batch(page_layout)), expected)
+        self.assertEqual(json.dumps(server.convert_lines(page_layout)), expected)
+
+    @unittest.skipIf(PageLayout is None, "pero_ocr is not installed")
+    def test_logits(self):
+        page_layout = create_pero_page_layout(random.Random(1))
+        self.assertEqual(server.convert_lines_batch(page_layout), server.convert_lines(page_layout))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""LineBatcher of the OCR pipeline with a stub OCR engine, without a GPU or models.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from ocr_pipeline import LineBatcher
+except ImportError:
+    LineBatcher = None
+
+
+class StubEngine:
+    """process_lines of an OCR engine returning the transcriptions and logits of the crops (strings here)."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    def process_lines(self, crops, sparse_logits=True):
+        self.calls.append(list(crops))
+
+        if self.error is not None:
+            raise self.error
+
+        return [f"text {crop}" for crop in crops], [f"logits {crop}" for crop in crops]
+
+
+def call_pages(batcher, pages, parser_lock=None):
+    """Calls the batcher from a thread for each page (a list of crops), returns the results or raised exceptions."""
+    results = [None] * len(pages)
+
+    for _ in pages:
+        batcher.page_started()
+
+    def process_page(i):
+        try:
+            if parser_lock is None:
+                results[i] = batcher(pages[i], sparse_logits=False)
+            else:
+                with parser_lock:
+                    results[i] = batcher(pages[i], sparse_logits=False)
+        except Exception as error:
+            results[i] = error
+        finally:
+            batcher.page_finished()
+
+    threads = [threading.Thread(target=process_page, args=(i,)) for i in range(len(pages))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    return results
+
+
+@unittest.skipIf(LineBatcher is None, "dependencies of ocr_pipeline are not installed")
+class LineBatcherTest(unittest.TestCase):
+    def test_split_results(self):
+        engine = StubEngine()
+        batcher = LineBatcher(engine.process_lines, max_delay=5)
+
+        results = call_pages(batcher, [["a", "b", "c"], ["d"], []])
+
+        self.assertEqual(len(engine.calls), 1)
+        self.assertEqual(sorted(engine.calls[0]), ["a", "b", "c", "d"])
+        self.assertEqual(results, [
+            (["text a", "text b", "text c"], ["logits a", "logits b", "logits c"]),
+            (["text d"], ["logits d"]),
+            ([], [])
+        ])
+        self.assertEqual((batcher.batches, batcher.batched_calls, batcher.batched_lines), (1, 3, 4))
+
+    def test_engine_error(self):
+        error = RuntimeError("CUDA out of memory")
+        batcher = LineBatcher(StubEngine(error).process_lines, max_delay=5)
+
+        results = call_pages(batcher, [["a"], ["b", "c"]])
+
+        self.assertEqual(results, [error, error])
+
+    def test_single_page(self):
+        batcher = LineBatcher(StubEngine().process_lines, max_delay=30)
+
+        start = time.monotonic()
+        results = call_pages(batcher, [["a"]])
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(results, [(["text a"], ["logits a"])])
+
+    def test_parser_lock(self):
+        # each page holds the lock around the parser, the batch is complete only when the lock is released by the first
+        parser_lock = threading.Lock()
+        engine = StubEngine()
+        batcher = LineBatcher(engine.process_lines, max_delay=30, parser_lock=parser_lock)
+
+        start = time.monotonic()
+        results = call_pages(batcher, [["a"], ["b"]], parser_lock)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(len(engine.calls), 1)
+        self.assertEqual(results, [(["text a"], ["logits a"]), (["text b"], ["logits b"])])
+        self.assertFalse(parser_lock.locked())
+
+
+if __name__ == "__main__":
+    unittest.main()
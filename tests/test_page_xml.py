@@ -0,0 +1,114 @@
+"""Reading of PAGE XML results by page_xml.read_page, compared with pero_ocr.core.layout.PageLayout.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import page_xml
+import server
+
+try:
+    from pero_ocr.core.layout import PageLayout
+except ImportError:
+    PageLayout = None
+
+PAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "page_formats.xml")
+
+
+class ReadPageTest(unittest.TestCase):
+    def test_read_page(self):
+        page = page_xml.read_page(PAGE_PATH)
+
+        self.assertEqual(page.id, "page")
+        self.assertEqual(page.page_size, (1600, 1200))
+        self.assertEqual([region.id for region in page.regions], ["r1", "r2", "r3"])
+        self.assertEqual([region.category for region in page.regions], ["text", "Obrázek", None])
+        self.assertEqual([region.transcription for region in page.regions],
+                         ["region text", "caption of the image", None])
+        self.assertEqual(page.regions[1].polygon, [[600, 400], [900, 400], [900, 700], [600, 700]])
+        self.assertEqual(page.regions[2].lines, [])
+
+        lines = page.regions[0].lines
+        # the line without a baseline is skipped
+        self.assertEqual([line.id for line in lines], ["r1-l1", "r1-l2", "r1-l3", "r1-l4", "r1-l6"])
+        self.assertEqual([line.transcription for line in lines],
+                         ["JSON custom", "heights_v2 with a word", "legacy heights of four values",
+                          "legacy heights of three values", ""])
+        self.assertEqual([line.heights for line in lines], [[12, 5], [14.5, 6.0], [10.0, 40.0], [30.0, 25.0], [11, 3]])
+        self.assertEqual([line.category for line in lines], ["text", None, None, None, "text"])
+
+        self.assertEqual(lines[1].polygon, [[12, 71], [480, 70], [480, 100], [12, 100]])
+        self.assertEqual(lines[1].baseline, [[12, 95], [250, 96], [480, 95]])
+        self.assertEqual(lines[4].polygon, [[12, 230], [480, 230], [480, 260], [12, 260]])
+        self.assertEqual(lines[4].baseline, [[12, 255], [480, 255]])
+        self.assertTrue(all(isinstance(x, int) for point in lines[4].polygon for x in point))
+
+    def test_file_object(self):
+        with open(PAGE_PATH, "rb") as file:
+            page = page_xml.read_page(file)
+
+        self.assertEqual(len(page.regions[0].lines), 5)
+
+    @unittest.skipIf(PageLayout is None, "pero_ocr is not installed")
+    def test_pero_parity(self):
+        page = page_xml.read_page(PAGE_PATH)
+        page_layout = PageLayout(file=PAGE_PATH)
+
+        self.assertEqual(page.id, page_layout.id)
+        self.assertEqual(page.page_size, page_layout.page_size)
+        self.assertEqual(len(page.regions), len(page_layout.regions))
+
+        for region, pero_region in zip(page.regions, page_layout.regions):
+            self.assertEqual(region.id, pero_region.id)
+            self.assertEqual(region.transcription, pero_region.transcription)
+            np.testing.assert_array_equal(region.polygon, pero_region.polygon)
+            # older versions of pero_ocr do not read the categories
+            if hasattr(pero_region, "category"):
+                self.assertEqual(region.category, pero_region.category)
+
+            self.assertEqual(len(region.lines), len(pero_region.lines))
+
+            for line, pero_line in zip(region.lines, pero_region.lines):
+                self.assertEqual(line.id, pero_line.id)
+                self.assertEqual(line.transcription, pero_line.transcription)
+                np.testing.assert_array_equal(line.polygon, pero_line.polygon)
+                np.testing.assert_array_equal(line.baseline, pero_line.baseline)
+                np.testing.assert_array_equal(line.heights, pero_line.heights)
+
+    @unittest.skipIf(PageLayout is None, "pero_ocr is not installed")
+    def test_pero_lines(self):
+        # /get_lines of the page is the same as from the PageLayout read by pero_ocr. Versions of pero_ocr without
+        # categories get them from the minimal reader, and the values are compared as numbers, as those versions read
+        # heights of the JSON custom attribute (integers) by the legacy regular expression as floats.
+        page = page_xml.read_page(PAGE_PATH)
+        page_layout = PageLayout(file=PAGE_PATH)
+
+        for region, pero_region in zip(page.regions, page_layout.regions):
+            pero_region.category = region.category
+            for line, pero_line in zip(region.lines, pero_region.lines):
+                pero_line.category = line.category
+
+        confidences = ConfidencesStub()
+        self.assertEqual(server.convert_lines_batch(page, confidences),
+                         server.convert_lines_batch(page_layout, confidences))
+
+
+class ConfidencesStub:
+    """Lines without stored confidences, all characters get confidence 1."""
+
+    def get(self, line_id):
+        return None
+
+    def get_batch(self, line_ids):
+        return [None] * len(line_ids)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,15 @@
+"""WSGI entry point of the server for production servers, e.g.:
+
+    PERO_SERVER_CONFIG=config.ini gunicorn --workers 4 --threads 16 --worker-class gthread --timeout 60 wsgi:app
+
+Each /wait_status request occupies a thread for up to `wait_status_timeout` seconds, so `wait_status_max_waiters`
+should be set to at most half of the threads.
+
+`python server.py -c config.ini --workers 4` runs the same setup with the TLS settings of the config file.
+"""
+
+import os
+
+from server import create_app
+
+app = create_app(os.environ["PERO_SERVER_CONFIG"])